@@ -8,28 +8,816 @@
 # in several places the program checks which version of the interpreter is
 # dealing with and selects the appropriate version of the code to be executed.
 
+import argparse
+import base64
+import bisect
+import email.utils
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import math
+import mmap
+import multiprocessing
 import os
+import re
+import select
+import selectors
+import signal
 import socket
 import sys
-from threading import Event, Lock, Thread
+import time
+import traceback
+import zlib
+from collections import OrderedDict, deque
+from struct import pack, pack_into, unpack_from
+from threading import Condition, Event, Lock, Thread
+
+try:
+    import resource # Not available on Windows.
+except ImportError:
+    resource = None
+
+try:
+    import brotli # Optional, files are also compressed with Brotli if present.
+except ImportError:
+    brotli = None
+
+if sys.version_info.major == 3:
+    from urllib.parse import parse_qs
+else:
+    from urlparse import parse_qs
 
 DEBUG = False # Changing to True displays additional messages.
 
+# Longest time (in seconds) a client may wait for new messages in one request.
+MAX_POLL_TIMEOUT = 60
+
+# Files up to this size are kept in memory (together with their compressed
+# versions), as long as all of them together do not exceed FILE_CACHE_BYTES.
+# Larger files are sent straight from the disk.
+FILE_CACHE_MAX_FILE = 1024 * 1024
+FILE_CACHE_BYTES = 16 * 1024 * 1024
+
+# How often (in seconds) a cached file is checked for changes.
+FILE_CHECK_INTERVAL = 1
+
+# Files of these types are worth compressing.
+COMPRESSIBLE_EXTENSIONS = ('.html', '.js', '.css', '.json', '.txt', '.svg')
+
+# Responses made on the fly (e.g. the messages) are compressed with this
+# zlib level (0 means not at all) if they have at least this many bytes.
+# Smaller ones are not worth the time, nor the header.
+DYNAMIC_COMPRESS_LEVEL = 6
+DYNAMIC_COMPRESS_MIN_SIZE = 1024
+DYNAMIC_ENCODINGS = ('gzip', 'deflate')
+
+# How often a comment is sent over an idle event stream, so that proxies
+# and browsers do not consider the connection dead.
+EVENT_STREAM_HEARTBEAT = 15
+
+# Rooms other than the default one: how many of them there may be, how much
+# memory their messages may take together, and after how many seconds
+# without any requests a room is forgotten. The limits are checked once
+# in a while, the least recently used rooms are removed first.
+ROOMS_LIMIT = 10000
+ROOMS_BYTES = 256 * 1024 * 1024
+ROOM_IDLE_TIMEOUT = 600
+ROOMS_CHECK_INTERVAL = 1
+
+# Allowed names of the rooms (the default room is called '').
+ROOM_NAME = re.compile(r'[A-Za-z0-9_.-]{0,64}$')
+
+# Requests every client address may make, by route (None stands for all
+# the other routes), as (per second, at once). The limits are kept for
+# this many addresses at most, the ones not seen for the longest time are
+# forgotten first.
+RATE_LIMITS = {
+    ('POST', '/chat'):     (5, 20),
+    ('POST', '/messages'): (20, 40),
+    ('GET', '/messages'):  (20, 40),
+    ('GET', '/events'):    (1, 5),
+    ('GET', '/ws'):        (1, 5),
+    None:                  (20, 100),
+}
+RATE_LIMIT_CLIENTS = 100000
+
+# Messages sent to /chat in one request at most. Each of them counts as
+# a request for the limits, so there should not be more than can be sent
+# at once.
+CHAT_BATCH_LIMIT = 20
+
+# Connections a server process keeps open at most; the ones above the limit
+# are told to come back after RETRY_AFTER seconds. Every connection takes a
+# thread, unless they are handled by the event loop.
+MAX_CONNECTIONS = 1000
+MAX_CONNECTIONS_EVENT_LOOP = 50000
+RETRY_AFTER = 1
+
+# A WebSocket client which does not take a frame within this many seconds
+# is disconnected (by ClientThread; the event loop limits the queued bytes).
+WEBSOCKET_SEND_TIMEOUT = 10
+
+# Fixed-size store of the most recent messages, indexed by their absolute IDs
+# (the ID of a message is the number of messages added before it); a new
+# message simply takes the place of the oldest one.
+# Every message is kept already serialized to JSON, so a response is only
+# joined from ready pieces. Responses are also remembered until the next
+# message arrives, since most clients ask for the same thing.
+# The ring itself is not thread-safe; SimpleChatWWW holds its lock while
+# using it.
+class MessageRing():
+    RESPONSE_CACHE_SIZE = 16
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.next_id = 0
+        self.bytes = 0 # Size of the stored messages.
+        self.lock = Lock()
+
+        self.responses = {}
+        self.responses_head = 0 # ID of the next message when they were made.
+
+        # Part of the ETags: the IDs start from 0 again in a new store (after
+        # a restart, or in a room created again), so they are not enough.
+        self.generation = base64.urlsafe_b64encode(os.urandom(6)).decode('ascii')
+
+        # Readable when messages are added by other processes (see
+        # SharedMessageRing), None if there are no others.
+        self.wakeup_fd = None
+
+    # ID of the next message.
+    def head(self):
+        return self.next_id
+
+    # ID of the oldest message still stored.
+    def oldest(self):
+        return max(self.head() - self.capacity, 0)
+
+    def append(self, sender_ip, text):
+        self.store(self.head(), json.dumps([sender_ip, text]).encode('utf-8'))
+
+    def store(self, message_id, data):
+        slot = message_id % self.capacity
+        if self.slots[slot] is not None:
+            self.bytes -= len(self.slots[slot])
+        self.slots[slot] = data
+        self.bytes += len(data)
+        self.next_id = message_id + 1
+
+    # Bytes taken by the messages and the remembered responses.
+    def memory(self):
+        return self.bytes + sum(len(response) for response in self.responses.values())
+
+    # Serialized messages with IDs from start to end (excluding end).
+    def pieces(self, start, end):
+        # The messages may wrap around the end of the slots.
+        first = start % self.capacity
+        end = first + end - start
+        if end <= self.capacity:
+            return self.slots[first:end]
+        return self.slots[first:] + self.slots[:end - self.capacity]
+
+    # The JSON response with the messages from last_message_id on (or from
+    # the oldest one still stored), its ETag and the ID following the last
+    # message in it. A response holds at most `capacity` messages; a new
+    # client (last_message_id < 0) gets the most recent ones, and so does
+    # a client which knows of more messages than there are (e.g. in a room
+    # which has been forgotten in the meantime).
+    def encoded_since(self, last_message_id):
+        head = self.head()
+        if head != self.responses_head:
+            self.responses.clear()
+            self.responses_head = head
+
+        if last_message_id < 0 or last_message_id > head:
+            last_message_id = head - self.capacity
+        start = min(max(last_message_id, self.oldest()), head)
+        end = min(start + self.capacity, head)
+        etag = '"%s-%u-%u"' % (self.generation, start, end)
+
+        response = self.responses.get(start)
+        if response is None:
+            response = b''.join([
+                b'{"last_message_id": ', str(end).encode('ascii'),
+                b', "messages": [', b', '.join(self.pieces(start, end)), b']}'])
+
+            if len(self.responses) >= self.RESPONSE_CACHE_SIZE:
+                self.responses.clear()
+            self.responses[start] = response
+
+        return response, etag, end
+
+    # Forget the wakeups which have already been seen.
+    def clear_wakeup(self):
+        if self.wakeup_fd is None:
+            return
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+# MessageRing shared by several worker processes.
+# The messages live in an anonymous shared memory map created before the
+# workers are started: a header with the ID of the next message, followed by
+# slots of a fixed size, each with the length and the bytes of a message.
+# The lock is a semaphore shared by the processes as well. Every worker has a
+# pipe; after adding a message, a worker writes a byte to the pipes of all
+# the others, so their clients waiting for messages can be answered at once.
+class SharedMessageRing(MessageRing):
+    SLOT_SIZE = 4096
+
+    def __init__(self, capacity, workers, slot_size=SLOT_SIZE):
+        MessageRing.__init__(self, 0)
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.mem = mmap.mmap(-1, 8 + capacity * slot_size)
+        self.lock = multiprocessing.Lock()
+
+        self.pipes = []
+        for i in range(workers):
+            r, w = os.pipe()
+            os.set_blocking(r, False)
+            os.set_blocking(w, False)
+            self.pipes.append((r, w))
+        self.worker = None
+
+    # To be called in every worker process after it has been started.
+    def attach(self, worker):
+        self.worker = worker
+        for i, (r, w) in enumerate(self.pipes):
+            if i != worker:
+                os.close(r)
+        self.wakeup_fd = self.pipes[worker][0]
+
+    def head(self):
+        return unpack_from('<Q', self.mem, 0)[0]
+
+    def store(self, message_id, data):
+        if len(data) > self.slot_size - 4:
+            raise ValueError("message too long")
+        offset = 8 + (message_id % self.capacity) * self.slot_size
+        pack_into('<I', self.mem, offset, len(data))
+        self.mem[offset + 4:offset + 4 + len(data)] = data
+
+        # The message becomes visible only when it is complete.
+        pack_into('<Q', self.mem, 0, message_id + 1)
+
+        for i, (r, w) in enumerate(self.pipes):
+            if i != self.worker:
+                try:
+                    os.write(w, b'!')
+                except BlockingIOError:
+                    pass # The pipe is full of wakeups that have not been seen yet.
+
+    def pieces(self, start, end):
+        pieces = []
+        for message_id in range(start, end):
+            offset = 8 + (message_id % self.capacity) * self.slot_size
+            length = unpack_from('<I', self.mem, offset)[0]
+            pieces.append(self.mem[offset + 4:offset + 4 + length])
+        return pieces
+
+# A part of MessageLog: messages from the one with ID `base` on, in the file
+# "<base>.log", one per line, and the offsets just past each of them in
+# "<base>.idx", as 8-byte integers. The index has a fixed size (the number
+# of messages that fit in the segment) and is mapped into memory.
+class LogSegment():
+    def __init__(self, path, base, size):
+        self.base = base
+        name = os.path.join(path, '%020u' % base)
+        self.log_path = name + '.log'
+        self.index_path = name + '.idx'
+
+        self.fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # An existing segment keeps its size, even if the default changed.
+            index_size = os.fstat(index_fd).st_size
+            if index_size < 8:
+                index_size = size * 8
+                os.ftruncate(index_fd, index_size)
+            self.index_map = mmap.mmap(index_fd, index_size)
+        finally:
+            os.close(index_fd)
+        self.index = memoryview(self.index_map).cast('Q')
+        self.size = len(self.index)
+
+        # The offsets grow until the first empty entry. Entries pointing past
+        # the end of the log belong to messages which did not reach the disk.
+        log_size = os.fstat(self.fd).st_size
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if 0 < self.index[mid] <= log_size:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.count = lo
+        self.end = self.index[lo - 1] if lo else 0
+        self.synced = self.count
+
+        # Drop whatever was not completely written before the server stopped.
+        if log_size > self.end:
+            os.ftruncate(self.fd, self.end)
+        if self.count < self.size and self.index[self.count]:
+            self.index_map[self.count * 8:] = bytes((self.size - self.count) * 8)
+
+    def append(self, data):
+        os.write(self.fd, data + b'\n')
+        self.end += len(data) + 1
+        self.index[self.count] = self.end
+        self.count += 1
+
+    # Messages from first to last (excluding last), counted from the base.
+    def pieces(self, first, last):
+        offset = self.index[first - 1] if first else 0
+        data = os.pread(self.fd, self.index[last - 1] - offset, offset)
+        return data.split(b'\n')[:-1]
+
+    # Make sure that the messages written so far are on the disk.
+    def sync(self):
+        count = self.count
+        os.fsync(self.fd)
+
+        # Only the pages of the index which have changed.
+        start = self.synced * 8 // mmap.PAGESIZE * mmap.PAGESIZE
+        self.index_map.flush(start, count * 8 - start)
+        self.synced = count
+
+    def close(self):
+        self.index.release()
+        self.index_map.close()
+        os.close(self.fd)
+
+    def remove(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+
+# MessageRing kept on the disk, so the messages survive a restart of the
+# server, and there can be many more of them than fit in the memory.
+# The log is split into segments (see LogSegment); a message with any ID is
+# found through the index of its segment without reading anything before it,
+# and starting the server only means mapping the indexes. When the log grows
+# over `keep_messages`, the oldest segments are removed.
+# Messages are written at once, but become visible only after they have
+# been flushed to the disk. A single thread does it for all the messages
+# written in the meantime (group commit), so the cost of fsync is shared
+# by all of them; then it wakes up the clients waiting for messages.
+class MessageLog(MessageRing):
+    SEGMENT_MESSAGES = 1000000
+    KEEP_MESSAGES = 10000000
+
+    def __init__(self, capacity, path, segment_messages=SEGMENT_MESSAGES,
+                 keep_messages=KEEP_MESSAGES):
+        MessageRing.__init__(self, 0)
+        self.capacity = capacity
+        self.path = path
+        self.segment_messages = segment_messages
+        self.keep_messages = keep_messages
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.segments = []
+        for fname in sorted(os.listdir(path)):
+            base, ext = os.path.splitext(fname)
+            if ext == '.log' and base.isdigit():
+                self.segments.append(LogSegment(path, int(base), segment_messages))
+        if not self.segments:
+            self.segments.append(LogSegment(path, 0, segment_messages))
+
+        last = self.segments[-1]
+        self.next_id = last.base + last.count # The next visible message.
+        self.written = self.next_id           # The next message to write.
+        self.unsynced = []                    # Segments written since the last commit.
+
+        r, self.wakeup_w = os.pipe()
+        os.set_blocking(r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.wakeup_fd = r
+
+        self.pending = Event()
+        committer = Thread(target=self.__commit_loop)
+        committer.daemon = True
+        committer.start()
+
+    def oldest(self):
+        return self.segments[0].base
+
+    def append(self, sender_ip, text):
+        self.store(self.written, json.dumps([sender_ip, text]).encode('utf-8'))
+
+    def store(self, message_id, data):
+        segment = self.segments[-1]
+        if segment.count == segment.size:
+            segment = LogSegment(self.path, message_id, self.segment_messages)
+            self.segments.append(segment)
+        segment.append(data)
+        self.written = message_id + 1
+
+        if not self.unsynced or self.unsynced[-1] is not segment:
+            self.unsynced.append(segment)
+        self.pending.set()
+
+    def pieces(self, start, end):
+        pieces = []
+        for segment in self.segments:
+            first = max(start, segment.base)
+            last = min(end, segment.base + segment.count)
+            if first < last:
+                pieces.extend(segment.pieces(first - segment.base, last - segment.base))
+        return pieces
+
+    def __commit_loop(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+
+            with self.lock:
+                written = self.written
+                segments, self.unsynced = self.unsynced, []
+
+            # Messages written during the flush wait for the next one.
+            for segment in segments:
+                segment.sync()
+
+            with self.lock:
+                self.next_id = written
+
+                # Segments are removed only when everything in them is
+                # already visible, so none of them is still being flushed.
+                while (len(self.segments) > 1 and
+                       written - self.segments[1].base >= self.keep_messages):
+                    self.segments.pop(0).remove()
+
+            try:
+                os.write(self.wakeup_w, b'!')
+            except BlockingIOError:
+                pass # The pipe is full of wakeups that have not been seen yet.
+
+# A file served by SimpleChatWWW, with everything needed to answer quickly.
+# The variants are the file as it is ('') and its compressed versions
+# ('gzip', 'br'), each as (data or None, path, size, ETag); data is None for
+# variants which are too large to keep in memory and are sent from the disk.
+class StaticFile():
+    __slots__ = ("mtime_ns", "size", "last_modified", "variants", "cost", "checked")
+
+    def __init__(self, fname, st):
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.variants = {}
+        self.cost = 256 # Rough memory use of the entry itself.
+        self.checked = time.monotonic()
+
+        # Files compressed in advance (e.g. with "gzip -k") are used when they
+        # are not older than the file itself.
+        etag = '%x-%x' % (st.st_mtime_ns, st.st_size)
+        self.add_variant('', None, fname, st.st_size, etag)
+        for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+            try:
+                variant_st = os.stat(fname + ext)
+            except OSError:
+                continue
+            if variant_st.st_mtime_ns >= st.st_mtime_ns:
+                self.add_variant(encoding, None, fname + ext, variant_st.st_size, etag)
+
+    def add_variant(self, encoding, data, path, size, etag):
+        # Every variant has its own ETag, as its bytes are different.
+        etag = '"%s%s"' % (etag, '-' + encoding if encoding else '')
+        self.variants[encoding] = (data, path, size, etag)
+        if data is not None:
+            self.cost += len(data)
+
+    # Load the variants into memory and compress the file in the missing ones.
+    def load(self, compress):
+        for encoding in list(self.variants):
+            data, path, size, etag = self.variants[encoding]
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.variants[encoding] = (data, path, len(data), etag)
+            self.cost += len(data)
+
+        if not compress:
+            return
+        data, path, size, etag = self.variants['']
+        etag = etag.strip('"')
+        compressors = [('gzip', lambda data: gzip.compress(data, 9))]
+        if brotli is not None:
+            compressors.append(('br', brotli.compress))
+        for encoding, compressor in compressors:
+            if encoding not in self.variants:
+                compressed = compressor(data)
+                # Very small files may only grow.
+                if len(compressed) < len(data):
+                    self.add_variant(encoding, compressed, path, len(compressed), etag)
+
+# Counters of one route of the website (or of all the unknown ones).
+class RouteMetrics():
+    __slots__ = ("statuses", "buckets", "seconds", "bytes_in", "bytes_out")
+
+    def __init__(self, buckets):
+        self.statuses = {} # Number of responses by status (None if waiting).
+        self.buckets = [0] * (buckets + 1) # The last one is +Inf.
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+# What the server has been doing, in the text format of Prometheus.
+# Handling a request only appends a tuple to a queue (which needs no lock in
+# CPython); the tuples are added up in the counters of the routes once
+# there are enough of them or the metrics are asked for. With several
+# workers every process has its own.
+class Metrics():
+    # Upper limits of the buckets of the request duration histogram, in seconds.
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    # Requests recorded before they are added up.
+    RECORDS_LIMIT = 256
+
+    def __init__(self, routes):
+        self.lock = Lock()
+        self.routes = dict((route, RouteMetrics(len(self.BUCKETS))) for route in routes)
+        self.other = RouteMetrics(len(self.BUCKETS))
+        self.records = deque()
+
+        self.connections = 0
+        self.connections_total = 0
+        self.connections_rejected = 0
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+
+    # A request for `route` has been handled. A response held until there
+    # are new messages has no status yet and is counted as "wait".
+    def request(self, route, response, bytes_in, seconds):
+        self.records.append((route, response, bytes_in, seconds))
+        if len(self.records) >= self.RECORDS_LIMIT:
+            self.collect()
+
+    def collect(self):
+        with self.lock:
+            # The same as self.routes.get() etc., only without looking them
+            # up for every record.
+            popleft = self.records.popleft
+            get_route = self.routes.get
+            other = self.other
+            bisect_left = bisect.bisect_left
+            buckets = self.BUCKETS
+
+            for i in range(len(self.records)):
+                route, response, bytes_in, seconds = popleft()
+                m = get_route(route, other)
+                status = response.get('status')
+                m.statuses[status] = m.statuses.get(status, 0) + 1
+                m.buckets[bisect_left(buckets, seconds)] += 1
+                m.seconds += seconds
+                m.bytes_in += bytes_in
+                data = response.get('data')
+                if data is not None:
+                    m.bytes_out += len(data)
+                elif 'file' in response:
+                    m.bytes_out += response['file'][1]
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    # A connection has been turned away, as there were too many of them.
+    def connection_rejected(self):
+        with self.lock:
+            self.connections_rejected += 1
+
+    # Called by TimedLock after waiting. Every room has its own lock, so
+    # several of them may be reporting at the same time.
+    def lock_waited(self, seconds):
+        with self.lock:
+            self.lock_waits += 1
+            self.lock_wait_seconds += seconds
+
+    # `counters` and `gauges` are other values, as (name, description, value).
+    def render(self, counters=(), gauges=()):
+        lines = []
+        def metric(name, kind, description, samples):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, labels, value))
+
+        self.collect()
+        with self.lock:
+            routes = sorted(self.routes.items())
+            routes.append((('', 'other'), self.other))
+
+            requests = []
+            durations = []
+            bytes_in = []
+            bytes_out = []
+            for (method, path), m in routes:
+                labels = 'method="%s",path="%s"' % (method, path)
+                for status, count in sorted(m.statuses.items(), key=str):
+                    status = status[0] if status is not None else 'wait'
+                    requests.append(('{%s,status="%s"}' % (labels, status), count))
+                total = 0
+                for le, count in zip(self.BUCKETS + ('+Inf',), m.buckets):
+                    total += count
+                    durations.append(('_bucket{%s,le="%s"}' % (labels, le), total))
+                durations.append(('_sum{%s}' % labels, repr(m.seconds)))
+                durations.append(('_count{%s}' % labels, total))
+                bytes_in.append(('{%s}' % labels, m.bytes_in))
+                bytes_out.append(('{%s}' % labels, m.bytes_out))
+
+            connections = self.connections
+            connections_total = self.connections_total
+            connections_rejected = self.connections_rejected
+            lock_waits, lock_wait_seconds = self.lock_waits, self.lock_wait_seconds
+
+        metric('httpchat_requests_total', 'counter',
+               'Requests handled, by route and response status.', requests)
+        # The histogram lines share the name given once in HELP and TYPE.
+        lines.append('# HELP httpchat_request_duration_seconds Time spent in the handlers.')
+        lines.append('# TYPE httpchat_request_duration_seconds histogram')
+        for suffix, value in durations:
+            lines.append('httpchat_request_duration_seconds%s %s' % (suffix, value))
+        metric('httpchat_request_body_bytes_total', 'counter',
+               'Bytes of request bodies received.', bytes_in)
+        metric('httpchat_response_body_bytes_total', 'counter',
+               'Bytes of response bodies sent.', bytes_out)
+        metric('httpchat_connections', 'gauge', 'Open connections.', [('', connections)])
+        metric('httpchat_connections_total', 'counter', 'Accepted connections.',
+               [('', connections_total)])
+        metric('httpchat_connections_rejected_total', 'counter',
+               'Connections refused because of too many open ones.', [('', connections_rejected)])
+        metric('httpchat_messages_lock_waits_total', 'counter',
+               'Times a lock of the messages (of any room) was taken only after waiting.', [('', lock_waits)])
+        metric('httpchat_messages_lock_wait_seconds_total', 'counter',
+               'Time spent waiting for the locks of the messages.', [('', repr(lock_wait_seconds))])
+        for name, description, value in counters:
+            metric(name, 'counter', description, [('', value)])
+        for name, description, value in gauges:
+            metric(name, 'gauge', description, [('', value)])
+
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+# A lock that tells the metrics how long it had to be waited for. Taking it
+# when it is free costs only one more call; only waiting is measured.
+class TimedLock():
+    def __init__(self, lock, metrics):
+        self.lock = lock
+        self.metrics = metrics
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        if timeout < 0:
+            acquired = self.lock.acquire()
+        else:
+            acquired = self.lock.acquire(True, timeout)
+        if acquired:
+            self.metrics.lock_waited(time.perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+# Token buckets of the clients, by their addresses, one set for every route
+# with a limit. A bucket holds at most `burst` tokens and gets `rate` new ones
+# every second; a request takes one. Only the tokens and the time they were
+# counted are kept, and a bucket is refilled when it is used again.
+# There are at most `clients` buckets for a route: when there would be more,
+# the full ones are forgotten (they are the same as new ones), and if that
+# does not free half of the places, the oldest ones.
+class RateLimiter():
+    def __init__(self, limits, clients=RATE_LIMIT_CLIENTS):
+        self.limits = limits
+        self.clients = clients
+        self.buckets = dict((route, {}) for route in limits)
+        self.lock = Lock()
+
+    # Take tokens for requests of the client for the route. Returns 0 if
+    # there were enough, or the number of seconds until there are.
+    def take(self, route, client_ip, count=1):
+        if route not in self.limits:
+            route = None
+            if route not in self.limits:
+                return 0
+        rate, burst = self.limits[route]
+        buckets = self.buckets[route]
+        now = time.monotonic()
+        with self.lock:
+            bucket = buckets.get(client_ip)
+            if bucket is None:
+                if len(buckets) >= self.clients:
+                    self.__make_room(buckets, now, rate, burst)
+                bucket = buckets[client_ip] = [burst, now]
+
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= count:
+                bucket[0] = tokens - count
+                return 0
+            bucket[0] = tokens
+            return (count - tokens) / rate
+
+    def __make_room(self, buckets, now, rate, burst):
+        for client_ip, (tokens, counted) in list(buckets.items()):
+            if tokens + (now - counted) * rate >= burst:
+                del buckets[client_ip]
+        # The dictionary keeps the order in which the clients came.
+        for client_ip in list(itertools.islice(buckets, max(0, len(buckets) - self.clients // 2))):
+            del buckets[client_ip]
+
+# A chat room with its own messages, lock and message IDs, so the clients of
+# one room never wait for those of another. Threads wait for new messages on
+# the condition, while the event loop is told by the listeners of the website.
+# A room which has been removed is closed: the clients waiting for it get
+# what it had, and the event streams and WebSockets are closed, so that
+# the clients come back to a new room with the same name.
+class ChatRoom():
+    def __init__(self, name, messages, metrics):
+        self.name = name
+        self.messages = messages
+        self.lock = TimedLock(messages.lock, metrics)
+        self.cond = Condition(self.lock)
+        self.last_active = time.monotonic()
+        self.closed = False
+
+        # Frames with messages for WebSocket clients by the ETag of their
+        # contents; every client gets the same one, so it is encoded once.
+        # So are the compressed responses, by their own ETags.
+        self.frames = {}
+        self.compressed = {}
+
+    # Wait (at most `timeout` seconds) until there are messages the client
+    # does not have yet. Returns False if there are still none.
+    def wait_for_messages(self, last_message_id, timeout):
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: self.closed or self.messages.head() != last_message_id, timeout)
+
+    def memory(self):
+        with self.lock:
+            return (self.messages.memory() +
+                    sum(len(frame) for frame in self.frames.values()) +
+                    sum(len(data) for data in self.compressed.values()))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
 # Implementation of website logic.
 class SimpleChatWWW():
-    def __init__(self, the_end):
+    def __init__(self, the_end, workers=1, log_path=None,
+                 compress_level=DYNAMIC_COMPRESS_LEVEL, compress_min_size=DYNAMIC_COMPRESS_MIN_SIZE,
+                 rate_limits=RATE_LIMITS):
         self.the_end = the_end
         self.files = "." # For example, the files may be in your working directory.
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
 
-        self.file_cache = {}
+        # Every client may make only so many requests (no limits if None).
+        self.rate_limiter = RateLimiter(rate_limits) if rate_limits is not None else None
+
+        self.file_cache = OrderedDict() # From the least recently used.
+        self.file_cache_bytes = 0
+        self.file_cache_hits = 0
+        self.file_cache_misses = 0
         self.file_cache_lock = Lock()
 
-        self.messages = []
-        self.messages_offset = 0
-        self.messages_lock = Lock()
-        self.messages_limit = 1000 # Maximum number of stored messages.
-        
+        # Maximum number of messages kept in memory (in every room) and sent
+        # in one response.
+        self.messages_limit = 1000
+        if log_path is not None:
+            messages = MessageLog(self.messages_limit, log_path)
+        elif workers > 1:
+            messages = SharedMessageRing(self.messages_limit, workers)
+        else:
+            messages = MessageRing(self.messages_limit)
+
+        # Only the default room can be shared by the workers or kept on the
+        # disk, so the other rooms are available only without them.
+        self.rooms_enabled = log_path is None and workers <= 1
+
         # Mapping web addresses to handlers.
         self.handlers = {
             ('GET', '/'):          self.__handle_GET_index,
@@ -38,22 +826,97 @@ class SimpleChatWWW():
             ('GET', '/main.js'):   self.__handle_GET_javascript,
             ('POST', '/chat'):     self.__handle_POST_chat,
             ('POST', '/messages'): self.__handle_POST_messages,
+            ('GET', '/messages'):  self.__handle_GET_messages,
+            ('GET', '/events'):    self.__handle_GET_events,
+            ('GET', '/ws'):        self.__handle_GET_websocket,
+            ('GET', '/metrics'):   self.__handle_GET_metrics,
         }
+        self.metrics = Metrics(self.handlers)
+
+        # The rooms by their names. They are looked up without the lock,
+        # which is needed only to add or remove them.
+        self.default_room = ChatRoom('', messages, self.metrics)
+        self.rooms = { '': self.default_room }
+        self.rooms_lock = Lock()
+        self.rooms_checked = time.monotonic()
+
+        # The event loop registers a listener called (with the room) after
+        # every new message.
+        self.messages_listeners = []
 
     def handle_http_request(self, req):
-        req_query = (req['method'], req['query'])
-        if req_query not in self.handlers:
-            return { 'status': (404, 'Not Found') }
-        return self.handlers[req_query](req)
+        started = time.perf_counter()
+
+        # The parameters after "?" do not take part in choosing the handler.
+        req_query = (req['method'], req['query'].split('?', 1)[0])
+        handler = self.handlers.get(req_query)
+        retry_after = self.__rate_limited(req_query, req)
+        if retry_after:
+            response = {
+                'status': (429, 'Too Many Requests'),
+                'headers': [
+                    ('Retry-After', '%u' % retry_after),
+                ]
+            }
+        elif handler is None:
+            response = { 'status': (404, 'Not Found') }
+        else:
+            response = handler(req)
+
+        self.metrics.request(req_query, response, len(req['data'] or ''),
+                             time.perf_counter() - started)
+        return response
+
+    # Whether the client has made too many requests for the route recently.
+    # Returns the number of seconds after which it may try again, or 0.
+    def __rate_limited(self, route, req, count=1):
+        if self.rate_limiter is None:
+            return 0
+        wait = self.rate_limiter.take(route, req['client_ip'], count)
+        return int(math.ceil(wait))
+
+    # The same for the other messages of a batch sent to /chat (the request
+    # itself has already been counted as the first one). Too long batches
+    # are refused by __chat() anyway.
+    def __batch_rate_limited(self, req, obj):
+        if type(obj) is not list or not 1 < len(obj) <= CHAT_BATCH_LIMIT:
+            return 0
+        return self.__rate_limited(('POST', '/chat'), req, len(obj) - 1)
 
     def __handle_GET_index(self, req):
-        return self.__send_file('httpchat_index.html')
+        return self.__send_file(req, 'httpchat_index.html')
 
     def __handle_GET_style(self, req):
-        return self.__send_file('httpchat_style.css')
+        return self.__send_file(req, 'httpchat_style.css')
 
     def __handle_GET_javascript(self, req):
-        return self.__send_file('httpchat_main.js')
+        return self.__send_file(req, 'httpchat_main.js')
+
+    def __handle_GET_metrics(self, req):
+        with self.file_cache_lock:
+            file_cache = (self.file_cache_hits, self.file_cache_misses, self.file_cache_bytes)
+        data = self.metrics.render([
+            ('httpchat_file_cache_hits_total', 'Files served from the cache.', file_cache[0]),
+            ('httpchat_file_cache_misses_total', 'Files read from the disk.', file_cache[1]),
+        ], [
+            ('httpchat_file_cache_bytes', 'Bytes of files in the cache.', file_cache[2]),
+            ('httpchat_messages_next_id', 'ID of the next message in the default room.',
+             self.default_room.messages.head()),
+            ('httpchat_rooms', 'Chat rooms.', len(self.rooms)),
+        ])
+        headers = [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Cache-Control', 'no-cache'),
+        ]
+        encoding = self.__choose_encoding(req, data, headers)
+        if encoding:
+            data = http_compress(data, encoding, self.compress_level)
+            headers.append(('Content-Encoding', encoding))
+        return {
+            'status': (200, 'OK'),
+            'headers': headers,
+            'data': data
+        }
 
     def __handle_POST_chat(self, req):
         # Read the needed fields from the received JSON object.
@@ -64,27 +927,70 @@ class SimpleChatWWW():
         except ValueError:
             return { 'status': (400, 'Bad Request') }
 
-        if type(obj) is not dict or 'text' not in obj:
-            return { 'status': (400, 'Bad Request') }
-        
-        text = obj['text']
-        if type(text) is not str and type(text) is not unicode:
-            return { 'status': (400, 'Bad Request') }
-        
-        sender_ip = req['client_ip']
+        retry_after = self.__batch_rate_limited(req, obj)
+        if retry_after:
+            return {
+                'status': (429, 'Too Many Requests'),
+                'headers': [
+                    ('Retry-After', '%u' % retry_after),
+                ]
+            }
 
-        # Add a message to the list.
-        # If the list is longer than the limit,
-        # remove one message in front and increase the offset.
-        with self.messages_lock:
-            if len(self.messages) > self.messages_limit:
-                self.messages.pop(0)
-                self.messages_offset += 1
-            self.messages.append((sender_ip, text))
+        room, error = self.__request_room(req, obj)
+        if error:
+            return error
 
-        sys.stdout.write("[  INFO ] <%s> %s\n" % (sender_ip, text))
+        return { 'status': self.__chat(room, req['client_ip'], obj) }
 
-        return { 'status': (200, 'OK') }
+    # Add the message from the object sent by a client, or the messages from
+    # an array of such objects (all of them at once, so the waiting clients
+    # are woken once and get them in one response). Returns the status of
+    # the HTTP response.
+    def __chat(self, room, sender_ip, obj):
+        objs = obj if type(obj) is list else [obj]
+        if not objs:
+            return (400, 'Bad Request')
+        if len(objs) > CHAT_BATCH_LIMIT:
+            return (413, 'Payload Too Large')
+
+        texts = []
+        for obj in objs:
+            if type(obj) is not dict or 'text' not in obj:
+                return (400, 'Bad Request')
+
+            text = obj['text']
+            if type(text) is not str:
+                return (400, 'Bad Request')
+            texts.append(text)
+
+        # Add the messages to the ring (in place of the oldest ones, if it is
+        # full). A message too long for the shared memory stops the batch,
+        # the ones before it stay.
+        status = (200, 'OK')
+        added = 0
+        with room.cond:
+            for text in texts:
+                try:
+                    room.messages.append(sender_ip, text)
+                except ValueError:
+                    status = (413, 'Payload Too Large')
+                    break
+                added += 1
+            if added:
+                room.cond.notify_all()
+        if not added:
+            return status
+
+        for listener in self.messages_listeners:
+            listener(room)
+
+        for text in texts[:added]:
+            if room is self.default_room:
+                sys.stdout.write("[  INFO ] <%s> %s\n" % (sender_ip, text))
+            else:
+                sys.stdout.write("[  INFO ] <%s> [%s] %s\n" % (sender_ip, room.name, text))
+
+        return status
 
     def __handle_POST_messages(self, req):
         # Read the needed fields from the received JSON object.
@@ -102,33 +1008,319 @@ class SimpleChatWWW():
         if type(last_message_id) is not int:
             return { 'status': (400, 'Bad Request') }
 
-        # Copy all messages, starting with last_message_id.
-        with self.messages_lock:
-            last_message_id -= self.messages_offset
-            if last_message_id < 0:
-                last_message_id = 0
-            messages = self.messages[last_message_id:]
-            new_last_message_id = self.messages_offset + len(self.messages)
+        timeout = obj.get('timeout', 0)
+        if type(timeout) not in (int, float) or timeout < 0:
+            return { 'status': (400, 'Bad Request') }
+        # json takes NaN and Infinity too.
+        if type(timeout) is float and not math.isfinite(timeout):
+            return { 'status': (400, 'Bad Request') }
+
+        room, error = self.__request_room(req, obj)
+        if error:
+            return error
+
+        return self.__messages(req, room, last_message_id, timeout)
+
+    # The same as POST, with the parameters in the address, e.g.
+    # /messages?last_message_id=10&timeout=25
+    def __handle_GET_messages(self, req):
+        params = parse_qs(req['query'].partition('?')[2])
+        try:
+            last_message_id = int(params.get('last_message_id', ['-1'])[0])
+            timeout = float(params.get('timeout', ['0'])[0])
+        except ValueError:
+            return { 'status': (400, 'Bad Request') }
+        if not math.isfinite(timeout) or timeout < 0:
+            return { 'status': (400, 'Bad Request') }
+
+        room, error = self.__request_room(req)
+        if error:
+            return error
+
+        return self.__messages(req, room, last_message_id, timeout)
+
+    def __messages(self, req, room, last_message_id, timeout):
+        # With a timeout (long polling), the response is held back until
+        # there is something new or the time runs out.
+        if timeout and not room.wait_for_messages(last_message_id, 0):
+            return {
+                'wait': (last_message_id, min(timeout, MAX_POLL_TIMEOUT),
+                         lambda: self.__messages_response(req, room, last_message_id),
+                         room)
+            }
+        return self.__messages_response(req, room, last_message_id)
+
+    # Server-Sent Events: every new message is sent over a connection which
+    # stays open (the browser's EventSource object receives them).
+    def __handle_GET_events(self, req):
+        # After reconnecting, the browser tells which event it got last.
+        last_message_id = req['headers'].get('last-event-id')
+        if last_message_id is None:
+            params = parse_qs(req['query'].partition('?')[2])
+            last_message_id = params.get('last_message_id', ['-1'])[0]
+        try:
+            last_message_id = int(last_message_id)
+        except ValueError:
+            return { 'status': (400, 'Bad Request') }
 
-        # Generate a response.
-        data = json.dumps({
-            "last_message_id": new_last_message_id,
-            "messages": messages
-        })
+        room, error = self.__request_room(req)
+        if error:
+            return error
 
         return {
             'status': (200, 'OK'),
             'headers': [
-                ('Content-Type', 'application/json;charset=utf-8'),
+                ('Content-Type', 'text/event-stream'),
+                ('Cache-Control', 'no-cache'),
             ],
+            'stream': (last_message_id,
+                       lambda last_message_id: self.__messages_event(room, last_message_id),
+                       room)
+        }
+
+    # WebSocket: a connection over which the messages are both sent (as in
+    # /chat) and received (as in /messages), each as a text frame with JSON.
+    def __handle_GET_websocket(self, req):
+        headers = req['headers']
+        if (headers.get('upgrade', '').lower() != 'websocket' or
+                'upgrade' not in headers.get('connection', '').lower() or
+                'sec-websocket-key' not in headers):
+            return { 'status': (400, 'Bad Request') }
+        if headers.get('sec-websocket-version') != '13':
+            return {
+                'status': (426, 'Upgrade Required'),
+                'headers': [
+                    ('Sec-WebSocket-Version', '13'),
+                ]
+            }
+
+        params = parse_qs(req['query'].partition('?')[2])
+        try:
+            last_message_id = int(params.get('last_message_id', ['-1'])[0])
+        except ValueError:
+            return { 'status': (400, 'Bad Request') }
+
+        room, error = self.__request_room(req)
+        if error:
+            return error
+
+        return {
+            'status': (101, 'Switching Protocols'),
+            'headers': [
+                ('Upgrade', 'websocket'),
+                ('Sec-WebSocket-Accept', websocket_accept(headers['sec-websocket-key'])),
+            ],
+            'websocket': (last_message_id,
+                          lambda last_message_id: self.__messages_frame(room, last_message_id),
+                          lambda data: self.__websocket_message(req, room, data),
+                          room)
+        }
+
+    # A text frame received over a WebSocket. Returns the status code with
+    # which the connection should be closed, or None.
+    def __websocket_message(self, req, room, data):
+        try:
+            obj = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return WEBSOCKET_INVALID_DATA
+
+        # Messages sent over a WebSocket count as requests for /chat.
+        if self.__rate_limited(('POST', '/chat'), req) or self.__batch_rate_limited(req, obj):
+            return WEBSOCKET_TRY_AGAIN_LATER
+
+        # The room may have been removed since the connection was opened.
+        if room.closed:
+            room = self.__room(room.name)
+        status = self.__chat(room, req['client_ip'], obj)
+        if status[0] == 413:
+            return WEBSOCKET_TOO_BIG
+        if status[0] != 200:
+            return WEBSOCKET_INVALID_DATA
+        return None
+
+    # The same data as in the response to /messages, as a WebSocket frame,
+    # or None if the room has been closed.
+    def __messages_frame(self, room, last_message_id):
+        if room.closed:
+            return None, last_message_id
+        data, etag, new_last_message_id = self.__messages_since(room, last_message_id)
+        frame = room.frames.get(etag)
+        if frame is None:
+            frame = websocket_frame(WEBSOCKET_TEXT, data)
+            if len(room.frames) >= MessageRing.RESPONSE_CACHE_SIZE:
+                room.frames.clear()
+            room.frames[etag] = frame
+        return frame, new_last_message_id
+
+    # Messages, starting with last_message_id, as JSON.
+    def __messages_since(self, room, last_message_id):
+        with room.lock:
+            return room.messages.encoded_since(last_message_id)
+
+    def __messages_response(self, req, room, last_message_id):
+        data, etag, new_last_message_id = self.__messages_since(room, last_message_id)
+
+        # A compressed response has its own ETag, as its bytes are different.
+        headers = []
+        encoding = self.__choose_encoding(req, data, headers)
+        if encoding:
+            etag = '%s-%s"' % (etag[:-1], encoding)
+
+        # The client already has exactly this response.
+        headers.append(('ETag', etag))
+        if req['headers'].get('if-none-match') == etag:
+            return {
+                'status': (304, 'Not Modified'),
+                'headers': headers
+            }
+
+        # Every client waiting in the room gets the same response, so it is
+        # compressed only once.
+        if encoding:
+            compressed = room.compressed.get(etag)
+            if compressed is None:
+                compressed = http_compress(data, encoding, self.compress_level)
+                if len(room.compressed) >= MessageRing.RESPONSE_CACHE_SIZE:
+                    room.compressed.clear()
+                room.compressed[etag] = compressed
+            data = compressed
+            headers.append(('Content-Encoding', encoding))
+
+        headers.append(('Content-Type', 'application/json;charset=utf-8'))
+        return {
+            'status': (200, 'OK'),
+            'headers': headers,
         'data': data
         }
 
+    # The encoding in which the response with the given data should be sent
+    # ('' if none). Adds Vary to the headers if the response depends on the
+    # Accept-Encoding header of the request.
+    def __choose_encoding(self, req, data, headers):
+        if not self.compress_level or len(data) < self.compress_min_size:
+            return ''
+        headers.append(('Vary', 'Accept-Encoding'))
+        return http_choose_encoding(req['headers'].get('accept-encoding', ''), DYNAMIC_ENCODINGS)
+
+    # The same data as in the response to /messages, as a single event,
+    # or None if the room has been closed.
+    def __messages_event(self, room, last_message_id):
+        if room.closed:
+            return None, last_message_id
+        data, etag, new_last_message_id = self.__messages_since(room, last_message_id)
+        event = b''.join([b'id: ', str(new_last_message_id).encode('ascii'),
+                          b'\ndata: ', data, b'\n\n'])
+        return event, new_last_message_id
+
+    # The room named in the request ("room" in the JSON object or in the
+    # address, the default room if none), and the response in case of an error.
+    def __request_room(self, req, obj=None):
+        if type(obj) is dict and 'room' in obj:
+            name = obj['room']
+        else:
+            params = parse_qs(req['query'].partition('?')[2])
+            name = params.get('room', [''])[0]
+        if type(name) is not str or not ROOM_NAME.match(name):
+            return None, { 'status': (400, 'Bad Request') }
+        room = self.__room(name)
+        if room is None:
+            return None, { 'status': (404, 'Not Found') }
+        return room, None
+
+    # The room with the given name, created if it does not exist yet (None if
+    # there are no rooms except the default one).
+    def __room(self, name):
+        now = time.monotonic()
+        room = self.rooms.get(name)
+        if room is None:
+            if not self.rooms_enabled:
+                return None
+            with self.rooms_lock:
+                room = self.rooms.get(name)
+                if room is None:
+                    room = ChatRoom(name, MessageRing(self.messages_limit), self.metrics)
+                    self.rooms[name] = room
+            if len(self.rooms) > ROOMS_LIMIT + 1:
+                self.rooms_checked = 0
+        room.last_active = now
+
+        if now - self.rooms_checked >= ROOMS_CHECK_INTERVAL:
+            self.__check_rooms(now)
+        return room
+
+    # Remove the rooms which have not been used for a long time, and the least
+    # recently used ones while there are too many of them or their messages
+    # take too much memory.
+    def __check_rooms(self, now):
+        if not self.rooms_lock.acquire(False):
+            return # Another thread is already doing it.
+        try:
+            self.rooms_checked = now
+            removed = []
+            rooms = []
+            for room in self.rooms.values():
+                if room is self.default_room:
+                    continue
+                if now - room.last_active > ROOM_IDLE_TIMEOUT:
+                    removed.append(room)
+                else:
+                    rooms.append(room)
+
+            rooms.sort(key=lambda room: room.last_active)
+            memory = [room.memory() for room in rooms]
+            total = sum(memory)
+            i = 0
+            while i < len(rooms) and (len(rooms) - i > ROOMS_LIMIT or total > ROOMS_BYTES):
+                removed.append(rooms[i])
+                total -= memory[i]
+                i += 1
+
+            for room in removed:
+                del self.rooms[room.name]
+        finally:
+            self.rooms_lock.release()
+
+        for room in removed:
+            room.close()
+            for listener in self.messages_listeners:
+                listener(room)
+
+    # Readable when other worker processes add messages (None if there are
+    # none); check_messages() should be called then.
+    def messages_wakeup_fd(self):
+        return self.default_room.messages.wakeup_fd
+
+    def check_messages(self):
+        room = self.default_room
+        room.messages.clear_wakeup()
+        with room.cond:
+            room.cond.notify_all()
+        for listener in self.messages_listeners:
+            listener(room)
+
+    # Wait for messages from other processes in a thread (for ClientThread,
+    # the event loop does it by itself).
+    def watch_messages(self):
+        fd = self.messages_wakeup_fd()
+        while not self.the_end.is_set():
+            if select.select([fd], [], [], 1)[0]:
+                self.check_messages()
+
+    # The listener is called (with the room) after every new message, in the
+    # thread which added it, and after a room has been closed.
+    def add_messages_listener(self, listener):
+        self.messages_listeners.append(listener)
+
+    def remove_messages_listener(self, listener):
+        self.messages_listeners.remove(listener)
+
     # Creating a response containing the contents of the file on the disk.
     # In practice, the method below additionally tries to cache files and read
     # them only if they have not already been loaded or if the file has changed
-    # in the meantime.
-    def __send_file(self, fname):
+    # in the meantime. A client which already has the current version of the
+    # file gets only a short "304 Not Modified", and a client which accepts
+    # compressed data gets the compressed version of the file.
+    def __send_file(self, req, fname):
         # Determine the file type based on its extension.
         ext = os.path.splitext(fname)[1]
         mime_type = {
@@ -137,237 +1329,1341 @@ class SimpleChatWWW():
             '.css': 'text/css;charset=utf-8',
             }.get(ext.lower(), 'application/octet-stream')
 
+        entry = self.__get_file(fname)
+        if entry is None:
+            return { 'status': (404, 'Not Found') }
+
+        encoding = http_choose_encoding(req['headers'].get('accept-encoding', ''), entry.variants)
+        data, path, size, etag = entry.variants[encoding]
+
+        headers = [
+            ('ETag', etag),
+            ('Last-Modified', entry.last_modified),
+            ('Cache-Control', 'no-cache'), # Always check if the file has changed.
+            ('Vary', 'Accept-Encoding'),
+        ]
+        if http_not_modified(req['headers'], etag, entry.mtime_ns // 10 ** 9):
+            return { 'status': (304, 'Not Modified'), 'headers': headers }
+
+        headers.append(('Content-Type', mime_type))
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+
+        if data is not None:
+            return { 'status': (200, 'OK'), 'headers': headers, 'data': data }
+
+        # A large file goes from the disk straight to the socket (sendfile).
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return { 'status': (404, 'Not Found') }
+        return {
+            'status': (200, 'OK'),
+            'headers': headers,
+            'file': (f, os.fstat(f.fileno()).st_size)
+            }
+
+    # The cache entry of a file, loaded or refreshed if needed.
+    # Returns None if the file cannot be read.
+    def __get_file(self, fname):
+        now = time.monotonic()
+
+        # Check if the file is in the cache and has been checked recently.
+        with self.file_cache_lock:
+            entry = self.file_cache.get(fname)
+            if entry is not None:
+                self.file_cache.move_to_end(fname)
+                if now - entry.checked < FILE_CHECK_INTERVAL:
+                    self.file_cache_hits += 1
+                    return entry
+
         # Check when the file was last modified.
         try:
-            mtime = os.stat(fname).st_mtime
+            st = os.stat(fname)
         except:
             # Unfortunately, CPython on Windows throws an exception class that is not declared under GNU/Linux.
             # The easiest way is to catch all exceptions, although this is definitely an inelegant solution.
 
             # The file probably does not exist or cannot be accessed.
-            return { 'status': (404, 'Not Found') }
+            return None
 
-        # Check if the file is in the cache.
-        with self.file_cache_lock:
-            if fname in self.file_cache and self.file_cache[fname][0] == mtime:
-                return {
-                    'status': (200, 'OK'),
-                    'headers': [
-                        ('Content-Type', mime_type),
-                    ],
-                'data': self.file_cache[fname][1]
-                }
+        if entry is not None and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+            entry.checked = now
+            with self.file_cache_lock:
+                self.file_cache_hits += 1
+            return entry
 
         # As a last resort, load the file.
-        try:
-            with open(fname, 'rb') as f:
-                data = f.read()
-                mtime = os.fstat(f.fileno()).st_mtime # Update the mime.
-        except IOError as e:
-            # Failed to read the file.
-            if DEBUG:
-                sys.stdout.write("[WARNING] File %s not found, but requested.\n" % fname)
-            
-            return { 'status': (404, 'Not Found') }
+        entry = StaticFile(fname, st)
+        if st.st_size <= FILE_CACHE_MAX_FILE:
+            try:
+                entry.load(os.path.splitext(fname)[1].lower() in COMPRESSIBLE_EXTENSIONS)
+            except IOError as e:
+                # Failed to read the file.
+                if DEBUG:
+                    sys.stdout.write("[WARNING] File %s not found, but requested.\n" % fname)
+                return None
 
-        # Add the contents of the file to the cache (unless another thread has done so in the meantime).
+        # Add the file to the cache (replacing an older version) and make room
+        # for it by removing the least recently used ones.
         with self.file_cache_lock:
-            if fname not in self.file_cache or self.file_cache[fname][0] < mtime:
-                self.file_cache[fname] = (mtime, data)
+            self.file_cache_misses += 1
+            old_entry = self.file_cache.pop(fname, None)
+            if old_entry is not None:
+                self.file_cache_bytes -= old_entry.cost
+            self.file_cache[fname] = entry
+            self.file_cache_bytes += entry.cost
+            while self.file_cache_bytes > FILE_CACHE_BYTES and len(self.file_cache) > 1:
+                old_fname, old_entry = self.file_cache.popitem(last=False)
+                self.file_cache_bytes -= old_entry.cost
+
+        return entry
 
-        # Send a reply with the contents of the file.
-        return {
-            'status': (200, 'OK'),
-                'headers': [
-                    ('Content-Type', mime_type),
-                ],
-            'data': data
-            }
-            
 # A very simple implementation of a multi-threaded HTTP server.
 class ClientThread(Thread):
-    def __init__(self, website, sock, sock_addr):
+    RECV_SIZE = 64 * 1024
+
+    def __init__(self, website, sock, sock_addr, idle_timeout=5, max_requests=100):
         super(ClientThread, self).__init__()
+        self.daemon = True # Clients waiting for messages do not keep the server running.
         self.s = sock
         self.s_addr = sock_addr
         self.website = website
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.parser = HTTPRequestParser()
 
     def __recv_http_request(self):
-        # Very simplified processing of an HTTP request with the main purpose of mining:
-        # - methods
-        # - desired path
-        # - next parameters in the form of a dictionary
-        # - additional data (in the case of POST)
-
-        # Receive data until completion of header.
-        data = recv_until(self.s, '\r\n\r\n')
-        if not data:
-            return None
+        # Receive the data in large pieces and pass them to the parser until
+        # it has a whole request; usually a single piece is enough. Whatever
+        # comes after the request waits in the parser for the next call.
+        while True:
+            request = self.parser.next_request()
+            if request is not None:
+                break
+            if self.parser.expect_continue:
+                self.parser.expect_continue = False
+                self.s.sendall(HTTP_CONTINUE)
 
-        # Split the query into lines.
-        lines = data.split('\r\n')
+            data = self.s.recv(self.RECV_SIZE)
+            if not data:
+                return None # The connection has been broken.
+            self.parser.feed(data)
 
-        # Analyze the query (first line).
-        query_tokens = lines.pop(0).split(' ')
-        if len(query_tokens) != 3:
-            return None
-        
-        method, query, version = query_tokens
-
-        # Load parameters.
-        headers = {}
-        for line in lines:
-            tokens = line.split(':', 1)
-            if len(tokens) != 2:
-                continue
+        request["client_ip"] = self.s_addr[0]
+        request["client_port"] = self.s_addr[1]
+        return request
 
-            # The capitalization of the header does not matter,
-            # so it is a good idea to normalize it,
-            # e.g. by converting all letters to lowercase.
-            header_name = tokens[0].strip().lower()
-            header_value = tokens[1].strip()
-            headers[header_name] = header_value
+    def __send_http_response(self, response, connection=None):
+        try:
+            self.s.sendall(make_http_response(response, connection))
 
-            # For POST method, download additional data.
-            # Note: the exemplary implementation in no way limits the number of transmitted data.
-            if method == 'POST':
-                try:
-                    data_length = int(headers['content-length'])
-                    data = recv_all(self.s, data_length)
-                except KeyError as e:
-                    # There is no Content-Length entry in the headers.
-                    data = recv_remaining(self.s)
-                except ValueError as e:
-                    return None
-            else:
-                data = None
-
-            # Put all relevant data in the dictionary and return it.
-            request = {
-                "method": method,
-                "query": query,
-                "headers": headers,
-                "data": data,
-                "client_ip": self.s_addr[0],
-                "client_port": self.s_addr[1]
-                }
-
-            return request
-
-        def __send_http_response(self, response):
-            # Construct the HTTP response.
-            lines = []
-            lines.append('HTTP/1.1 %u %s' % response['status'])
-
-            # Set the basic fields.
-            lines.append('Server: example')
-            if 'data' in response:
-                lines.append('Content-Length: %u' % len(response['data']))
-            else:
-                lines.append('Content-Length: 0')
-            
-            # Rewrite the headlines.
-            if 'headers' in response:
-                for header in response['headers']:
-                    lines.append('%s: %s' % header)
-            
-            lines.append('')
-
-            # Rewrite the data.
-            if 'data' in response:
-                lines.append(response['data'])
-            
-            # Convert the response to bytes and send.
-            if sys.version_info.major == 3:
-                converted_lines = []
-                for line in lines:
-                    if type(line) is bytes:
-                        converted_lines.append(line)
-                    else:
-                        converted_lines.append(bytes(line, 'utf-8'))
-                    lines = converted_lines
+            # The contents of a large file go from the disk straight to the socket.
+            if 'file' in response:
+                self.s.sendfile(response['file'][0], 0, response['file'][1])
+        finally:
+            if 'file' in response:
+                response['file'][0].close()
 
-                self.s.sendall(b'\r\n'.join(lines))
-            
-            def __handle_client(self):
+    def __handle_client(self):
+        # As long as the client wants, the requests are handled one after
+        # another on the same connection. The client does not have to wait
+        # for a response before sending the next request (pipelining); such
+        # requests wait in the socket until their turn comes.
+        for requests in range(1, self.max_requests + 1):
+            try:
                 request = self.__recv_http_request()
-                if not request:
-                    if DEBUG:
-                        sys.stdout.write("[WARNING] Client %s:%i doesn't make any sense. "
-                                         "Disconnecting.\n" % self.s_addr)
-                    return
+            except HTTPRequestError as e:
                 if DEBUG:
-                    sys.stdout.write("[  INFO ] Client %s:%i requested %s\n" % (
-                        self.s_addr[0], self.s_addr[1], request['query']))
+                    sys.stdout.write("[WARNING] Client %s:%i doesn't make any sense (%s). "
+                                     "Disconnecting.\n" % (self.s_addr[0], self.s_addr[1], e))
+                self.__send_http_response({ 'status': e.status }, 'close')
+                return
+            if not request:
+                return
+            if DEBUG:
+                sys.stdout.write("[  INFO ] Client %s:%i requested %s\n" % (
+                    self.s_addr[0], self.s_addr[1], request['query']))
+            # An exception in a handler must not leave the connection behind.
+            try:
                 response = self.website.handle_http_request(request)
-                self.__send_http_response(response)
 
-            def run(self):
-                self.s.settimeout(5) # Operations should not take longer than 5 seconds.
+                # The response may have to wait for new messages.
+                if 'wait' in response:
+                    last_message_id, timeout, make_response, room = response['wait']
+                    room.wait_for_messages(last_message_id, timeout)
+                    response = make_response()
+            except Exception:
+                traceback.print_exc()
+                response = { 'status': (500, 'Internal Server Error') }
+
+            # An event stream lasts until the client disconnects.
+            if 'stream' in response:
+                self.__send_http_response(response, 'close')
+                self.__send_events(*response['stream'])
+                return
+
+            # So does a WebSocket, but the client keeps sending as well.
+            if 'websocket' in response:
+                self.__send_http_response(response, 'Upgrade')
+                self.__websocket(*response['websocket'])
+                return
+
+            keep_alive = requests < self.max_requests and http_keep_alive(request)
+            self.__send_http_response(response, http_connection_header(request, keep_alive))
+            if not keep_alive:
+                return
+
+    def __send_events(self, last_message_id, next_event, room):
+        while True:
+            if room.wait_for_messages(last_message_id, EVENT_STREAM_HEARTBEAT):
+                event, last_message_id = next_event(last_message_id)
+                if event is None:
+                    return # The room has been closed.
+            else:
+                event = HTTP_EVENT_STREAM_HEARTBEAT
+            self.s.sendall(event)
+
+    # The frames from the client are received here, and the messages are
+    # sent by another thread; both of them may send, but one at a time.
+    def __websocket(self, last_message_id, next_frame, receive, room):
+        parser = WebSocketParser(self.parser.buffer)
+        send_lock = Lock()
+        closed = Event()
 
+        def send(frame):
+            with send_lock:
+                self.s.sendall(frame)
+
+        # A client which does not receive the frames cannot stop the sender
+        # for long, and a silent one is kept alive with pings.
+        self.s.settimeout(WEBSOCKET_SEND_TIMEOUT)
+        sender = Thread(target=self.__send_frames,
+                        args=(last_message_id, next_frame, room, send, closed))
+        sender.daemon = True
+        sender.start()
+
+        try:
+            while True:
                 try:
-                    self.__handle_client()
-                except socket.tiemout as e:
-                    if DEBUG:
-                        sys.stdout.write("[WARNING] Client %s:%i timed out. "
-                                         "Disconnecting.\n" % self.s_addr)
+                    frame = parser.next_frame()
+                except WebSocketError as e:
+                    send(websocket_close_frame(e.code))
+                    return
+                if frame is None:
+                    try:
+                        data = self.s.recv(self.RECV_SIZE)
+                    except socket.timeout:
+                        if closed.is_set():
+                            return
+                        continue
+                    if not data:
+                        return
+                    parser.feed(data)
+                    continue
+
+                opcode, payload = frame
+                if opcode == WEBSOCKET_TEXT:
+                    code = receive(payload)
+                    if code is not None:
+                        send(websocket_close_frame(code))
+                        return
+                elif opcode == WEBSOCKET_PING:
+                    send(websocket_frame(WEBSOCKET_PONG, payload))
+                elif opcode == WEBSOCKET_CLOSE:
+                    send(websocket_close_reply(payload))
+                    return
+                elif opcode != WEBSOCKET_PONG:
+                    send(websocket_close_frame(WEBSOCKET_UNSUPPORTED))
+                    return
+        finally:
+            closed.set()
+
+    def __send_frames(self, last_message_id, next_frame, room, send, closed):
+        try:
+            while not closed.is_set():
+                if room.wait_for_messages(last_message_id, EVENT_STREAM_HEARTBEAT):
+                    frame, last_message_id = next_frame(last_message_id)
+                    if frame is None:
+                        # The room has been closed.
+                        frame = websocket_close_frame(WEBSOCKET_GOING_AWAY)
+                        closed.set()
+                else:
+                    frame = WEBSOCKET_HEARTBEAT
+                send(frame)
+        except OSError:
+            # Too slow or already gone; the receiving side will notice.
+            closed.set()
+        if closed.is_set():
+            try:
+                self.s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        # Operations should not take longer than 5 seconds (by default),
+        # this is also how long an idle connection waits for the next request.
+        # The connection has been counted as open when it was accepted,
+        # and whatever happens, it is closed and counted as such.
+        try:
+            self.s.settimeout(self.idle_timeout)
+            self.__handle_client()
+        except socket.timeout as e:
+            if DEBUG:
+                sys.stdout.write("[WARNING] Client %s:%i timed out. "
+                                 "Disconnecting.\n" % self.s_addr)
+        except OSError as e:
+            if DEBUG:
+                sys.stdout.write("[WARNING] Client %s:%i disconnected (%s).\n" % (
+                    self.s_addr[0], self.s_addr[1], e))
+        finally:
+            try:
                 self.s.shutdown(socket.SHUT_RDWR)
-                self.s.close()
-
-        # Not a very quick but convenient function that receives data until a specific string (which is also returned) is encountered.
-        def recv_until(sock, txt):
-            txt = list(txt)
-            if sys.version_info.major == 3:
-                txt = [bytes(ch, 'ascii') for ch in txt]
-            
-            full_data = []
-            last_n_bytes = [None] * len(txt)
-
-            # Until the last N bytes are equal to the searched value, read the data.
-
-            while last_n_bytes != txt:
-                next_byte = sock.recv(1)
-                if not next_byte:
-                    return '' # The connection has been broken.
-                full_data.append(next_byte)
-                last_n_bytes.pop(0)
-                last_n_bytes.append(next_byte)
-
-            full_data = b''.join(full_data)
-            if sys.version_info.major == 3:
-                return str(full_data, 'utf-8')
-            return full_data
-
-        # Auxiliary function that receives an exact number of bytes.
-        def recv_all(sock, n):
-            data = []
-
-            while len(data) < n:
-                data_latest = sock.recv(n - len(data))
-                if not data_latest:
+            except OSError:
+                pass # The other side has already disconnected.
+            self.s.close()
+            self.website.metrics.connection_closed()
+
+# Construct the HTTP response from the dictionary returned by the website.
+def make_http_response(response, connection=None):
+    lines = []
+    lines.append('HTTP/1.1 %u %s' % response['status'])
+
+    # Set the basic fields.
+    # A stream has no length, it lasts until the connection is closed,
+    # and neither has a connection switched to the WebSocket protocol.
+    lines.append('Server: example')
+    if connection is not None:
+        lines.append('Connection: %s' % connection)
+    if 'stream' in response or 'websocket' in response:
+        pass
+    elif 'file' in response:
+        lines.append('Content-Length: %u' % response['file'][1])
+    elif 'data' in response:
+        lines.append('Content-Length: %u' % len(response['data']))
+    else:
+        lines.append('Content-Length: 0')
+
+    # Rewrite the headlines.
+    if 'headers' in response:
+        for header in response['headers']:
+            lines.append('%s: %s' % header)
+
+    lines.append('')
+
+    # Rewrite the data (an empty line ends the headers even without it).
+    lines.append(response.get('data', ''))
+
+    # Convert the response to bytes.
+    if sys.version_info.major == 3:
+        converted_lines = []
+        for line in lines:
+            if type(line) is bytes:
+                converted_lines.append(line)
+            else:
+                converted_lines.append(bytes(line, 'utf-8'))
+        lines = converted_lines
+        return b'\r\n'.join(lines)
+    return '\r\n'.join(lines)
+
+# Analysis of the head of an HTTP request (the request line and the headers)
+# received as a whole. Returns the method, the path, the version and the
+# headers, or None if the request makes no sense.
+def parse_http_head(head):
+    lines = head.split('\r\n')
+
+    query_tokens = lines.pop(0).split(' ')
+    if len(query_tokens) != 3:
+        return None
+    method, query, version = query_tokens
+
+    headers = {}
+    for line in lines:
+        tokens = line.split(':', 1)
+        if len(tokens) != 2:
+            continue
+        headers[tokens[0].strip().lower()] = tokens[1].strip()
+
+    return method, query, version, headers
+
+# Interim response to a client waiting for permission to send the data
+# (Expect: 100-continue).
+HTTP_CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+# A comment line, ignored by the browser, sent over an idle event stream.
+HTTP_EVENT_STREAM_HEARTBEAT = b':\n\n'
+
+# The answer to a connection above the limit, sent before its request is read.
+HTTP_SERVICE_UNAVAILABLE = (b'HTTP/1.1 503 Service Unavailable\r\nServer: example\r\n'
+                            b'Connection: close\r\nRetry-After: %u\r\n'
+                            b'Content-Length: 0\r\n\r\n' % RETRY_AFTER)
+
+# Connections turned away because there are too many of them. Each gets
+# the answer at once (it fits into the empty socket buffer), without a thread
+# or buffers for it. The socket is closed only a moment later: closing it
+# before the request arrives would reset the connection, and the client
+# could lose the answer.
+class ConnectionRefuser():
+    LINGER = 1 # Seconds.
+    LIMIT = 1024 # Sockets waiting to be closed at most.
+
+    def __init__(self):
+        self.sockets = deque() # (time to close, socket)
+
+    def refuse(self, sock):
+        try:
+            sock.setblocking(0)
+            sock.send(HTTP_SERVICE_UNAVAILABLE)
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            sock.close()
+            return
+        now = time.monotonic()
+        self.sockets.append((now + self.LINGER, sock))
+        if len(self.sockets) > self.LIMIT:
+            self.sockets.popleft()[1].close()
+        self.close_expired(now)
+
+    def close_expired(self, now):
+        while self.sockets and self.sockets[0][0] <= now:
+            self.sockets.popleft()[1].close()
+
+    def close(self):
+        while self.sockets:
+            self.sockets.popleft()[1].close()
+
+# A request that cannot be handled, with the status of the error response.
+class HTTPRequestError(Exception):
+    def __init__(self, status):
+        super(HTTPRequestError, self).__init__('%u %s' % status)
+        self.status = status
+
+# Incremental HTTP request parser.
+# The data received from a connection is fed in pieces of any size and
+# collected in a single buffer; next_request() returns the first complete
+# request from it, or None if more data is needed. The end of the head is
+# found with one search (continued where the previous one ended), the body
+# is read according to Content-Length or decoded from chunks
+# (Transfer-Encoding: chunked). Requests sent one after another without
+# waiting for the responses (pipelining) are returned one by one.
+# Requests breaking the rules or the limits raise HTTPRequestError,
+# after which the connection should be closed.
+class HTTPRequestParser():
+    __slots__ = ("buffer", "head_limit", "body_limit", "search_start", "request",
+                 "body", "body_length", "chunk_size", "expect_continue")
+
+    HEAD_LIMIT = 64 * 1024
+    BODY_LIMIT = 1024 * 1024
+    CHUNK_LINE_LIMIT = 1024
+
+    # Only ASCII digits: int() takes also other ones, "0x", "_" and spaces.
+    DECIMAL = re.compile(r'[0-9]+')
+    HEXADECIMAL = re.compile(rb'[0-9A-Fa-f]+')
+
+    def __init__(self, head_limit=HEAD_LIMIT, body_limit=BODY_LIMIT):
+        self.buffer = bytearray()
+        self.head_limit = head_limit
+        self.body_limit = body_limit
+
+        self.search_start = 0 # Where to look for the end of the head.
+        self.request = None # Parsed head of the request whose body is awaited.
+        self.body = None # Decoded chunks, if the body is chunked.
+        self.body_length = 0 # Otherwise, the length of the body.
+        self.chunk_size = None # Size of the current chunk, if known.
+
+        # Set when the client waits for HTTP_CONTINUE before sending the body.
+        self.expect_continue = False
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        if self.request is None and not self.__parse_head():
+            return None
+
+        if self.body is not None:
+            if not self.__parse_chunks():
+                return None
+            data = bytes(self.body)
+        else:
+            if len(self.buffer) < self.body_length:
+                return None
+            data = bytes(self.buffer[:self.body_length])
+            del self.buffer[:self.body_length]
+
+        request = self.request
+        self.request = None
+        self.body = None
+        self.expect_continue = False
+
+        # Only POST requests are expected to carry the data.
+        if data or request["method"] == 'POST':
+            try:
+                request["data"] = data.decode('utf-8')
+            except UnicodeDecodeError:
+                raise HTTPRequestError((400, 'Bad Request'))
+        return request
+
+    def __parse_head(self):
+        head_end = self.buffer.find(b'\r\n\r\n', self.search_start)
+        if head_end < 0:
+            if len(self.buffer) > self.head_limit:
+                raise HTTPRequestError((431, 'Request Header Fields Too Large'))
+            # The end may start in the last 3 bytes received.
+            self.search_start = max(0, len(self.buffer) - 3)
+            return False
+        if head_end > self.head_limit:
+            raise HTTPRequestError((431, 'Request Header Fields Too Large'))
+
+        try:
+            head = parse_http_head(self.buffer[:head_end].decode('utf-8'))
+        except UnicodeDecodeError:
+            head = None
+        if head is None:
+            raise HTTPRequestError((400, 'Bad Request'))
+        del self.buffer[:head_end + 4]
+        self.search_start = 0
+
+        method, query, version, headers = head
+        self.request = {
+            "method": method,
+            "query": query,
+            "version": version,
+            "headers": headers,
+            "data": None
+            }
+
+        # A request with both lengths could be read differently by a proxy
+        # in front of the server, so it is better not to guess.
+        transfer_encoding = headers.get('transfer-encoding')
+        content_length = headers.get('content-length')
+        if transfer_encoding is not None:
+            if content_length is not None:
+                raise HTTPRequestError((400, 'Bad Request'))
+            if transfer_encoding.lower() != 'chunked':
+                raise HTTPRequestError((501, 'Not Implemented'))
+            self.body = bytearray()
+            self.chunk_size = None
+        elif content_length is not None:
+            if not self.DECIMAL.fullmatch(content_length):
+                raise HTTPRequestError((400, 'Bad Request'))
+            # Too many digits for the limit (int() would not even take
+            # thousands of them, leading zeros included).
+            content_length = content_length.lstrip('0') or '0'
+            if len(content_length) > len(str(self.body_limit)):
+                raise HTTPRequestError((413, 'Payload Too Large'))
+            self.body_length = int(content_length)
+            if self.body_length > self.body_limit:
+                raise HTTPRequestError((413, 'Payload Too Large'))
+        else:
+            self.body_length = 0
+
+        if headers.get('expect', '').lower() == '100-continue':
+            self.expect_continue = True
+        return True
+
+    # Move the complete chunks from the buffer to the body.
+    # Returns True after the last (empty) chunk.
+    def __parse_chunks(self):
+        while True:
+            if self.chunk_size is None:
+                # Size in hex, possibly followed by extensions after ";".
+                line_end = self.buffer.find(b'\r\n')
+                if line_end < 0:
+                    if len(self.buffer) > self.CHUNK_LINE_LIMIT:
+                        raise HTTPRequestError((400, 'Bad Request'))
+                    return False
+                size = bytes(self.buffer[:line_end]).split(b';', 1)[0].strip()
+                if not self.HEXADECIMAL.fullmatch(size):
+                    raise HTTPRequestError((400, 'Bad Request'))
+                self.chunk_size = int(size, 16)
+                if len(self.body) + self.chunk_size > self.body_limit:
+                    raise HTTPRequestError((413, 'Payload Too Large'))
+                del self.buffer[:line_end + 2]
+
+            if self.chunk_size == 0:
+                # The last chunk may be followed by trailer fields, which are
+                # skipped, and then by an empty line.
+                if self.buffer.startswith(b'\r\n'):
+                    del self.buffer[:2]
+                    return True
+                trailer_end = self.buffer.find(b'\r\n\r\n')
+                if trailer_end < 0:
+                    if len(self.buffer) > self.head_limit:
+                        raise HTTPRequestError((431, 'Request Header Fields Too Large'))
+                    return False
+                del self.buffer[:trailer_end + 4]
+                return True
+
+            if len(self.buffer) < self.chunk_size + 2:
+                return False
+            if self.buffer[self.chunk_size:self.chunk_size + 2] != b'\r\n':
+                raise HTTPRequestError((400, 'Bad Request'))
+            self.body += self.buffer[:self.chunk_size]
+            del self.buffer[:self.chunk_size + 2]
+            self.chunk_size = None
+
+# Choose the best of the available encodings ('' means none) that the client
+# accepts, according to its Accept-Encoding header.
+def http_choose_encoding(accept_encoding, available):
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+
+    for encoding in ('br', 'gzip', 'deflate'):
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return ''
+
+# Compress data for the Content-Encoding 'gzip' or 'deflate' (which is the
+# zlib format, despite its name).
+def http_compress(data, encoding, level):
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+# Whether the copy the client already has (described by If-None-Match or,
+# if there is no such header, If-Modified-Since) is still up to date.
+def http_not_modified(headers, etag, mtime):
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return False
+        return mtime <= since
+
+    return False
+
+# Whether the client wants to send more requests over the same connection.
+# HTTP/1.1 connections stay open unless the client says otherwise,
+# HTTP/1.0 ones only when the client asks for it.
+def http_keep_alive(request):
+    tokens = [t.strip().lower() for t in request['headers'].get('connection', '').split(',')]
+    if request['version'] == 'HTTP/1.1':
+        return 'close' not in tokens
+    return 'keep-alive' in tokens
+
+# The Connection header telling the client what happens to the connection
+# after the response, or None when the client already expects it.
+def http_connection_header(request, keep_alive):
+    if not keep_alive:
+        return 'close'
+    if request['version'] != 'HTTP/1.1':
+        return 'keep-alive'
+    return None
+
+# WebSocket (RFC 6455) frame types and the status codes of closing.
+WEBSOCKET_CONTINUATION = 0x0
+WEBSOCKET_TEXT = 0x1
+WEBSOCKET_BINARY = 0x2
+WEBSOCKET_CLOSE = 0x8
+WEBSOCKET_PING = 0x9
+WEBSOCKET_PONG = 0xA
+
+WEBSOCKET_NORMAL = 1000
+WEBSOCKET_GOING_AWAY = 1001
+WEBSOCKET_PROTOCOL_ERROR = 1002
+WEBSOCKET_UNSUPPORTED = 1003
+WEBSOCKET_INVALID_DATA = 1007
+WEBSOCKET_TOO_BIG = 1009
+WEBSOCKET_INTERNAL_ERROR = 1011
+WEBSOCKET_TRY_AGAIN_LATER = 1013
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# The value of Sec-WebSocket-Accept proving that the server understood
+# the handshake.
+def websocket_accept(key):
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+# A complete frame from the server (which does not mask its frames).
+def websocket_frame(opcode, payload=b''):
+    length = len(payload)
+    if length < 126:
+        head = pack('!BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        head = pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        head = pack('!BBQ', 0x80 | opcode, 127, length)
+    return head + payload
+
+def websocket_close_frame(code):
+    return websocket_frame(WEBSOCKET_CLOSE, pack('!H', code))
+
+# The answer to the client closing the connection repeats its status code.
+def websocket_close_reply(payload):
+    if len(payload) >= 2:
+        return websocket_frame(WEBSOCKET_CLOSE, payload[:2])
+    return websocket_frame(WEBSOCKET_CLOSE)
+
+# Sent to a silent client, whose browser answers it by itself.
+WEBSOCKET_HEARTBEAT = websocket_frame(WEBSOCKET_PING)
+
+# A frame that cannot be accepted, with the status code of closing.
+class WebSocketError(Exception):
+    def __init__(self, code):
+        super(WebSocketError, self).__init__('WebSocket status %u' % code)
+        self.code = code
+
+# Incremental parser of the frames sent by a WebSocket client, fed like
+# HTTPRequestParser (and starting with whatever it has left in its buffer).
+# next_frame() returns (opcode, payload) of the first complete message or
+# control frame, or None if more data is needed; a message split into
+# fragments is returned whole.
+class WebSocketParser():
+    __slots__ = ("buffer", "message_limit", "fragments", "fragments_opcode",
+                 "fragments_size")
+
+    MESSAGE_LIMIT = 64 * 1024
+
+    def __init__(self, buffer=b'', message_limit=MESSAGE_LIMIT):
+        self.buffer = bytearray(buffer)
+        self.message_limit = message_limit
+        self.fragments = None
+        self.fragments_opcode = None
+        self.fragments_size = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_frame(self):
+        while True:
+            buf = self.buffer
+            if len(buf) < 2:
+                return None
+            b0, b1 = buf[0], buf[1]
+            fin = b0 & 0x80
+            opcode = b0 & 0x0F
+            length = b1 & 0x7F
+
+            # Frames from the client must be masked, and no extensions
+            # have been agreed on.
+            if b0 & 0x70 or not b1 & 0x80:
+                raise WebSocketError(WEBSOCKET_PROTOCOL_ERROR)
+            if opcode >= WEBSOCKET_CLOSE and (not fin or length > 125):
+                raise WebSocketError(WEBSOCKET_PROTOCOL_ERROR)
+
+            pos = 2
+            if length == 126:
+                if len(buf) < 4:
+                    return None
+                length = unpack_from('!H', buf, 2)[0]
+                pos = 4
+            elif length == 127:
+                if len(buf) < 10:
                     return None
-                data.append(data_latest)
+                length = unpack_from('!Q', buf, 2)[0]
+                pos = 10
+            if length + self.fragments_size > self.message_limit:
+                raise WebSocketError(WEBSOCKET_TOO_BIG)
+
+            end = pos + 4 + length
+            if len(buf) < end:
+                return None
+            payload = websocket_unmask(buf[pos:pos + 4], buf[pos + 4:end])
+            del buf[:end]
+
+            if opcode >= WEBSOCKET_CLOSE:
+                return opcode, payload
+
+            if opcode == WEBSOCKET_CONTINUATION:
+                if self.fragments is None:
+                    raise WebSocketError(WEBSOCKET_PROTOCOL_ERROR)
+            elif self.fragments is not None:
+                raise WebSocketError(WEBSOCKET_PROTOCOL_ERROR)
+            elif fin:
+                return opcode, payload
+            else:
+                self.fragments = []
+                self.fragments_opcode = opcode
+
+            self.fragments.append(payload)
+            self.fragments_size += length
+            if fin:
+                opcode, payload = self.fragments_opcode, b''.join(self.fragments)
+                self.fragments = None
+                self.fragments_size = 0
+                return opcode, payload
+
+# XOR the payload with the 4-byte mask, all at once as big integers.
+def websocket_unmask(mask, payload):
+    length = len(payload)
+    key = bytes(mask) * (length // 4 + 1)
+    return (int.from_bytes(payload, 'little') ^
+            int.from_bytes(key[:length], 'little')).to_bytes(length, 'little')
+
+# State of a single connection handled by EventLoopServer.
+class ClientConnection():
+    __slots__ = ("s", "s_addr", "parser", "out_buffer", "out_offset", "out_file", "requests",
+                 "closing", "writing", "waiting", "stream", "websocket", "room", "frames",
+                 "frames_offset", "frames_bytes", "last_active", "closed")
+
+    def __init__(self, sock, sock_addr):
+        self.s = sock
+        self.s_addr = sock_addr
+        self.parser = HTTPRequestParser()
+        self.out_buffer = bytearray()
+        self.out_offset = 0
+        self.out_file = None # [file, offset, bytes left] sent after out_buffer.
+        self.requests = 0 # Number of requests handled so far.
+        self.closing = False # Close after sending what is in out_buffer.
+        self.writing = False # Waiting for the socket to be ready for writing.
+
+        # (request, last_message_id, deadline, make_response) of a request
+        # waiting for new messages.
+        self.waiting = None
+
+        # [last_message_id, next_event] of an event stream.
+        self.stream = None
+
+        # [last_message_id, next_frame, receive] of a WebSocket, and the
+        # queue of frames sent after out_buffer. The frames are shared by
+        # all the clients, so they are queued rather than copied.
+        self.websocket = None
+
+        # The chat room whose messages the connection is waiting for.
+        self.room = None
+        self.frames = None
+        self.frames_offset = 0
+        self.frames_bytes = 0
+
+        self.last_active = time.monotonic()
+        self.closed = False
+
+# An HTTP server handling all the connections in a single thread.
+# Instead of a thread blocked on every socket, the sockets are non-blocking and
+# the operating system (epoll, kqueue, ... chosen by the selectors module)
+# tells which of them are ready to be read or written. A waiting connection
+# costs only its socket and a few small objects, so even tens of thousands of
+# idle clients are not a problem.
+# The requests are handled by the same website object as in ClientThread,
+# which means that a slow handler delays all the clients.
+class EventLoopServer():
+    RECV_SIZE = 64 * 1024
+    SENDFILE_SIZE = 1024 * 1024 # Bytes sent from a file in one call.
+
+    # An event stream or WebSocket client that does not receive this much is
+    # disconnected, instead of collecting all the messages for it.
+    STREAM_BUFFER_LIMIT = 1024 * 1024
+
+    def __init__(self, website, sock, the_end, idle_timeout=5, max_requests=100,
+                 max_connections=MAX_CONNECTIONS_EVENT_LOOP):
+        self.website = website
+        self.s = sock
+        self.the_end = the_end
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.max_connections = max_connections
+        self.refuser = ConnectionRefuser()
+
+        self.selector = selectors.DefaultSelector()
+
+        # The connections by their file descriptors, ordered from the one that
+        # has been waiting the longest, so the idle ones are found quickly.
+        self.connections = OrderedDict()
+
+        # Connections waiting for new messages (including event streams and
+        # WebSockets) by their rooms, and a heap of the time limits of the
+        # waiting requests as (deadline, sequence number, connection).
+        self.room_clients = {}
+        self.deadlines = []
+        self.deadlines_seq = itertools.count()
+        self.streams = set()
+        self.websockets = set()
+        self.rooms_changed = set()
+        self.last_heartbeat = time.monotonic()
+
+    def run(self):
+        self.s.setblocking(0)
+        self.selector.register(self.s, selectors.EVENT_READ)
+        self.website.add_messages_listener(self.__on_messages_added)
+
+        # Messages added by other worker processes.
+        wakeup_fd = self.website.messages_wakeup_fd()
+        if wakeup_fd is not None:
+            self.selector.register(wakeup_fd, selectors.EVENT_READ, self.website)
+
+        try:
+            while not self.the_end.is_set():
+                # Wake up at least every second to check the end condition and
+                # close the connections that have been idle for too long, or
+                # earlier if a client has been waiting for messages long enough.
+                timeout = 1
+                if self.deadlines:
+                    timeout = max(0, min(timeout, self.deadlines[0][0] - time.monotonic()))
+                for key, events in self.selector.select(timeout):
+                    if key.data is None:
+                        self.__accept()
+                        continue
+                    if key.data is self.website:
+                        self.website.check_messages()
+                        continue
+                    c = key.data
+                    if events & selectors.EVENT_READ:
+                        self.__read(c)
+                    if events & selectors.EVENT_WRITE and not c.closed:
+                        self.__write(c)
+
+                # Messages added by the handlers are delivered here rather
+                # than in the middle of another handler.
+                while self.rooms_changed:
+                    self.__deliver_messages()
+                self.__check_timers()
+        finally:
+            self.website.remove_messages_listener(self.__on_messages_added)
+            for c in list(self.connections.values()):
+                self.__close(c)
+            self.refuser.close()
+            self.selector.close()
+
+    # The handlers are called in the same thread, so is the listener.
+    def __on_messages_added(self, room):
+        self.rooms_changed.add(room)
+
+    # Only the clients of the rooms with new messages are checked.
+    def __deliver_messages(self):
+        rooms, self.rooms_changed = self.rooms_changed, set()
+        for room in rooms:
+            for c in list(self.room_clients.get(room, ())):
+                if c.waiting is not None:
+                    if room.wait_for_messages(c.waiting[1], 0):
+                        self.__resume(c, c.waiting[3]())
+                elif c.stream is not None:
+                    if not room.wait_for_messages(c.stream[0], 0):
+                        continue
+                    event, c.stream[0] = c.stream[1](c.stream[0])
+                    if event is None:
+                        self.__close(c) # The room has been closed.
+                    else:
+                        self.__send_stream(c, event)
+                elif c.websocket is not None:
+                    if not room.wait_for_messages(c.websocket[0], 0):
+                        continue
+                    frame, c.websocket[0] = c.websocket[1](c.websocket[0])
+                    if frame is None:
+                        self.__detach(c) # The room has been closed.
+                        self.__close_websocket(c, websocket_close_frame(WEBSOCKET_GOING_AWAY))
+                    else:
+                        self.__send_frame(c, frame)
+
+    def __attach(self, c, room):
+        c.room = room
+        self.room_clients.setdefault(room, set()).add(c)
+
+    def __detach(self, c):
+        clients = self.room_clients.get(c.room)
+        if clients is not None:
+            clients.discard(c)
+            if not clients:
+                del self.room_clients[c.room]
+        c.room = None
+
+    def __check_timers(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, c = heapq.heappop(self.deadlines)
+            # The client may have got its messages in the meantime.
+            if c.waiting is not None and c.waiting[2] == deadline:
+                self.__resume(c, c.waiting[3]())
+
+        if now - self.last_heartbeat >= EVENT_STREAM_HEARTBEAT:
+            self.last_heartbeat = now
+            for c in list(self.streams):
+                self.__send_stream(c, HTTP_EVENT_STREAM_HEARTBEAT)
+            for c in list(self.websockets):
+                self.__send_frame(c, WEBSOCKET_HEARTBEAT)
+
+        self.__close_idle(now)
+        self.refuser.close_expired(now)
+
+    def __accept(self):
+        # Pick up all the waiting calls, there may be many of them at once.
+        while True:
+            try:
+                s, s_addr = self.s.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # E.g. the limit of open files has been reached.
+                if DEBUG:
+                    sys.stdout.write("[WARNING] Failed to accept a connection: %s\n" % e)
+                return
+
+            if len(self.connections) >= self.max_connections:
+                self.refuser.refuse(s)
+                self.website.metrics.connection_rejected()
+                continue
+
+            if DEBUG:
+                sys.stdout.write("[  INFO ] New connection: %s:%i\n" % s_addr)
+            s.setblocking(0)
+            c = ClientConnection(s, s_addr)
+            self.connections[s.fileno()] = c
+            self.website.metrics.connection_opened()
+            self.selector.register(s, selectors.EVENT_READ, c)
+
+    def __touch(self, c):
+        c.last_active = time.monotonic()
+        self.connections.move_to_end(c.s.fileno())
+
+    def __read(self, c):
+        try:
+            data = c.s.recv(self.RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.__close(c)
+            return
+        if not data:
+            self.__close(c) # The connection has been broken.
+            return
+
+        c.parser.feed(data)
+        self.__touch(c)
+
+        if c.websocket is not None:
+            self.__read_frames(c)
+            return
+
+        # A client waiting for messages is not expected to send much.
+        if c.waiting is not None or c.stream is not None:
+            if len(c.parser.buffer) > c.parser.head_limit:
+                self.__close(c)
+            return
+        self.__handle_requests(c)
+
+    # Handle all the complete requests in the buffer. A client may send many
+    # of them without waiting for the responses (pipelining); the responses
+    # are sent in the same order, all together.
+    def __handle_requests(self, c):
+        while (not c.closing and c.waiting is None and c.stream is None and
+               c.websocket is None and c.out_file is None):
+            response = self.__handle_request(c)
+            if response is None:
+                break
+            c.out_buffer += response
+        if c.out_buffer:
+            self.__write(c)
+
+    # Handle the first request in the buffer. Returns the bytes of the
+    # response (empty if it has to wait for new messages), or None if the
+    # request has not arrived in full yet.
+    def __handle_request(self, c):
+        try:
+            request = c.parser.next_request()
+        except HTTPRequestError as e:
+            if DEBUG:
+                sys.stdout.write("[WARNING] Client %s:%i doesn't make any sense (%s). "
+                                 "Disconnecting.\n" % (c.s_addr[0], c.s_addr[1], e))
+            # The rest of the data cannot be trusted, so the connection is
+            # closed after the error response.
+            c.closing = True
+            return make_http_response({ 'status': e.status }, 'close')
+        except Exception:
+            # A mistake in the parser must not stop the whole server either.
+            traceback.print_exc()
+            c.closing = True
+            return make_http_response({ 'status': (400, 'Bad Request') }, 'close')
+        if request is None:
+            if c.parser.expect_continue:
+                c.parser.expect_continue = False
+                return HTTP_CONTINUE
+            return None
+
+        request["client_ip"] = c.s_addr[0]
+        request["client_port"] = c.s_addr[1]
+
+        if DEBUG:
+            sys.stdout.write("[  INFO ] Client %s:%i requested %s\n" % (
+                c.s_addr[0], c.s_addr[1], request['query']))
+
+        # An exception in a handler must not stop the whole server.
+        try:
+            response = self.website.handle_http_request(request)
+        except Exception:
+            traceback.print_exc()
+            response = { 'status': (500, 'Internal Server Error') }
+
+        # Nothing new yet - the response is sent when new messages arrive
+        # or the time runs out, and until then the connection just waits.
+        if 'wait' in response:
+            last_message_id, timeout, make_response, room = response['wait']
+            deadline = time.monotonic() + timeout
+            c.waiting = (request, last_message_id, deadline, make_response)
+            self.__attach(c, room)
+            heapq.heappush(self.deadlines, (deadline, next(self.deadlines_seq), c))
+            return b''
 
-            data = b''.join(data)
-            if sys.version_info.major == 3:
-                return str(data, 'utf-8')
+        return self.__finish_request(c, request, response)
+
+    def __finish_request(self, c, request, response):
+        c.requests += 1
+
+        # An event stream lasts until the client disconnects; the messages
+        # the client does not have yet are sent right after the headers.
+        if 'stream' in response:
+            last_message_id, next_event, room = response['stream']
+            c.stream = [last_message_id, next_event]
+            self.streams.add(c)
+            self.__attach(c, room)
+            data = make_http_response(response, 'close')
+            if room.wait_for_messages(last_message_id, 0):
+                event, c.stream[0] = next_event(last_message_id)
+                if event is not None:
+                    data += event
             return data
 
-        # Auxiliary function that receives data from the socket until disconnected.
-        def recv_remaining(sock):
-            data = []
-            while True:
-                data_latest = sock.recv(4096)
-                if not data_latest:
-                    data = b''.join(data)
-                    if sys.version_info.major == 3:
-                        return str(data, 'utf-8')
-                    return data
-                data.append(data_latest)
+        # The same with a WebSocket; from now on, the data from the client
+        # are frames.
+        if 'websocket' in response:
+            last_message_id, next_frame, receive, room = response['websocket']
+            c.websocket = [last_message_id, next_frame, receive]
+            c.parser = WebSocketParser(c.parser.buffer)
+            c.frames = deque()
+            self.websockets.add(c)
+            self.__attach(c, room)
+            data = make_http_response(response, 'Upgrade')
+            if room.wait_for_messages(last_message_id, 0):
+                frame, c.websocket[0] = next_frame(last_message_id)
+                if frame is not None:
+                    data += frame
+            return data
 
-def main():
-    the_end = Event()
-    website = SimpleChatWWW(the_end)
+        # The contents of a file are sent after the headers, and only then the
+        # responses to the next requests.
+        if 'file' in response:
+            f, size = response['file']
+            c.out_file = [f, 0, size]
+
+        keep_alive = c.requests < self.max_requests and http_keep_alive(request)
+        c.closing = not keep_alive
+        return make_http_response(response, http_connection_header(request, keep_alive))
+
+    # Send the response to a request that has been waiting for messages and
+    # carry on with the requests that came after it.
+    def __resume(self, c, response):
+        request = c.waiting[0]
+        c.waiting = None
+        self.__detach(c)
+        c.out_buffer += self.__finish_request(c, request, response)
+        self.__handle_requests(c)
+
+    def __send_stream(self, c, data):
+        if len(c.out_buffer) - c.out_offset > self.STREAM_BUFFER_LIMIT:
+            if DEBUG:
+                sys.stdout.write("[WARNING] Client %s:%i does not keep up with the events. "
+                                 "Disconnecting.\n" % c.s_addr)
+            self.__close(c)
+            return
+        c.out_buffer += data
+        self.__write(c)
+
+    def __read_frames(self, c):
+        while not c.closing:
+            try:
+                frame = c.parser.next_frame()
+            except WebSocketError as e:
+                if DEBUG:
+                    sys.stdout.write("[WARNING] Client %s:%i doesn't make any sense (%s). "
+                                     "Disconnecting.\n" % (c.s_addr[0], c.s_addr[1], e))
+                self.__close_websocket(c, websocket_close_frame(e.code))
+                return
+            if frame is None:
+                return
+
+            opcode, payload = frame
+            if opcode == WEBSOCKET_TEXT:
+                # As with the requests, an exception must not stop the server.
+                try:
+                    code = c.websocket[2](payload)
+                except Exception:
+                    traceback.print_exc()
+                    code = WEBSOCKET_INTERNAL_ERROR
+                if code is not None:
+                    self.__close_websocket(c, websocket_close_frame(code))
+            elif opcode == WEBSOCKET_PING:
+                self.__send_frame(c, websocket_frame(WEBSOCKET_PONG, payload))
+            elif opcode == WEBSOCKET_CLOSE:
+                self.__close_websocket(c, websocket_close_reply(payload))
+            elif opcode != WEBSOCKET_PONG:
+                self.__close_websocket(c, websocket_close_frame(WEBSOCKET_UNSUPPORTED))
+
+    def __send_frame(self, c, frame):
+        if c.closing or c.closed:
+            return # Nothing may follow the closing frame.
+        if c.frames_bytes > self.STREAM_BUFFER_LIMIT:
+            if DEBUG:
+                sys.stdout.write("[WARNING] Client %s:%i does not keep up with the messages. "
+                                 "Disconnecting.\n" % c.s_addr)
+            self.__close(c)
+            return
+        c.frames.append(frame)
+        c.frames_bytes += len(frame)
+        self.__write(c)
+
+    # The connection is closed once the closing frame has been sent.
+    def __close_websocket(self, c, frame):
+        self.__send_frame(c, frame)
+        c.closing = True
+        if not c.closed:
+            self.__write(c)
+
+    def __write(self, c):
+        if c.out_offset < len(c.out_buffer):
+            try:
+                sent = c.s.send(memoryview(c.out_buffer)[c.out_offset:])
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.__close(c)
+                return
+            if sent:
+                c.out_offset += sent
+                self.__touch(c)
+
+            if c.out_offset < len(c.out_buffer):
+                self.__wait_for_write(c)
+                return
+
+            del c.out_buffer[:]
+            c.out_offset = 0
+
+        while c.frames:
+            frame = c.frames[0]
+            try:
+                sent = c.s.send(memoryview(frame)[c.frames_offset:])
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.__close(c)
+                return
+            if sent:
+                c.frames_offset += sent
+                self.__touch(c)
+            if c.frames_offset < len(frame):
+                self.__wait_for_write(c)
+                return
+            c.frames.popleft()
+            c.frames_bytes -= len(frame)
+            c.frames_offset = 0
+
+        if c.out_file is not None:
+            if not self.__write_file(c):
+                return
+            c.out_file[0].close()
+            c.out_file = None
+
+        if c.closing:
+            self.__close(c)
+            return
+
+        # Back to waiting for requests, some of which may have already arrived.
+        if c.writing:
+            c.writing = False
+            self.selector.modify(c.s, selectors.EVENT_READ, c)
+        if c.parser.buffer and c.stream is None and c.websocket is None:
+            self.__handle_requests(c)
+
+    # Send as much of the file as the socket takes. Returns True once the
+    # whole file has been sent.
+    def __write_file(self, c):
+        f, offset, left = c.out_file
+        while left:
+            try:
+                if hasattr(os, 'sendfile'):
+                    sent = os.sendfile(c.s.fileno(), f.fileno(), offset,
+                                       min(left, self.SENDFILE_SIZE))
+                else:
+                    f.seek(offset)
+                    sent = c.s.send(f.read(min(left, self.RECV_SIZE)))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.__close(c)
+                return False
+            if not sent:
+                # The file has become shorter, the promised length cannot be kept.
+                self.__close(c)
+                return False
+            offset += sent
+            left -= sent
+            self.__touch(c)
+
+        c.out_file[1] = offset
+        c.out_file[2] = left
+        if left:
+            self.__wait_for_write(c)
+            return False
+        return True
+
+    # The rest will be sent when the socket is ready for it. Until then,
+    # nothing more is read, so a client that sends requests but does
+    # not receive the responses cannot fill up the memory.
+    def __wait_for_write(self, c):
+        if not c.writing:
+            c.writing = True
+            self.selector.modify(c.s, selectors.EVENT_WRITE, c)
+
+    def __close_idle(self, now):
+        while self.connections:
+            c = next(iter(self.connections.values()))
+            if now - c.last_active < self.idle_timeout:
+                break
+            # Clients waiting for messages are not idle.
+            if c.waiting is not None or c.stream is not None or c.websocket is not None:
+                self.__touch(c)
+                continue
+            if DEBUG:
+                sys.stdout.write("[WARNING] Client %s:%i timed out. "
+                                 "Disconnecting.\n" % c.s_addr)
+            self.__close(c)
+
+    def __close(self, c):
+        if c.closed:
+            return
+        c.closed = True
+        del self.connections[c.s.fileno()]
+        self.website.metrics.connection_closed()
+        self.__detach(c)
+        self.streams.discard(c)
+        self.websockets.discard(c)
+        if c.out_file is not None:
+            c.out_file[0].close()
+        self.selector.unregister(c.s)
+        try:
+            c.s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # The other side has already disconnected.
+        c.s.close()
+
+# Every connection takes a file descriptor, and the usual soft limit
+# (1024 on GNU/Linux) would be reached long before the server is busy.
+def raise_open_files_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass # Not allowed, the current limit has to do.
+
+def serve(website, args, reuse_port=False):
+    the_end = website.the_end
 
     # Create a socket.
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -379,8 +2675,28 @@ def main():
     # again will fail.
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    # Listen on port 8888 on all interfaces.
-    s.bind(('0.0.0.0', 8888))
+    # Every worker process has its own socket bound to the same port,
+    # and the system spreads the new connections among them.
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    # Listen on port 8888 (by default) on all interfaces.
+    s.bind(('0.0.0.0', args.port))
+
+    if args.event_loop:
+        # A single thread picks up the calls as fast as they come, but when
+        # thousands of them come at once, they have to wait in a longer queue.
+        raise_open_files_limit()
+        s.listen(socket.SOMAXCONN)
+        EventLoopServer(website, s, the_end, args.idle_timeout, args.max_requests,
+                        args.max_connections or MAX_CONNECTIONS_EVENT_LOOP).run()
+        return
+
+    if website.messages_wakeup_fd() is not None:
+        watcher = Thread(target=website.watch_messages)
+        watcher.daemon = True
+        watcher.start()
+
     s.listen(32) # The number in the parameter indicates the maximum length
                  # of the queue of waiting connections. In this case, calls
                  # will be answered on a regular basis, so the queue may be small.
@@ -390,6 +2706,9 @@ def main():
     # every second. This allows the code to verify that the server has been called to exit.
     s.settimeout(1)
 
+    max_connections = args.max_connections or MAX_CONNECTIONS
+    refuser = ConnectionRefuser()
+
     while not the_end.is_set():
         # Pick up the call.
         try:
@@ -401,11 +2720,94 @@ def main():
                 sys.stdout.write("[  INFO ] New connection: %s:%i\n" % c_addr)
         except socket.timeout as e:
             continue # Go back to the beginning of the loop and check the end condition.
+        finally:
+            refuser.close_expired(time.monotonic())
 
-        # New connection.
+        # With too many threads, every client would wait; the ones above the
+        # limit are told to come back later instead.
+        if website.metrics.connections >= max_connections:
+            refuser.refuse(c)
+            website.metrics.connection_rejected()
+            continue
+
+        # New connection, counted at once so that a burst of them cannot
+        # get past the limit before their threads start.
         # Create a new thread to handle it (alternatively, you could use threadpool here).
-        ct = ClientThread(website, c, c_addr)
-        ct.start()
+        website.metrics.connection_opened()
+        ct = ClientThread(website, c, c_addr, args.idle_timeout, args.max_requests)
+        try:
+            ct.start()
+        except RuntimeError:
+            # No more threads can be started.
+            c.close()
+            website.metrics.connection_closed()
+
+def main():
+    parser = argparse.ArgumentParser(description="Simple HTTP chat server.")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--event-loop", action="store_true",
+                        help="handle all the connections in a single thread "
+                             "instead of a thread per connection")
+    parser.add_argument("--idle-timeout", type=float, default=5,
+                        help="seconds after which a silent client is disconnected")
+    parser.add_argument("--max-requests", type=int, default=100,
+                        help="maximum number of requests over one connection")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes sharing the port and the messages")
+    parser.add_argument("--log", metavar="DIR",
+                        help="keep the messages on the disk, in the given directory")
+    parser.add_argument("--compress-level", type=int, default=DYNAMIC_COMPRESS_LEVEL,
+                        choices=range(10), metavar="0-9",
+                        help="zlib level of the compressed messages (0 to send them as they are)")
+    parser.add_argument("--compress-min-size", type=int, default=DYNAMIC_COMPRESS_MIN_SIZE,
+                        metavar="BYTES", help="smallest response worth compressing")
+    parser.add_argument("--max-connections", type=int,
+                        help="connections kept open at most by every worker (default %u, "
+                             "or %u with --event-loop)" % (MAX_CONNECTIONS, MAX_CONNECTIONS_EVENT_LOOP))
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="do not limit the requests of the clients (e.g. when all of them "
+                             "come through one proxy)")
+    args = parser.parse_args()
+    if args.log and args.workers > 1:
+        parser.error("--log cannot be used with more than one worker")
+
+    the_end = Event()
+    website = SimpleChatWWW(the_end, args.workers, args.log,
+                            args.compress_level, args.compress_min_size,
+                            None if args.no_rate_limit else RATE_LIMITS)
+
+    if args.workers <= 1:
+        serve(website, args)
+        return
+
+    # The workers are started after the shared messages have been created.
+    children = []
+    for worker in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                website.default_room.messages.attach(worker)
+                serve(website, args, reuse_port=True)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    # Stopping the main process stops the workers as well.
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass # Already gone.
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        stop(None, None)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,361 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Load generator for httpchat.
+# A number of simulated browsers ask for new messages the way
+# httpchat_main.js does, while senders post messages at a given rate.
+# Each posted message carries the time it was sent, so the pollers can tell
+# how long it took to reach them. By default the server (httpchat.py) is
+# started in the background with the given options, and the results can
+# be saved as JSON to compare the server modes between runs.
+
+import argparse
+import gzip
+import http.client
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from threading import Event, Lock, Thread
+
+# Text of the messages posted by the benchmark: the sender, the number of
+# the message and the time it was sent (time.perf_counter()).
+BENCH_PREFIX = "bench "
+
+def bench_text(sender, seq):
+    return "%s%u:%u:%.9f" % (BENCH_PREFIX, sender, seq, time.perf_counter())
+
+def bench_sent_time(text):
+    if not text.startswith(BENCH_PREFIX):
+        return None
+    try:
+        return float(text.rsplit(":", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+# Value below which the given fraction of the (sorted) samples lies.
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+# Latencies and errors of one kind of requests, collected by many threads.
+class BenchStats():
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+        self.bytes = 0 # Received, as they came over the network.
+
+    def add(self, latency, status=200, size=0):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes += size
+            if status == 200:
+                self.latencies.append(latency)
+            else:
+                self.errors += 1
+
+    def error(self, kind):
+        with self.lock:
+            self.errors += 1
+            self.statuses[kind] = self.statuses.get(kind, 0) + 1
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        count = len(latencies) + self.errors
+        return {
+            "count": count,
+            "rate": count / elapsed if elapsed else 0.0,
+            "errors": self.errors,
+            "error_rate": float(self.errors) / count if count else 0.0,
+            "statuses": dict((str(k), v) for k, v in self.statuses.items()),
+            "bytes": self.bytes,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        }
+
+# A connection to the server which is opened again after an error, or for
+# every request if keep-alive is off. With `compress` the responses may come
+# compressed with gzip. Returns the status, the data and the number of bytes
+# of the data as they were received.
+class BenchConnection():
+    def __init__(self, host, port, keep_alive=True, timeout=60, compress=False):
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.compress = compress
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        headers = {} if self.keep_alive else { "Connection": "close" }
+        if self.compress:
+            headers["Accept-Encoding"] = "gzip"
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        if not self.keep_alive or response.will_close:
+            self.close()
+        size = len(data)
+        if response.getheader("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        return response.status, data, size
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+# A browser: one request for the messages after another, as httpchat_main.js
+# does without EventSource. With a timeout the server holds the request until
+# there is something new (long polling); without it the poller asks again
+# after `interval` seconds.
+def bench_poller(args, end, ready, stats, delivery):
+    conn = BenchConnection(args.host, args.port, not args.no_keep_alive, compress=args.gzip)
+    last_message_id = -1
+    first = True
+    while True:
+        now = time.perf_counter()
+        if not first and now >= end[0]:
+            break
+        timeout = 0
+        if args.poll_timeout and not first:
+            timeout = max(0.0, min(args.poll_timeout, end[0] - now))
+        body = json.dumps({ "last_message_id": last_message_id, "timeout": timeout })
+
+        t = time.perf_counter()
+        try:
+            status, data, size = conn.request("POST", "/messages", body)
+        except (OSError, http.client.HTTPException) as e:
+            stats.error(type(e).__name__)
+            time.sleep(0.1)
+            continue
+        received = time.perf_counter()
+
+        # The first response only tells where the history ends.
+        if first:
+            if status == 200:
+                last_message_id = json.loads(data)["last_message_id"]
+                first = False
+                ready()
+            continue
+
+        stats.add(received - t, status, size)
+        if status != 200:
+            time.sleep(0.1)
+            continue
+
+        obj = json.loads(data)
+        last_message_id = obj["last_message_id"]
+        latencies = []
+        for sender_ip, text in obj["messages"]:
+            sent = bench_sent_time(text)
+            if sent is not None:
+                latencies.append(received - sent)
+        delivery.extend(latencies)
+
+        if not args.poll_timeout and args.poll_interval:
+            time.sleep(args.poll_interval)
+    conn.close()
+
+# Posts `rate` messages per second until the end, on schedule: a late message
+# does not move the next ones.
+def bench_sender(args, sender, start, end, stats, sent):
+    conn = BenchConnection(args.host, args.port, not args.no_keep_alive)
+    seq = 0
+    while True:
+        due = start + seq / args.send_rate
+        if due >= end:
+            break
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        body = json.dumps({ "text": bench_text(sender, seq) })
+        seq += 1
+        t = time.perf_counter()
+        try:
+            status, data, size = conn.request("POST", "/chat", body)
+        except (OSError, http.client.HTTPException) as e:
+            stats.error(type(e).__name__)
+            continue
+        stats.add(time.perf_counter() - t, status)
+        if status == 200:
+            sent.append(1)
+    conn.close()
+
+def bench_run(args):
+    poll_stats = BenchStats()
+    chat_stats = BenchStats()
+    delivery = []
+    sent = []
+
+    # The pollers first catch up with the history; the measurement starts
+    # when all of them are ready.
+    end = [float("inf")]
+    ready_count = [0]
+    ready_lock = Lock()
+    all_ready = Event()
+    def ready():
+        with ready_lock:
+            ready_count[0] += 1
+            if ready_count[0] == args.pollers:
+                all_ready.set()
+
+    pollers = [Thread(target=bench_poller, args=(args, end, ready, poll_stats, delivery))
+               for _ in range(args.pollers)]
+    for th in pollers:
+        th.daemon = True
+        th.start()
+    if args.pollers:
+        all_ready.wait(30)
+
+    start = time.perf_counter()
+    end[0] = start + args.duration
+    senders = [Thread(target=bench_sender,
+                      args=(args, i, start, end[0], chat_stats, sent))
+               for i in range(args.senders)]
+    for th in senders:
+        th.daemon = True
+        th.start()
+
+    for th in senders + pollers:
+        th.join(args.duration + 60)
+    elapsed = time.perf_counter() - start
+
+    delivery.sort()
+    expected = len(sent) * args.pollers
+    return {
+        "elapsed": elapsed,
+        "messages": poll_stats.summary(elapsed),
+        "chat": chat_stats.summary(elapsed),
+        "delivery": {
+            "count": len(delivery),
+            "expected": expected,
+            "lost": max(0, expected - len(delivery)),
+            "p50_ms": percentile(delivery, 0.50) * 1000,
+            "p95_ms": percentile(delivery, 0.95) * 1000,
+            "p99_ms": percentile(delivery, 0.99) * 1000,
+            "max_ms": delivery[-1] * 1000 if delivery else 0.0,
+        },
+    }
+
+def bench_report(results):
+    for kind in ("chat", "messages"):
+        r = results[kind]
+        sys.stdout.write("%-10s %8u requests %9.0f req/s   p50 %8.3f ms   p95 %8.3f ms   "
+                         "p99 %8.3f ms   %u errors (%.2f%%)   %u bytes received\n" % (
+            kind, r["count"], r["rate"], r["p50_ms"], r["p95_ms"], r["p99_ms"],
+            r["errors"], r["error_rate"] * 100, r["bytes"]))
+    r = results["delivery"]
+    sys.stdout.write("%-10s %8u of %u messages   p50 %8.3f ms   p95 %8.3f ms   p99 %8.3f ms\n" % (
+        "delivery", r["count"], r["expected"], r["p50_ms"], r["p95_ms"], r["p99_ms"]))
+
+# The main numbers of several saved runs side by side.
+def bench_compare(paths):
+    runs = []
+    for path in paths:
+        with open(path) as f:
+            runs.append(json.load(f))
+    rows = [
+        ("chat req/s", lambda r: r["results"]["chat"]["rate"]),
+        ("chat p99 ms", lambda r: r["results"]["chat"]["p99_ms"]),
+        ("messages req/s", lambda r: r["results"]["messages"]["rate"]),
+        ("messages p99 ms", lambda r: r["results"]["messages"]["p99_ms"]),
+        ("messages kB", lambda r: r["results"]["messages"].get("bytes", 0) / 1024.0),
+        ("errors", lambda r: r["results"]["chat"]["errors"] + r["results"]["messages"]["errors"]),
+        ("delivery p50 ms", lambda r: r["results"]["delivery"]["p50_ms"]),
+        ("delivery p99 ms", lambda r: r["results"]["delivery"]["p99_ms"]),
+        ("lost messages", lambda r: r["results"]["delivery"]["lost"]),
+    ]
+    sys.stdout.write("%-16s" % "" + "".join("%16s" % r["label"][:15] for r in runs) + "\n")
+    for name, value in rows:
+        sys.stdout.write("%-16s" % name + "".join("%16.2f" % value(r) for r in runs) + "\n")
+
+# Start httpchat.py on a free port and wait until it accepts connections.
+# All the simulated clients come from one address, so the server does not
+# limit their requests.
+def start_server(server_args):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "httpchat.py")
+    process = subprocess.Popen([sys.executable, script, "--port", str(port), "--no-rate-limit"] +
+                               shlex.split(server_args),
+                               stdout=subprocess.DEVNULL)
+    for i in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("the server did not start")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for httpchat.")
+    parser.add_argument("--host", help="address of a running server (by default one is started)")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--server-args", default="",
+                        help='options of the started server, e.g. --server-args="--event-loop"')
+    parser.add_argument("--duration", type=float, default=10, help="seconds of the measurement")
+    parser.add_argument("--pollers", type=int, default=50, help="simulated browsers")
+    parser.add_argument("--poll-timeout", type=float, default=25,
+                        help="long polling timeout (0 for short polling)")
+    parser.add_argument("--poll-interval", type=float, default=1,
+                        help="seconds between short polls")
+    parser.add_argument("--senders", type=int, default=5)
+    parser.add_argument("--send-rate", type=float, default=10,
+                        help="messages per second of every sender")
+    parser.add_argument("--no-keep-alive", action="store_true",
+                        help="open a new connection for every request")
+    parser.add_argument("--gzip", action="store_true",
+                        help="accept compressed responses")
+    parser.add_argument("--label", help="name of the run in the saved results")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", nargs="+", metavar="FILE",
+                        help="show saved results side by side instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        bench_compare(args.compare)
+        return
+
+    process = None
+    if args.host is None:
+        process, args.port = start_server(args.server_args)
+        args.host = "127.0.0.1"
+
+    try:
+        results = bench_run(args)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    bench_report(results)
+    if args.output:
+        config = dict((k, v) for k, v in vars(args).items()
+                      if k not in ("output", "compare", "label"))
+        label = args.label or args.server_args or "default"
+        with open(args.output, "w") as f:
+            json.dump({ "label": label, "config": config, "results": results }, f, indent=2)
+            f.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,66 @@
 // Function to run after page load.
 $(function() {
+    // An open WebSocket connection, if there is one.
+    var websocket = null;
+
+    // The chat room, given after '#' in the address (the default room if none).
+    var room = decodeURIComponent(window.location.hash.substr(1));
+
     // Plug in a function that sends text to chat-input and set focus to the text field.
     $('#chat-input')
     .focus()
     .keypress(function(ev) {
-    if (ev.which != 13) { // ENTER key.
-        return;
-    }
-    ev.preventDefault();
+        if (ev.which != 13) { // ENTER key.
+            return;
+        }
+        ev.preventDefault();
 
-    // Download content and clear the text box.
-    var text = $(this).val();
-    $(this).val('');
+        // Download content and clear the text box.
+        var text = $(this).val();
+        $(this).val('');
 
-    // Send the text to the server.
-    var text_json = JSON.stringify({
-        "text": text
-    });
-    $.ajax({
-        url: '/chat',
-        type: 'POST',
-        data: text_json,
-        async: true
+        // Send the text to the server.
+        if (websocket) {
+            websocket.send(JSON.stringify({
+                "text": text,
+                "room": room
+            }));
+            return;
+        }
+        unsent.push({ "text": text });
+        if (!sending) {
+            sendMessages();
+        }
     });
-});
 
-// Regularly poll the server for new messages.
-var last_message_id = -1;
-var chat = $("chat-text");
-function checkForNewMessages() {
-    var request_json = JSON.stringify({
-        "last_message_id": last_message_id
-    });
+    // Messages typed while the previous ones are being sent wait, and then
+    // go together in a single request (up to as many as the server takes).
+    var unsent = [];
+    var sending = false;
+    var batch_limit = 20;
 
-    $.ajax({
-        url: '/messages',
-        type: 'POST',
-        data: request_json,
-        dataType: 'json',
-        async: true,
-        error: function(jqXHR, textStatus, errorThrown) {
-            console.log("Failed to fetch new messages: " + errorThrown);
-
-            // Call the function again in a second.
-            window.setTimeout(checkForNewMessages, 1000);
-        },
-    success: function(data) {
+    function sendMessages() {
+        var messages = unsent.splice(0, batch_limit);
+        sending = true;
+        $.ajax({
+            url: '/chat?room=' + encodeURIComponent(room),
+            type: 'POST',
+            data: JSON.stringify(messages),
+            async: true,
+            complete: function() {
+                sending = false;
+                if (unsent.length) {
+                    sendMessages();
+                }
+            }
+        });
+    }
+
+    var last_message_id = -1;
+    var chat = $("#chat-text");
+
+    // View the messages received from the server.
+    function showMessages(data) {
         last_message_id = data["last_message_id"];
         data["messages"].forEach(function(cv, idx, arr) {
             var person = cv[0];
@@ -58,10 +73,91 @@ function checkForNewMessages() {
         });
 
         chat.animate({ scrollTop: chat[0].scrollHeight }, 500);
+    }
+
+    // Wait for new messages. The server holds the request until there is
+    // something new (or 25 seconds pass), so the next one can be sent
+    // right after the response.
+    function checkForNewMessages() {
+        var request_json = JSON.stringify({
+            "last_message_id": last_message_id,
+            "timeout": 25,
+            "room": room
+        });
+
+        $.ajax({
+            url: '/messages',
+            type: 'POST',
+            data: request_json,
+            dataType: 'json',
+            async: true,
+            error: function(jqXHR, textStatus, errorThrown) {
+                console.log("Failed to fetch new messages: " + errorThrown);
+
                 // Call the function again in a second.
                 window.setTimeout(checkForNewMessages, 1000);
             },
+            success: function(data) {
+                showMessages(data);
+                checkForNewMessages();
+            },
         });
     }
-    checkForNewMessages();
-});
\ No newline at end of file
+
+    // Receive new messages as Server-Sent Events if the browser can do it.
+    // The browser reconnects by itself after a lost connection; only if the
+    // server refuses the stream, go back to asking for the messages.
+    function listenForNewMessages() {
+        var events = new EventSource('/events?last_message_id=' + last_message_id +
+                                     '&room=' + encodeURIComponent(room));
+        events.onmessage = function(ev) {
+            showMessages(JSON.parse(ev.data));
+        };
+        events.onerror = function() {
+            if (events.readyState == EventSource.CLOSED) {
+                checkForNewMessages();
+            }
+        };
+    }
+
+    // Without WebSocket, receive the messages in the best other way.
+    function fallBack() {
+        if (window.EventSource) {
+            listenForNewMessages();
+        } else {
+            checkForNewMessages();
+        }
+    }
+
+    // Both send and receive the messages over a WebSocket. A connection
+    // which has worked is opened again after it is lost; if it cannot be
+    // opened at all, the messages are received in another way.
+    function connectWebSocket() {
+        var scheme = window.location.protocol == "https:" ? "wss://" : "ws://";
+        var socket = new WebSocket(scheme + window.location.host +
+                                   '/ws?last_message_id=' + last_message_id +
+                                   '&room=' + encodeURIComponent(room));
+        var opened = false;
+        socket.onopen = function() {
+            opened = true;
+            websocket = socket;
+        };
+        socket.onmessage = function(ev) {
+            showMessages(JSON.parse(ev.data));
+        };
+        socket.onclose = function() {
+            websocket = null;
+            if (opened) {
+                window.setTimeout(connectWebSocket, 1000);
+            } else {
+                fallBack();
+            }
+        };
+    }
+
+    if (window.WebSocket) {
+        connectWebSocket();
+    } else {
+        fallBack();
+    }
+});
@@ -1,20 +1,64 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import ipaddress
+import itertools
+import json
 import os
+import random
 import socket
 import sys
+import time
+from collections import OrderedDict, namedtuple
 from datetime import timedelta
-from struct import pack, unpack
+from struct import error as struct_error, pack, unpack, unpack_from
+from threading import Condition, Event, Lock, Thread
 
-def dns_query(query, domain, dnserver):
+# Transport can be "tcp" or "udp". Over UDP the answer usually comes in a
+# single round trip; only when it does not fit in a datagram (the TC flag),
+# the question is asked again over TCP.
+def dns_query(query, domain, dnserver, cache=None, port=53, raw=False, transport="tcp"):
+    # If the answer is still in the cache, there is no need to ask the server.
+    if cache is not None:
+        dns_reply = cache.get(dnserver, query, domain, raw)
+        if dns_reply is not None:
+            return dns_reply
+
+    dns_response_packet = None
+    if transport == "udp":
+        try:
+            dns_response_packet = dns_udp_query_packet(query, domain, dnserver, port)
+        except socket.error as e:
+            sys.stderr.write("error: no answer from server (%s)\n" % (e.strerror or e))
+            return None
+        if dns_response_parse_header(dns_response_packet)["TC"]:
+            dns_response_packet = None
+
+    if dns_response_packet is None:
+        dns_response_packet = dns_tcp_query_packet(query, domain, dnserver, port)
+        if dns_response_packet is None:
+            return None
+
+    dns_reply = dns_response_parse_packet(dns_response_packet, raw)
+
+    if cache is not None:
+        cache.put(dnserver, query, domain, dns_response_packet, dns_reply, raw)
+
+    return dns_reply
+
+# A single query over its own TCP connection.
+def dns_tcp_query_packet(query, domain, dnserver, port=53):
     # Create a socket that uses TCP (AF_INET, SOCK_STREAM).
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     # Connect to the indicated server on port 53.
     try:
-        s.connect((dnserver, 53)) # DNS works on port 53.
+        s.connect((dnserver, port)) # DNS works on port 53.
     except socket.error as e:
         sys.stderr.write("error: failed to connect to server (%s)\n" % e.strerror)
+        s.close()
+        return None
     
     # Send an inquiry.
     dns_query_packet = dns_query_make_packet(query, domain)
@@ -22,24 +66,98 @@ def dns_query(query, domain, dnserver):
 
     # Receive the answer.
     dns_response_packet = dns_tcp_recv_packet(s)
-    dns_reply = dns_response_parse_packet(dns_response_packet)
+    if dns_response_packet is None:
+        sys.stderr.write("error: server hung up without answering\n")
+        s.close()
+        return None
 
     # Close the connection and socket.
     s.shutdown(socket.SHUT_RDWR)
     s.close()
 
-    return dns_reply
+    return dns_response_packet
+
+# A single query over UDP, asked up to 1 + retries times if there is no answer.
+# Every query gets its own socket, so it also gets a random source port,
+# which makes forging the answers much harder.
+# Answers longer than 512 bytes are only possible with EDNS0, so by default
+# the query advertises EDNS_PAYLOAD_SIZE (edns=0 turns EDNS0 off).
+def dns_udp_query_packet(query, domain, dnserver, port=53, timeout=1, retries=2, edns=None):
+    if edns is None:
+        edns = EDNS_PAYLOAD_SIZE
+    query_id = random.getrandbits(16)
+    packet = dns_query_make_packet(query, domain, query_id, edns=edns)
 
-def dns_query_make_packet(query_type, domain):
-    # Create a header.
-    query_id = 1234 # In the case of a single application and TCP,
-                    # this field can have any value (it is basically unused).
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Connecting a UDP socket means that datagrams from other
+        # addresses are not delivered to it.
+        s.connect((dnserver, port))
+        for _ in range(1 + retries):
+            s.send(packet)
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                s.settimeout(remaining)
+                try:
+                    reply = s.recv(0xffff)
+                except socket.timeout:
+                    break
+                # Ignore anything that is not the answer to our query.
+                if len(reply) >= 12 and unpack_from(">H", reply)[0] == query_id:
+                    return reply
+    finally:
+        s.close()
+
+    raise socket.timeout("no reply from %s" % dnserver)
+
+# Numeric codes of the query types.
+DNS_QUERY_TYPES = {
+    "A": 1,
+    "NS": 2,
+    "CNAME": 5,
+    "SOA": 6,
+    "WKS": 11,
+    "PTR": 12,
+    "HINFO": 13,
+    "MINFO": 14,
+    "MX": 15,
+    "TXT": 16,
+    "AAAA": 28,
+    "SRV": 33
+    }
+
+# Typed RDATA of the records with more than one field.
+DNSMXData = namedtuple("DNSMXData", "preference exchange")
+DNSSOAData = namedtuple("DNSSOAData", "mname rname serial refresh retry expire minimum")
+DNSSRVData = namedtuple("DNSSRVData", "priority weight port target")
+
+# Size of UDP answers advertised in the EDNS0 OPT record (see RFC 6891).
+# 1232 bytes fit in a single packet on practically every network.
+EDNS_PAYLOAD_SIZE = 1232
+
+# The part of the header following the ID depends only on the flags, so it is
+# built once for every combination of them and then reused.
+dns_query_header_templates = {}
+
+# The same goes for the TYPE and CLASS fields closing the question.
+dns_query_type_templates = {}
+
+def dns_query_header_template(rd=True, cd=False, opt=False):
+    key = (rd, cd, opt)
+    template = dns_query_header_templates.get(key)
+    if template is not None:
+        return template
 
     # In basic use, most of the fields in a 16-bit control word can be cleared.
     cw_rcode = 0
+    cw_cd = int(cd) # "Checking disabled" - do not validate DNSSEC signatures.
+    cw_ad = 0
     cw_z = 0
     cw_ra = 0
-    cw_rd = 1 # The "resolve query recursively" flag.
+    cw_rd = int(rd) # The "resolve query recursively" flag.
     cw_tc = 0
     cw_aa = 0
     cw_opcode = 0 # Standard query (QUERY).
@@ -48,154 +166,433 @@ def dns_query_make_packet(query_type, domain):
     # Combining single fields into a 16-bit word.
     control_word = (
         cw_rcode |
-        (cw_z << 4) |
+        (cw_cd << 4) |
+        (cw_ad << 5) |
+        (cw_z << 6) |
         (cw_ra << 7) |
         (cw_rd << 8) |
-        (cw_tc << 7) |
+        (cw_tc << 9) |
         (cw_aa << 10) |
         (cw_opcode << 11) |
         (cw_qr << 15))
-    
-    header = pack(">HHHHHH",
-        query_id, # ID
-        control_word, # QR, Opcode, AA, TC, RD, RA, Z, RCODE
+
+    # The "DNSSEC OK" flag and the EDNS0 payload size have no place in the
+    # header, they are carried by the OPT record in the additional section.
+    template = pack(">HHHHH",
+        control_word, # QR, Opcode, AA, TC, RD, RA, Z, AD, CD, RCODE
         1, # QDCOUNT
         0, # ANCOUNT
         0, # NSCOUNT
-        0) # ARCOUNT
-
-    query = []
-
-    # Coding individual domain elements in the form of length + data.
-    # (no compression due to only one domain).
-    for subdomain in domain.split("."):
-        query.append(pack(">B", len(subdomain)))
-        query.append(subdomain)
-    query.append("\0") # The last element has a length of zero and marks the end.
-
-    qtype = {
-        "A": 1,
-        "NS": 2,
-        "CNAME": 5,
-        "SOA": 6,
-        "WKS": 11,
-        "PTR": 12,
-        "HINFO": 13,
-        "MINFO": 14,
-        "MX": 15,
-        "TXT": 16
-        }[query_type]
-    qclass = 1 # IN (the Internet).
-    query.append(pack(">HH", qtype, qclass))
-
-    return header + ''.join(query)
-
-def dns_response_parse_packet(p):
-    idx = 0
-    header = dns_response_parse_header(p)
-    idx += 12
-
-    # Ignore repeated inquiries - in our case they are unnecessary.
-    for _ in range(header[QDCOUNT]):
-        domain, idx = dns_decode_domain(p, idx)
-        idx += 4 # Ignore the TYPE and CLASS fields.
-
-    # Receive the answers.
+        1 if opt else 0) # ARCOUNT
+
+    dns_query_header_templates[key] = template
+    return template
+
+def dns_query_type_template(query_type):
+    template = dns_query_type_templates.get(query_type)
+    if template is None:
+        qtype = DNS_QUERY_TYPES[query_type]
+        qclass = 1 # IN (the Internet).
+        template = pack(">HH", qtype, qclass)
+        dns_query_type_templates[query_type] = template
+    return template
+
+dns_opt_records = {}
+
+# OPT pseudo-record: root name, TYPE 41, the UDP payload size in place of the
+# CLASS and the extended flags in place of the TTL (0x8000 is "DNSSEC OK").
+# No record at all is needed if neither EDNS0 nor DO was asked for.
+def dns_opt_record(edns=None, do=False):
+    if not edns and not do:
+        return b""
+    key = (edns, do)
+    record = dns_opt_records.get(key)
+    if record is None:
+        record = pack(">BHHIH", 0, 41, edns or EDNS_PAYLOAD_SIZE, 0x8000 if do else 0, 0)
+        dns_opt_records[key] = record
+    return record
+
+# Coding individual domain elements in the form of length + data
+# (no compression due to only one domain) at the end of the buffer.
+def dns_encode_domain(buf, domain):
+    if domain.endswith("."):
+        domain = domain[:-1] # The root is marked by the final zero anyway.
+    if domain:
+        for subdomain in domain.encode("utf-8").split(b"."):
+            if not 0 < len(subdomain) < 64:
+                raise ValueError("invalid domain name %r" % domain)
+            buf.append(len(subdomain))
+            buf += subdomain
+    buf.append(0) # The last element has a length of zero and marks the end.
+
+# Append a complete query to the end of the buffer.
+# The edns parameter is the UDP payload size to advertise with EDNS0.
+def dns_query_write_packet(buf, query_type, domain, query_id, rd=True, cd=False, do=False,
+                           edns=None):
+    opt = dns_opt_record(edns, do)
+    buf += pack(">H", query_id)
+    buf += dns_query_header_template(rd, cd, bool(opt))
+    dns_encode_domain(buf, domain)
+    buf += dns_query_type_template(query_type)
+    buf += opt
+
+def dns_query_make_packet(query_type, domain, query_id=None, rd=True, cd=False, do=False,
+                          edns=None):
+    # A single query on its own connection does not really need the ID, but
+    # once several queries share one connection it is the only thing that
+    # tells the replies apart, so by default a random one is drawn.
+    if query_id is None:
+        query_id = random.getrandbits(16)
+
+    buf = bytearray()
+    dns_query_write_packet(buf, query_type, domain, query_id, rd, cd, do, edns)
+    return bytes(buf)
+
+# Build many queries at once from (type, domain) pairs.
+# Returns a list of (ID, packet) pairs; the IDs are drawn so that none of them
+# repeats within the batch (as long as the batch has at most 65536 queries).
+def dns_query_make_packets(queries, rd=True, cd=False, do=False, edns=None):
+    queries = list(queries)
+    if len(queries) <= 0x10000:
+        query_ids = random.sample(range(0x10000), len(queries))
+    else:
+        query_ids = [random.getrandbits(16) for _ in queries]
+
+    # Look the templates up once for the whole batch.
+    opt = dns_opt_record(edns, do)
+    header = dns_query_header_template(rd, cd, bool(opt))
+
+    packets = []
+    buf = bytearray()
+    for (query_type, domain), query_id in zip(queries, query_ids):
+        del buf[:]
+        buf += pack(">H", query_id)
+        buf += header
+        dns_encode_domain(buf, domain)
+        buf += dns_query_type_template(query_type)
+        buf += opt
+        packets.append((query_id, bytes(buf)))
+
+    return packets
+
+# Answers of the response as a list of dictionaries.
+# By default the fields are formatted for display. In the raw mode they are
+# left as they are (numeric TYPE, CLASS and TTL, typed DATA), which is both
+# faster and easier to process further.
+def dns_response_parse_packet(p, raw=False):
+    # Questions are ignored - in our case they are unnecessary.
     reply = []
-    for _ in range(header["ANCOUNT"]):
-        domain, idx = dns_decode_domain(p, idx)
-        atype, aclass, attl, adatalen = unpack(">HHIH", p[idx: idx + 10])
-        idx += 10
-        adata = p[idx: idx + adatalen]
-        idx += adatalen
+    if raw:
+        for record in DNSMessage(p).answers:
+            reply.append({
+                "NAME": record.name,
+                "TYPE": record.type,
+                "CLASS": record.rclass,
+                "TTL": record.ttl,
+                "DATA": record.value
+            })
+        return reply
 
+    for record in DNSMessage(p).answers:
         reply.append({
-            "TYPE": dns_type_to_str(atype),
-            "CLASS": dns_class_to_str(aclass),
-            "TTL": dns_ttl_to_str(attl),
-            "DATA": dns_data_to_str(atype, adata, p, idx - adatalen)
+            "TYPE": dns_type_to_str(record.type),
+            "CLASS": dns_class_to_str(record.rclass),
+            "TTL": dns_ttl_to_str(record.ttl),
+            "DATA": record.data
         })
 
     return reply
 
+# A DNS message parsed only as far as it is necessary to find its records.
+# Nothing is copied out of the packet until it is needed: the records keep
+# only the offsets of their names and data, and decoded names are remembered
+# by their offsets, so a suffix shared by many records is decoded once.
+class DNSMessage():
+    __slots__ = ("packet", "view", "names", "header",
+                 "questions", "answers", "authority", "additional")
+
+    def __init__(self, p):
+        self.packet = p
+        self.view = memoryview(p)
+        self.names = {}
+        self.header = dns_response_parse_header(p)
+        idx = 12
+
+        # Questions as (name offset, TYPE, CLASS).
+        self.questions = []
+        for _ in range(self.header["QDCOUNT"]):
+            name_idx = idx
+            idx = dns_skip_domain(p, idx)
+            qtype, qclass = unpack_from(">HH", p, idx)
+            idx += 4
+            self.questions.append((name_idx, qtype, qclass))
+
+        self.answers, idx = self.__parse_records(idx, self.header["ANCOUNT"])
+        self.authority, idx = self.__parse_records(idx, self.header["NSCOUNT"])
+        self.additional, idx = self.__parse_records(idx, self.header["ARCOUNT"])
+
+    def __parse_records(self, idx, count):
+        p = self.packet
+        records = []
+        for _ in range(count):
+            name_idx = idx
+            idx = dns_skip_domain(p, idx)
+            atype, aclass, attl, adatalen = unpack_from(">HHIH", p, idx)
+            idx += 10
+            if idx + adatalen > len(p):
+                raise ValueError("record data beyond the end of the packet")
+            records.append(DNSRecord(self, name_idx, atype, aclass, attl, idx, adatalen))
+            idx += adatalen
+        return records, idx
+
+    def domain(self, idx):
+        return dns_decode_domain(self.packet, idx, self.names)[0]
+
+# A single resource record of a DNSMessage, decoded lazily.
+class DNSRecord():
+    __slots__ = ("message", "name_idx", "type", "rclass", "ttl",
+                 "rdata_idx", "rdata_len", "decoded_data", "decoded_value")
+
+    def __init__(self, message, name_idx, atype, aclass, attl, rdata_idx, rdata_len):
+        self.message = message
+        self.name_idx = name_idx
+        self.type = atype
+        self.rclass = aclass
+        self.ttl = attl
+        self.rdata_idx = rdata_idx
+        self.rdata_len = rdata_len
+        self.decoded_data = None
+        self.decoded_value = None
+
+    @property
+    def name(self):
+        return self.message.domain(self.name_idx)
+
+    # Raw RDATA as a view of the packet (without copying).
+    @property
+    def rdata(self):
+        return self.message.view[self.rdata_idx: self.rdata_idx + self.rdata_len]
+
+    # RDATA decoded according to the type (see dns_decode_rdata).
+    @property
+    def value(self):
+        if self.decoded_value is None:
+            self.decoded_value = dns_decode_rdata(
+                self.type, self.rdata, self.message.packet, self.rdata_idx,
+                self.message.names)
+        return self.decoded_value
+
+    # RDATA formatted for display.
+    @property
+    def data(self):
+        if self.decoded_data is None:
+            self.decoded_data = dns_data_to_str(
+                self.type, self.rdata, self.message.packet, self.rdata_idx,
+                self.message.names)
+        return self.decoded_data
+
 def dns_response_parse_header(p):
     query_id, control_word, qdcount, ancount, nscount, arcount = (
         unpack(">HHHHHH", p[:12]))
     header = {
+        "ID": query_id,
+        "RCODE": control_word & 0xf,
+        "TC": bool(control_word & 0x0200),
         "QDCOUNT": qdcount,
-        "ANCOUNT": ancount
+        "ANCOUNT": ancount,
+        "NSCOUNT": nscount,
+        "ARCOUNT": arcount
         }
     return header
 
+# Determine for how many seconds the answer may be kept in a cache.
+# A positive answer lives as long as the shortest TTL among its records.
+# A negative answer (NXDOMAIN or no records) lives as long as the SOA record
+# from the authority section allows (RFC 2308), or negative_ttl seconds if
+# the server did not send one. None means the answer must not be cached.
+def dns_response_cache_ttl(p, negative_ttl=300):
+    message = DNSMessage(p)
+    rcode = message.header["RCODE"]
+    if rcode not in (0, 3): # Only NOERROR and NXDOMAIN.
+        return None
+
+    if rcode == 0 and message.answers:
+        return min(record.ttl for record in message.answers)
+
+    for record in message.authority:
+        if record.type == 6: # Record SOA, its last field is the negative caching time.
+            minimum = unpack_from(">I", record.rdata, record.rdata_len - 4)[0]
+            return min(record.ttl, minimum)
+
+    return negative_ttl
+
 def dns_class_to_str(aclass):
     return {
         1: "IN", 2: "CS", 3: "CH", 4: "HS"
         }.get(aclass, "??")
 
+dns_type_names = dict((code, name) for name, code in DNS_QUERY_TYPES.items())
+
 def dns_type_to_str(atype):
-    return {
-        1: "A", 2: "NS", 5: "CNAME", 6: "SOA", 11: "WKS", 12: "PTR", 13: "HINFO", 14: "MINFO", 15: "MX", 16: "TXT"
-        }.get(atype, "??")
+    return dns_type_names.get(atype, "??")
+
+# The same few TTL values repeat in nearly every answer,
+# so each of them is formatted only once.
+dns_ttl_strings = {}
 
 def dns_ttl_to_str(attl):
-    return str(timedelta(seconds=attl))
+    s = dns_ttl_strings.get(attl)
+    if s is None:
+        s = str(timedelta(seconds=attl))
+        if len(dns_ttl_strings) < 4096:
+            dns_ttl_strings[attl] = s
+    return s
 
-def dns_data_to_str(atype, adata, p, adata_idx):
+# Decoding RDATA into Python values:
+#   A, AAAA             - address as a string
+#   NS, CNAME, PTR      - domain name
+#   MX, SOA, SRV        - DNSMXData, DNSSOAData, DNSSRVData
+#   TXT                 - tuple of strings
+#   any other type      - raw bytes
+def dns_decode_rdata(atype, adata, p, adata_idx, names=None):
+    # A wrong length would make the socket functions raise OSError, which
+    # would be taken for a network failure rather than a malformed reply.
     if atype == 1: # Record A.
-        return "%u.%u.%u.%u" % unpack("BBBB", adata)
+        if len(adata) != 4:
+            raise ValueError("A record of %u bytes" % len(adata))
+        return socket.inet_ntoa(adata)
+    elif atype == 28: # Record AAAA.
+        if len(adata) != 16:
+            raise ValueError("AAAA record of %u bytes" % len(adata))
+        return socket.inet_ntop(socket.AF_INET6, adata)
+    elif atype in (2, 5, 12): # Records NS, CNAME and PTR.
+        return dns_decode_domain(p, adata_idx, names)[0]
+    elif atype == 15: # Record MX.
+        preference = unpack_from(">H", adata)[0]
+        return DNSMXData(preference, dns_decode_domain(p, adata_idx + 2, names)[0])
+    elif atype == 6: # Record SOA.
+        mname, idx = dns_decode_domain(p, adata_idx, names)
+        rname, idx = dns_decode_domain(p, idx, names)
+        return DNSSOAData(mname, rname, *unpack_from(">IIIII", p, idx))
+    elif atype == 33: # Record SRV.
+        priority, weight, port = unpack_from(">HHH", adata)
+        return DNSSRVData(priority, weight, port, dns_decode_domain(p, adata_idx + 6, names)[0])
+    elif atype == 16: # Record TXT, a sequence of strings preceded by their lengths.
+        strings = []
+        idx = 0
+        while idx < len(adata):
+            length = adata[idx]
+            strings.append(str(adata[idx + 1: idx + 1 + length], "utf-8", "replace"))
+            idx += 1 + length
+        return tuple(strings)
+
+    return bytes(adata)
+
+# Printable characters stay as they are, the other bytes are replaced
+# with hexadecimal notation of their code.
+dns_byte_strings = [
+    chr(ch) if 32 <= ch <= 127 else " [%.2x] " % ch
+    for ch in range(256)]
+
+def dns_data_to_str(atype, adata, p, adata_idx, names=None):
+    if atype in (1, 28, 2, 5, 12): # Records A, AAAA, NS, CNAME and PTR.
+        return dns_decode_rdata(atype, adata, p, adata_idx, names)
     elif atype == 15: # Record MX.
-        preference = unpack(">H", adata[:2])[0]
-        domain, _ = dns_decode_domain(p, adata_idx + 2)
-        return "%s (%u)" % (domain, preference)
+        mx = dns_decode_rdata(atype, adata, p, adata_idx, names)
+        return "%s (%u)" % (mx.exchange, mx.preference)
+    elif atype == 6: # Record SOA.
+        return "%s %s %u %u %u %u %u" % dns_decode_rdata(atype, adata, p, adata_idx, names)
+    elif atype == 33: # Record SRV.
+        return "%u %u %u %s" % dns_decode_rdata(atype, adata, p, adata_idx, names)
+    elif atype == 16: # Record TXT.
+        return " ".join('"%s"' % s for s in dns_decode_rdata(atype, adata, p, adata_idx, names))
 
     # For an unsupported type, output printable characters.
-    # Replace non-ASCII bytes (bytes) with hexadecimal notation of their code.
-    o = []
-    for ch in adata:
-        ch = ord(ch)
-        if 32 <= ch <= 127: # Python is one of the few languages that can write this type.
-            o.append(chr(ch))
-        else:
-            o.append(" [%.2x] " % ch)
+    return ''.join([dns_byte_strings[ch] for ch in adata])
 
-    return ''.join(o)
+# Reading the domain name, following the compression pointers.
+# A pointer may only lead backwards (to a name that appeared earlier), so a
+# packet with a pointer loop is rejected instead of being followed forever.
+# Names already decoded are remembered in the names dictionary by their
+# offsets as (name, offset right after it), so when the same dictionary is
+# passed for the whole packet, every shared suffix is decoded only once.
+def dns_decode_domain(p, idx, names=None):
+    if names is None:
+        names = {}
+    entry = names.get(idx)
+    if entry is not None:
+        return entry
 
-# Recursive (due to compression) reading of the domain name.
-def dns_decode_domain(p, idx):
-    domain = []
+    # By far the most common case: the whole name is a pointer
+    # to a name that has already been decoded.
+    if p[idx] >= 0xc0:
+        pointer = ((p[idx] & 0x3f) << 8) | p[idx + 1]
+        target = names.get(pointer)
+        if target is not None and pointer < idx:
+            entry = names[idx] = (target[0], idx + 2)
+            return entry
 
-    while True:
-        type_len = ord(p, idx):
-        idx += 1
+    first_idx = idx
 
-        if type_len == 0: # End.
-            break
+    # The name consists of segments: labels ended by a zero or by a pointer.
+    segments = []
+    suffix = ""
+    while idx not in names:
+        start = idx
+        labels = []
+        pointer = None
 
-        if type_len & 0xc0: # Compression (pointer).
-            # Decode the name shift.
-            offset = (type_len & 0x3f) << 8
-            offset |= ord(p[idx])
-            idx += 1
+        while True:
+            type_len = p[idx]
+            if type_len == 0: # End.
+                idx += 1
+                break
 
-            # Get the domain name from the indicated shift.
-            domain_part, _ = dns_decode_domain(p, offset)
-            domain.append(domain_part)
+            if type_len & 0xc0: # Compression (pointer).
+                if type_len & 0xc0 != 0xc0:
+                    raise ValueError("unsupported label type")
+                pointer = ((type_len & 0x3f) << 8) | p[idx + 1]
+                idx += 2
+                break # The pointer is always the last element of the domain.
 
-            # The pointer is always the last element of the domain.
+            # Another plain domain fragment.
+            labels.append(str(p[idx + 1: idx + 1 + type_len], "utf-8", "replace"))
+            idx += 1 + type_len
+
+        segments.append((start, idx, labels))
+        if pointer is None:
             break
+        if pointer >= start:
+            raise ValueError("compression pointer loop")
+        idx = pointer
+    else:
+        suffix = names[idx][0]
+
+    # Put the name together starting from its end,
+    # remembering every suffix on the way.
+    for start, end, labels in reversed(segments):
+        if suffix:
+            labels.append(suffix)
+        suffix = '.'.join(labels)
+        names[start] = (suffix, end)
 
-        # Another plain domain fragment.
-        domain_part = p[idx:idx + type_len]
-        domain.append(domain_part)
-        idx += type_len
+    return names[first_idx]
 
-    return '.'.join(domain), idx
+# Skip the domain name without decoding it.
+def dns_skip_domain(p, idx):
+    while True:
+        type_len = p[idx]
+        if type_len & 0xc0: # The pointer is always the last element of the domain.
+            return idx + 2
+        idx += 1 + type_len
+        if type_len == 0:
+            return idx
 
 # DNS requires each packet to be preceded by a 2-byte length field.
 def dns_tcp_send_packet(s, packet):
-    packet_len = pack(">H", len(packet))
-    s.sendall(packet_len)
-    s.sendall(packet)
+    # Both parts are sent at once, so that they do not end up in separate
+    # segments and queries sent by other threads cannot get in between them.
+    s.sendall(pack(">H", len(packet)) + packet)
 
 def dns_tcp_recv_packet(s):
     packet_len = recv_all(s, 2)
@@ -207,16 +604,1004 @@ def dns_tcp_recv_packet(s):
 # Auxiliary function that receives an exact number of bytes.
 def recv_all(s, n):
     d = []
+    received = 0
 
-    while len(d) < n:
-        d_latest = s.recv(n - len(d))
+    while received < n:
+        d_latest = s.recv(n - received)
         if len(d_latest) == 0:
             # The other party hung up before sending all the required data.
             return None
         d.append(d_latest)
+        received += len(d_latest)
+
+    return b''.join(d)
+
+# A query sent over a shared connection and waiting for its reply.
+class DNSPendingQuery():
+    def __init__(self, connection, query_id):
+        self.connection = connection
+        self.query_id = query_id
+        self.done = Event()
+        self.packet = None
+        self.error = None
+        self.callbacks = []
+
+    def set_result(self, packet, error=None):
+        self.packet = packet
+        self.error = error
+        self.done.set()
+        for callback in self.callbacks:
+            callback(self)
+
+    # Call the function once the reply (or an error) arrives.
+    # It may happen to be called twice if the reply arrives just now.
+    def add_done_callback(self, callback):
+        self.callbacks.append(callback)
+        if self.done.is_set():
+            callback(self)
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            # Nobody is interested in the reply anymore, so if it arrives
+            # after all, the connection should simply drop it.
+            self.connection.forget(self)
+            raise socket.timeout("no reply from %s" % self.connection.dnserver)
+        if self.error is not None:
+            raise self.error
+        return self.packet
+
+# A persistent TCP connection to a DNS server.
+# Many queries can be in flight on it at the same time (pipelining as
+# described in RFC 7766). The server may answer them in any order, so the
+# replies are matched with the queries by their IDs.
+class DNSConnection():
+    def __init__(self, dnserver, port=53, timeout=5):
+        self.dnserver = dnserver
+        self.s = socket.create_connection((dnserver, port), timeout)
+        self.s.settimeout(None) # Replies are awaited by the queries themselves.
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.pending = {}
+        self.lock = Lock()
+        self.send_lock = Lock()
+        self.closed = False
+
+        # Thread receiving replies and handing them over to the waiting queries.
+        self.receiver = Thread(target=self.__receive_loop)
+        self.receiver.daemon = True
+        self.receiver.start()
+
+    def in_flight(self):
+        return len(self.pending)
+
+    def submit(self, query_type, domain):
+        with self.lock:
+            if self.closed:
+                raise socket.error("connection to %s is closed" % self.dnserver)
+            if len(self.pending) >= 0xffff:
+                raise socket.error("no free query IDs on connection to %s" % self.dnserver)
+
+            # Draw an ID that is not used by any other query in flight.
+            query_id = random.getrandbits(16)
+            while query_id in self.pending:
+                query_id = random.getrandbits(16)
+
+            pending = DNSPendingQuery(self, query_id)
+            self.pending[query_id] = pending
+
+        packet = dns_query_make_packet(query_type, domain, query_id)
+        try:
+            with self.send_lock:
+                dns_tcp_send_packet(self.s, packet)
+        except socket.error as e:
+            self.close(e)
+
+        return pending
+
+    def forget(self, pending):
+        with self.lock:
+            # The ID may already belong to another query if the reply came
+            # just now, so only the very same query is removed.
+            if self.pending.get(pending.query_id) is pending:
+                del self.pending[pending.query_id]
+
+    def close(self, error=None):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+
+        # Queries still waiting for a reply will not get one on this connection.
+        if error is None:
+            error = socket.error("connection to %s closed" % self.dnserver)
+        for p in pending:
+            p.set_result(None, error)
+
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass # The other party may have already hung up.
+        self.s.close()
+
+    def __receive_loop(self):
+        error = None
+        try:
+            while True:
+                packet = dns_tcp_recv_packet(self.s)
+                if not packet or len(packet) < 12:
+                    break # The server closed the connection (e.g. it was idle for too long).
+
+                query_id = unpack(">H", packet[:2])[0]
+                with self.lock:
+                    pending = self.pending.pop(query_id, None)
+
+                # Replies to unknown (e.g. timed out) queries are ignored.
+                if pending is not None:
+                    pending.set_result(packet)
+        except socket.error as e:
+            error = e
+        self.close(error)
+
+# A set of persistent connections to one DNS server.
+# New connections are opened only when all the existing ones are busy.
+# Opening one may take up to `timeout`, so it is done without the lock;
+# the lock only reserves a place for it, so that other threads can keep
+# using the connections already open.
+class DNSConnectionPool():
+    def __init__(self, dnserver, port=53, max_connections=4, max_in_flight=64, timeout=5):
+        self.dnserver = dnserver
+        self.port = port
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+
+        self.connections = []
+        self.connecting = 0 # Connections being opened.
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+
+    def get(self):
+        with self.cond:
+            while True:
+                # Forget connections closed by the server in the meantime.
+                self.connections = [c for c in self.connections if not c.closed]
+
+                best = None
+                for c in self.connections:
+                    if best is None or c.in_flight() < best.in_flight():
+                        best = c
+
+                full = len(self.connections) + self.connecting >= self.max_connections
+                if best is not None and (best.in_flight() < self.max_in_flight or full):
+                    return best
+                if not full:
+                    break
+
+                # No connection yet, but the other threads are opening them.
+                if not self.cond.wait(self.timeout):
+                    raise socket.timeout("timed out waiting for a connection")
+            self.connecting += 1
+
+        c = None
+        try:
+            c = DNSConnection(self.dnserver, self.port, self.timeout)
+        finally:
+            with self.cond:
+                self.connecting -= 1
+                if c is not None:
+                    self.connections.append(c)
+                self.cond.notify_all()
+        return c
+
+    def close(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for c in connections:
+            c.close()
+
+# Resolver keeping a pool of persistent connections per DNS server.
+# Unlike dns_query, it can be shared by many threads, each of them sending
+# queries over the same connections.
+class DNSResolver():
+    def __init__(self, port=53, max_connections=4, max_in_flight=64, timeout=5, cache=None):
+        self.cache = cache
+        self.port = port
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+
+        self.pools = {}
+        self.pools_lock = Lock()
+
+    def pool(self, dnserver):
+        with self.pools_lock:
+            if dnserver not in self.pools:
+                self.pools[dnserver] = DNSConnectionPool(
+                    dnserver, self.port, self.max_connections,
+                    self.max_in_flight, self.timeout)
+            return self.pools[dnserver]
+
+    # Send a query without waiting for the reply.
+    def submit(self, query_type, domain, dnserver):
+        return self.pool(dnserver).get().submit(query_type, domain)
+
+    def query_packet(self, query_type, domain, dnserver):
+        # The server is free to close an idle connection at any moment, so a
+        # query that was lost together with its connection is sent once more.
+        for attempt in range(2):
+            pending = self.submit(query_type, domain, dnserver)
+            try:
+                return pending.wait(self.timeout)
+            except socket.timeout:
+                raise
+            except socket.error:
+                if attempt:
+                    raise
+
+    def query(self, query_type, domain, dnserver, raw=False):
+        if self.cache is not None:
+            reply = self.cache.get(dnserver, query_type, domain, raw)
+            if reply is not None:
+                return reply
+
+        packet = self.query_packet(query_type, domain, dnserver)
+        reply = dns_response_parse_packet(packet, raw)
+
+        if self.cache is not None:
+            self.cache.put(dnserver, query_type, domain, packet, reply, raw)
+        return reply
+
+    def close(self):
+        with self.pools_lock:
+            pools = list(self.pools.values())
+            self.pools = {}
+        for pool in pools:
+            pool.close()
+
+# Resolver asking over UDP (with EDNS0) and falling back to TCP only when
+# the answer did not fit in a datagram. The TCP queries go through
+# a DNSResolver, so they share its persistent connections.
+class UDPDNSResolver():
+    def __init__(self, port=53, timeout=1, retries=2, edns=None, cache=None, tcp_resolver=None):
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.edns = edns
+        self.cache = cache
+        self.tcp_resolver = tcp_resolver
+        self.tcp_lock = Lock()
+        self.truncated = 0
+
+    def tcp(self):
+        with self.tcp_lock:
+            if self.tcp_resolver is None:
+                self.tcp_resolver = DNSResolver(port=self.port, timeout=self.timeout * (1 + self.retries))
+            return self.tcp_resolver
+
+    def query_packet(self, query_type, domain, dnserver):
+        packet = dns_udp_query_packet(query_type, domain, dnserver, self.port,
+                                      self.timeout, self.retries, self.edns)
+        if dns_response_parse_header(packet)["TC"]:
+            self.truncated += 1
+            packet = self.tcp().query_packet(query_type, domain, dnserver)
+        return packet
+
+    def query(self, query_type, domain, dnserver, raw=False):
+        if self.cache is not None:
+            reply = self.cache.get(dnserver, query_type, domain, raw)
+            if reply is not None:
+                return reply
+
+        packet = self.query_packet(query_type, domain, dnserver)
+        reply = dns_response_parse_packet(packet, raw)
+
+        if self.cache is not None:
+            self.cache.put(dnserver, query_type, domain, packet, reply, raw)
+        return reply
+
+    def close(self):
+        with self.tcp_lock:
+            if self.tcp_resolver is not None:
+                self.tcp_resolver.close()
+
+# In-memory cache of answers, keyed by (server, type, domain).
+# Each answer is kept as long as its TTL allows, negative answers included.
+# When the cache exceeds the entry or memory limit, the least recently used
+# answers are removed first.
+class DNSCache():
+    ENTRY_OVERHEAD = 256 # Approximate cost of the key, the reply and the bookkeeping.
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024,
+                 negative_ttl=300, max_ttl=86400):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+
+        self.entries = OrderedDict() # key -> (expiry time, size, reply)
+        self.size = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # The raw and the formatted replies (see dns_response_parse_packet)
+    # are kept separately.
+    def get(self, dnserver, query_type, domain, raw=False):
+        key = (dnserver, query_type, domain.lower(), raw)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[0] <= time.monotonic():
+                # The answer is outdated.
+                del self.entries[key]
+                self.size -= entry[1]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, dnserver, query_type, domain, packet, reply, raw=False):
+        try:
+            ttl = dns_response_cache_ttl(packet, self.negative_ttl)
+        except (IndexError, ValueError, struct_error):
+            return # A malformed answer is not worth remembering.
+        if not ttl:
+            return
+
+        key = (dnserver, query_type, domain.lower(), raw)
+        size = len(packet) + self.ENTRY_OVERHEAD
+        expiry = time.monotonic() + min(ttl, self.max_ttl)
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (expiry, size, reply)
+            self.size += size
+
+            # Remove the least recently used answers until the limits are met.
+            while (len(self.entries) > self.max_entries or
+                   self.size > self.max_bytes):
+                _, (_, old_size, _) = self.entries.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": float(self.hits) / lookups if lookups else 0.0
+            }
+
+# Latency and reliability of a single upstream server, as seen by the
+# HedgedDNSResolver. Both are tracked as exponentially weighted moving
+# averages, and the most recent latencies are kept to estimate percentiles.
+class DNSUpstreamStats():
+    ALPHA = 0.2 # Weight of the newest sample.
+    SAMPLES = 64 # Number of the most recent latencies kept.
+
+    def __init__(self, dnserver):
+        self.dnserver = dnserver
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = []
+        self.next_sample = 0
+        self.queries = 0
+        self.errors = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def record_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.ALPHA * (latency - self.latency)
+        self.error_rate -= self.ALPHA * self.error_rate
+
+        if len(self.samples) < self.SAMPLES:
+            self.samples.append(latency)
+        else:
+            self.samples[self.next_sample] = latency
+            self.next_sample = (self.next_sample + 1) % self.SAMPLES
+
+    def record_error(self):
+        self.errors += 1
+        self.error_rate += self.ALPHA * (1.0 - self.error_rate)
+
+    # The lower, the better. A server that has not been asked yet comes
+    # first, so that every server gets a chance to prove itself.
+    def score(self, timeout):
+        latency = self.latency if self.latency is not None else 0.0
+        # A failed query costs as much as waiting for the whole timeout.
+        return latency * (1.0 - self.error_rate) + timeout * self.error_rate
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+# Resolver asking several upstream servers.
+# Every query goes to the best server first. If it does not answer within
+# the time in which it usually answers (a percentile of its recent
+# latencies), the same query is sent to the next best server as well, and
+# the first valid answer wins. This way a single slow or failing server
+# does not hold the queries up.
+class HedgedDNSResolver():
+    def __init__(self, servers, port=53, timeout=5, cache=None, hedge_percentile=0.95,
+                 initial_hedge_delay=0.1, min_hedge_delay=0.005, max_hedges=1):
+        self.servers = list(servers)
+        self.timeout = timeout
+        self.cache = cache
+        self.hedge_percentile = hedge_percentile
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedges = max_hedges
+
+        self.resolver = DNSResolver(port=port, timeout=timeout)
+        self.upstreams = dict((s, DNSUpstreamStats(s)) for s in self.servers)
+        self.lock = Lock()
+
+    def ranked_servers(self):
+        with self.lock:
+            return sorted(self.servers, key=lambda s: self.upstreams[s].score(self.timeout))
+
+    def hedge_delay(self, dnserver):
+        with self.lock:
+            delay = self.upstreams[dnserver].percentile(self.hedge_percentile)
+        if delay is None:
+            return self.initial_hedge_delay
+        return min(max(delay, self.min_hedge_delay), self.timeout)
+
+    def __record(self, dnserver, latency=None):
+        with self.lock:
+            upstream = self.upstreams[dnserver]
+            upstream.queries += 1
+            if latency is None:
+                upstream.record_error()
+            else:
+                upstream.record_latency(latency)
+
+    def query_packet(self, query_type, domain):
+        candidates = self.ranked_servers()
+        hedges_left = self.max_hedges
+        start = time.monotonic()
+        deadline = start + self.timeout
+        any_done = Event()
+        in_flight = {} # DNSPendingQuery -> (server, time of sending)
+        hedge_at = deadline
+        error = None
+
+        while True:
+            # Send the query to the next server if nothing is in flight
+            # (the previous ones failed) or if it is time for a hedge.
+            now = time.monotonic()
+            if candidates and (not in_flight or (hedges_left > 0 and now >= hedge_at)):
+                dnserver = candidates.pop(0)
+                if in_flight:
+                    hedges_left -= 1
+                    with self.lock:
+                        self.upstreams[dnserver].hedges += 1
+                try:
+                    pending = self.resolver.submit(query_type, domain, dnserver)
+                except socket.error as e:
+                    self.__record(dnserver)
+                    error = e
+                    continue
+                in_flight[pending] = (dnserver, now)
+                pending.add_done_callback(lambda p: any_done.set())
+                hedge_at = now + self.hedge_delay(dnserver)
+                continue
+
+            if not in_flight:
+                break # Nobody left to ask.
+
+            # Wait for any answer, but no longer than until the next hedge.
+            wait_until = deadline
+            if candidates and hedges_left > 0:
+                wait_until = min(deadline, hedge_at)
+            any_done.wait(max(0.0, wait_until - now))
+            any_done.clear()
+
+            now = time.monotonic()
+            for pending in [p for p in in_flight if p.done.is_set()]:
+                dnserver, sent = in_flight.pop(pending)
+                if pending.error is not None:
+                    self.__record(dnserver)
+                    error = pending.error
+                    continue
+
+                # SERVFAIL and REFUSED mean the server could not help,
+                # maybe the other one can.
+                packet = pending.packet
+                if packet[3] & 0xf in (2, 5):
+                    self.__record(dnserver)
+                    error = socket.error("%s could not answer (RCODE %u)" % (dnserver, packet[3] & 0xf))
+                    continue
+
+                self.__record(dnserver, now - sent)
+                with self.lock:
+                    self.upstreams[dnserver].wins += 1
+
+                # The servers that lost the race are at least this slow.
+                for loser, (loser_server, loser_sent) in in_flight.items():
+                    loser.connection.forget(loser)
+                    self.__record(loser_server, now - loser_sent)
+                return packet
+
+            if now >= deadline:
+                for pending, (dnserver, sent) in in_flight.items():
+                    pending.connection.forget(pending)
+                    self.__record(dnserver)
+                raise socket.timeout("no reply to %s %s" % (query_type, domain))
+
+        raise error if error is not None else socket.error("no servers to ask")
+
+    def query(self, query_type, domain, raw=False):
+        # The answer is the same whichever server gave it.
+        if self.cache is not None:
+            reply = self.cache.get("", query_type, domain, raw)
+            if reply is not None:
+                return reply
+
+        packet = self.query_packet(query_type, domain)
+        reply = dns_response_parse_packet(packet, raw)
+
+        if self.cache is not None:
+            self.cache.put("", query_type, domain, packet, reply, raw)
+        return reply
+
+    def stats(self):
+        with self.lock:
+            return dict((s, {
+                "latency": u.latency,
+                "error_rate": u.error_rate,
+                "queries": u.queries,
+                "errors": u.errors,
+                "hedges": u.hedges,
+                "wins": u.wins,
+                "hedge_delay": u.percentile(self.hedge_percentile)
+            }) for s, u in self.upstreams.items())
+
+    def close(self):
+        self.resolver.close()
+
+# Asynchronous counterpart of DNSConnection for use with asyncio.
+# The packets are built and parsed by the same functions, only the waiting
+# for the replies is done by the event loop instead of a thread.
+class AsyncDNSConnection():
+    def __init__(self, dnserver, reader, writer):
+        self.dnserver = dnserver
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.closed = False
+        self.receiver = asyncio.ensure_future(self.__receive_loop())
+
+    def in_flight(self):
+        return len(self.pending)
+
+    async def query_packet(self, query_type, domain, timeout=5):
+        return await self.exchange(dns_query_make_packet(query_type, domain, 0), timeout)
+
+    # Send a ready query (e.g. received from a client) and wait for the reply.
+    # The ID of the query is replaced with one unique on this connection,
+    # so the reply carries that ID as well.
+    async def exchange(self, packet, timeout=5):
+        if self.closed:
+            raise ConnectionError("connection to %s is closed" % self.dnserver)
+
+        # Draw an ID that is not used by any other query in flight.
+        query_id = random.getrandbits(16)
+        while query_id in self.pending:
+            query_id = random.getrandbits(16)
+
+        loop = asyncio.get_event_loop()
+        reply = loop.create_future()
+        self.pending[query_id] = reply
+
+        # A plain timer is much cheaper than wrapping every query in wait_for.
+        timer = loop.call_later(timeout, self.__expire, query_id, reply)
+        try:
+            self.writer.write(pack(">HH", len(packet), query_id) + packet[2:])
+            await self.writer.drain()
+            return await reply
+        finally:
+            timer.cancel()
+            # Once the reply has arrived, the ID may have been drawn again
+            # by another query, so only our own entry can be removed.
+            if self.pending.get(query_id) is reply:
+                del self.pending[query_id]
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+
+    def __expire(self, query_id, reply):
+        if self.pending.get(query_id) is reply:
+            del self.pending[query_id]
+        if not reply.done():
+            reply.set_exception(socket.timeout("no reply from %s" % self.dnserver))
+
+    async def __receive_loop(self):
+        error = ConnectionError("connection to %s closed" % self.dnserver)
+        try:
+            while True:
+                packet_len = unpack(">H", await self.reader.readexactly(2))[0]
+                packet = await self.reader.readexactly(packet_len)
+                if len(packet) < 12:
+                    break
+
+                reply = self.pending.pop(unpack(">H", packet[:2])[0], None)
+                if reply is not None and not reply.done():
+                    reply.set_result(packet)
+        except asyncio.IncompleteReadError:
+            pass # The server closed the connection.
+        except OSError as e:
+            error = e
+
+        self.closed = True
+        for reply in self.pending.values():
+            if not reply.done():
+                reply.set_exception(error)
+        self.pending.clear()
+        self.writer.close()
+
+async def dns_async_connect(dnserver, port=53, timeout=5):
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(dnserver, port), timeout)
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return AsyncDNSConnection(dnserver, reader, writer)
+
+# Asynchronous counterpart of DNSResolver.
+# Keeps a few pipelined connections per server and spreads queries among them.
+class AsyncDNSResolver():
+    def __init__(self, port=53, max_connections=4, max_in_flight=256, timeout=5, cache=None):
+        self.port = port
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.cache = cache
+
+        self.connections = {}
+        self.connecting = {}
+
+    async def connection(self, dnserver):
+        connections = [c for c in self.connections.get(dnserver, []) if not c.closed]
+        self.connections[dnserver] = connections
+
+        best = None
+        for c in connections:
+            if best is None or c.in_flight() < best.in_flight():
+                best = c
+        if best is not None and (best.in_flight() < self.max_in_flight or
+                                 len(connections) >= self.max_connections):
+            return best
+
+        # Only one new connection to a server is opened at a time,
+        # everybody else waits for it instead of opening their own.
+        if dnserver not in self.connecting:
+            self.connecting[dnserver] = asyncio.ensure_future(
+                dns_async_connect(dnserver, self.port, self.timeout))
+            try:
+                c = await self.connecting[dnserver]
+            finally:
+                del self.connecting[dnserver]
+            self.connections[dnserver].append(c)
+            return c
+        return await asyncio.shield(self.connecting[dnserver])
+
+    async def query_packet(self, query_type, domain, dnserver):
+        return await self.exchange(dns_query_make_packet(query_type, domain, 0), dnserver)
+
+    async def exchange(self, packet, dnserver):
+        # A query lost together with its connection is sent once more.
+        for attempt in range(2):
+            c = await self.connection(dnserver)
+            try:
+                return await c.exchange(packet, self.timeout)
+            except socket.timeout:
+                raise
+            except OSError:
+                if attempt:
+                    raise
+
+    async def query(self, query_type, domain, dnserver, raw=False):
+        if self.cache is not None:
+            reply = self.cache.get(dnserver, query_type, domain, raw)
+            if reply is not None:
+                return reply
+
+        packet = await self.query_packet(query_type, domain, dnserver)
+        reply = dns_response_parse_packet(packet, raw)
+
+        if self.cache is not None:
+            self.cache.put(dnserver, query_type, domain, packet, reply, raw)
+        return reply
+
+    def close(self):
+        for connections in self.connections.values():
+            for c in connections:
+                c.close()
+        self.connections = {}
+
+# Read (type, domain) pairs, one per line, e.g. "MX bak.pl".
+# A line with the domain alone asks for the A record. Empty lines and
+# lines starting with # are skipped.
+def dns_bulk_read_pairs(f):
+    for line in f:
+        tokens = line.split()
+        if not tokens or tokens[0].startswith("#"):
+            continue
+        if len(tokens) == 1:
+            yield "A", tokens[0]
+        else:
+            yield tokens[0].upper(), tokens[1]
+
+# Records of unknown types carry raw bytes, which JSON cannot hold as they are.
+def dns_json_default(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return bytes(obj).hex()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+# Resolve all the pairs and write the results to output as JSON lines,
+# in the order in which they are completed.
+# Only `concurrency` queries are in flight at any time and the pairs are
+# taken from the iterator only when needed, so the memory use does not
+# depend on the size of the input.
+async def dns_bulk_resolve(pairs, servers, output, concurrency=100, port=53,
+                           timeout=5, cache=None, raw=False):
+    resolver = AsyncDNSResolver(port=port, timeout=timeout, cache=cache,
+                                max_in_flight=max(1, concurrency // len(servers)))
+    servers = itertools.cycle(servers)
+    pairs = iter(pairs)
+    stats = { "queries": 0, "errors": 0 }
+
+    async def worker():
+        # All the workers share one iterator; this is safe because they run
+        # in a single thread and never wait in the middle of taking a pair.
+        for query_type, domain in pairs:
+            dnserver = next(servers)
+            result = { "type": query_type, "domain": domain, "server": dnserver }
+            try:
+                # A name that cannot be put into a query is the input's fault,
+                # not the server's, so it must not be taken for a bad reply.
+                dns_encode_domain(bytearray(), domain)
+            except ValueError:
+                result["error"] = "invalid domain name"
+            else:
+                try:
+                    result["answers"] = await resolver.query(query_type, domain, dnserver, raw)
+                except KeyError:
+                    result["error"] = "unsupported query type"
+                except (OSError, asyncio.TimeoutError) as e:
+                    result["error"] = str(e) or e.__class__.__name__
+                except (IndexError, ValueError, struct_error):
+                    result["error"] = "malformed reply"
+
+            stats["queries"] += 1
+            if "error" in result:
+                stats["errors"] += 1
+            output.write(json.dumps(result, default=dns_json_default) + "\n")
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        resolver.close()
+        output.flush()
+
+    return stats
+
+# Name under which the PTR record of an IPv4 or IPv6 address is kept,
+# e.g. 3.2.1.10.in-addr.arpa for 10.1.2.3.
+def dns_reverse_name(address):
+    return ipaddress.ip_address(address).reverse_pointer
+
+# All the addresses of the networks, one after another, without the first
+# `skip` of them. They are generated one at a time, so even an IPv6 /64
+# takes no memory, and skipping the part of a sweep already done is free.
+def dns_reverse_addresses(networks, skip=0):
+    for network in networks:
+        if skip >= network.num_addresses:
+            skip -= network.num_addresses
+            continue
+        address_class = network.network_address.__class__
+        first = int(network.network_address)
+        for i in range(first + skip, first + network.num_addresses):
+            yield address_class(i)
+        skip = 0
+
+# The progress of a sweep is kept as the number of addresses, counted from
+# the beginning of the first network, that are all done.
+def dns_reverse_load_checkpoint(path, networks):
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if checkpoint["networks"] != [str(n) for n in networks]:
+        raise ValueError("checkpoint %s was made for other networks" % path)
+    return checkpoint["done"]
+
+def dns_reverse_save_checkpoint(path, networks, done):
+    # Written aside and renamed, so an interrupted write does not destroy it.
+    with open(path + ".tmp", "w") as f:
+        json.dump({ "networks": [str(n) for n in networks], "done": done }, f)
+    os.replace(path + ".tmp", path)
+
+# Spaces the calls to wait() so that on average no more than `rate` of them
+# per second return. After a quiet period up to `burst` return at once.
+class DNSRateLimiter():
+    def __init__(self, rate, burst=None):
+        self.interval = 1.0 / rate
+        self.burst = burst if burst is not None else max(1, int(rate / 10))
+        self.next_time = time.monotonic()
+
+    async def wait(self):
+        now = time.monotonic()
+        self.next_time = max(self.next_time, now - (self.burst - 1) * self.interval)
+        delay = self.next_time - now
+        self.next_time += self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# Look up the PTR records of all the addresses in the networks (given in the
+# CIDR notation) and write an address to hostname table to output: a line
+# "address<TAB>hostname" for every name found and "# address error" for
+# every address which could not be checked. Addresses without names are
+# left out.
+# With a checkpoint file the sweep can be stopped and started again where
+# it left off; the few addresses which were in flight at the time of the
+# last save may appear in the output twice.
+async def dns_reverse_sweep(networks, servers, output, concurrency=100, rate=None,
+                            port=53, timeout=5, checkpoint=None, checkpoint_interval=5):
+    networks = [ipaddress.ip_network(n, strict=False) for n in networks]
+    done = dns_reverse_load_checkpoint(checkpoint, networks) if checkpoint else 0
+
+    resolver = AsyncDNSResolver(port=port, timeout=timeout,
+                                max_in_flight=max(1, concurrency // len(servers)))
+    limiter = DNSRateLimiter(rate) if rate else None
+    servers = itertools.cycle(servers)
+    addresses = enumerate(dns_reverse_addresses(networks, done), done)
+    stats = { "queries": 0, "names": 0, "errors": 0, "done": done }
+
+    # Numbers of the addresses taken but not finished yet; everything before
+    # the smallest of them (or, when there are none, before the next one to
+    # be taken) is done.
+    in_flight = set()
+    taken = done
+    last_save = time.monotonic()
+
+    def save():
+        nonlocal last_save
+        stats["done"] = min(in_flight) if in_flight else taken
+        output.flush()
+        dns_reverse_save_checkpoint(checkpoint, networks, stats["done"])
+        last_save = time.monotonic()
+
+    async def worker():
+        nonlocal taken
+        for i, address in addresses:
+            in_flight.add(i)
+            taken = i + 1
+            if limiter is not None:
+                await limiter.wait()
+
+            lines = []
+            try:
+                message = DNSMessage(await resolver.query_packet(
+                    "PTR", dns_reverse_name(address), next(servers)))
+                # NXDOMAIN simply means there is no name.
+                if message.header["RCODE"] not in (0, 3):
+                    raise ValueError("RCODE %u" % message.header["RCODE"])
+                for record in message.answers:
+                    if record.type == DNS_QUERY_TYPES["PTR"]:
+                        lines.append("%s\t%s\n" % (address, record.value))
+            except (OSError, asyncio.TimeoutError) as e:
+                lines = ["# %s %s\n" % (address, str(e) or e.__class__.__name__)]
+            except (IndexError, ValueError, struct_error) as e:
+                lines = ["# %s %s\n" % (address, e)]
+
+            stats["queries"] += 1
+            if lines and lines[0].startswith("#"):
+                stats["errors"] += 1
+            else:
+                stats["names"] += len(lines)
+            output.writelines(lines)
+            in_flight.discard(i)
+
+            if checkpoint and time.monotonic() - last_save >= checkpoint_interval:
+                save()
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        resolver.close()
+        if checkpoint:
+            save()
+        else:
+            output.flush()
+
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Simple DNS client.")
+    parser.add_argument("--bulk", metavar="FILE",
+                        help="resolve (type, domain) pairs from the file (- for stdin) "
+                             "and print the results as JSON lines")
+    parser.add_argument("--reverse", metavar="CIDR", action="append", dest="networks",
+                        help="look up the names of all the addresses in the network "
+                             "(can be given many times) and print an address to name table")
+    parser.add_argument("--server", action="append", dest="servers",
+                        help="DNS server to use (can be given many times)")
+    parser.add_argument("--port", type=int, default=53)
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="maximum number of queries in flight")
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument("--raw", action="store_true",
+                        help="output numeric types and TTLs and typed data instead of text")
+    parser.add_argument("--rate", type=float,
+                        help="maximum number of queries per second in the reverse mode")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="save the progress of the reverse mode to the file "
+                             "and resume from it when started again")
+    parser.add_argument("--output", metavar="FILE",
+                        help="append the results to the file instead of printing them")
+    args = parser.parse_args()
+
+    output = open(args.output, "a") if args.output else sys.stdout
+
+    if args.networks:
+        servers = args.servers or ["8.8.8.8"]
+        try:
+            stats = asyncio.run(dns_reverse_sweep(
+                args.networks, servers, output, args.concurrency, args.rate,
+                args.port, args.timeout, args.checkpoint))
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        sys.stderr.write("%u queries, %u names, %u errors\n" %
+                         (stats["queries"], stats["names"], stats["errors"]))
+        return
+
+    if args.bulk:
+        servers = args.servers or ["8.8.8.8"]
+        f = sys.stdin if args.bulk == "-" else open(args.bulk)
+        try:
+            stats = asyncio.run(dns_bulk_resolve(
+                dns_bulk_read_pairs(f), servers, output,
+                args.concurrency, args.port, args.timeout, raw=args.raw))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+            if output is not sys.stdout:
+                output.close()
+        sys.stderr.write("%u queries, %u errors\n" % (stats["queries"], stats["errors"]))
+        return
 
-    return ''.join(d)
+    print(dns_query("A", "kacper.bak.pl", "8.8.8.8"))
+    print(dns_query("MX", "bak.pl", "8.8.8.8"))
+    print(dns_query("TXT", "bak.pl", "dns1.domeny.tv"))
 
-print dns_query("A", "kacper.bak.pl", "8.8.8.8")
-print dns_query("MX", "bak.pl", "8.8.8.8")
-print dns_query("TXT", "bak.pl", "dns1.domeny.tv")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Measuring the throughput and latency of the tcpdns client.
+# By default the queries go to a stand-in server (tcpdns_server.py) started
+# in the same process, so the results do not depend on the Internet.
+
+import argparse
+import asyncio
+import socket
+import sys
+import time
+from struct import error as struct_error
+from threading import Event, Thread
+
+from tcpdns import AsyncDNSResolver, DNSResolver, UDPDNSResolver, dns_query
+from tcpdns_server import SAMPLE_RECORDS, SimpleDNSServer
+
+# Names covered by the wildcard among the sample records.
+def bench_names(n):
+    return ["h%u.bench.bak.pl" % i for i in range(n)]
+
+# Value below which the given fraction of the (sorted) samples lies.
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def bench_report(mode, elapsed, latencies, errors):
+    latencies.sort()
+    queries = len(latencies) + errors
+    sys.stdout.write("%-10s %8u queries %10.0f q/s   p50 %8.3f ms   p99 %8.3f ms   %u errors\n" % (
+        mode, queries, queries / elapsed if elapsed else 0.0,
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000, errors))
+
+# A new connection for every query.
+def bench_single(server, port, names):
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for name in names:
+        t = time.perf_counter()
+        try:
+            if dns_query("A", name, server, port=port) is None:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - t)
+        except (socket.error, IndexError, ValueError, struct_error):
+            errors += 1
+    return time.perf_counter() - start, latencies, errors
+
+# Persistent, pipelined connections shared by a number of threads
+# (or, with the UDP resolver, datagrams sent by a number of threads).
+def bench_pooled(server, port, names, threads, resolver=None):
+    if resolver is None:
+        resolver = DNSResolver(port=port)
+    results = [([], [0]) for _ in range(threads)]
+
+    def worker(names, latencies, errors):
+        for name in names:
+            t = time.perf_counter()
+            try:
+                resolver.query("A", name, server)
+                latencies.append(time.perf_counter() - t)
+            except (socket.error, IndexError, ValueError, struct_error):
+                errors[0] += 1
+
+    workers = [Thread(target=worker, args=(names[i::threads],) + results[i])
+               for i in range(threads)]
+    start = time.perf_counter()
+    for th in workers:
+        th.start()
+    for th in workers:
+        th.join()
+    elapsed = time.perf_counter() - start
+    resolver.close()
+
+    return (elapsed, [l for latencies, _ in results for l in latencies],
+            sum(errors[0] for _, errors in results))
+
+# Many queries in flight at once within a single thread (asyncio).
+def bench_concurrent(server, port, names, concurrency):
+    latencies = []
+    errors = [0]
+
+    async def run():
+        resolver = AsyncDNSResolver(port=port)
+        pending = iter(names)
+
+        async def worker():
+            for name in pending:
+                t = time.perf_counter()
+                try:
+                    await resolver.query("A", name, server)
+                    latencies.append(time.perf_counter() - t)
+                except (OSError, asyncio.TimeoutError, IndexError, ValueError, struct_error):
+                    errors[0] += 1
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        resolver.close()
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    return time.perf_counter() - start, latencies, errors[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the tcpdns client.")
+    parser.add_argument("--server", help="DNS server to query (a local stand-in by default)")
+    parser.add_argument("--port", type=int, default=53)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8, help="threads in the pooled mode")
+    parser.add_argument("--concurrency", type=int, default=200,
+                        help="queries in flight in the concurrent mode")
+    parser.add_argument("--modes", default="single,pooled,concurrent,udp")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="reply delay of the stand-in server in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    the_end = Event()
+    server, port = args.server, args.port
+    if server is None:
+        stand_in = SimpleDNSServer(SAMPLE_RECORDS, the_end, args.latency, args.jitter,
+                                   error_rate=args.error_rate, drop_rate=args.drop_rate)
+        server, port = "127.0.0.1", stand_in.start("127.0.0.1", 0)
+
+    names = bench_names(args.queries)
+    for mode in args.modes.split(","):
+        if mode == "single":
+            bench_report(mode, *bench_single(server, port, names))
+        elif mode == "pooled":
+            bench_report(mode, *bench_pooled(server, port, names, args.threads))
+        elif mode == "udp":
+            bench_report(mode, *bench_pooled(server, port, names, args.threads,
+                                             UDPDNSResolver(port=port)))
+        elif mode == "concurrent":
+            bench_report(mode, *bench_concurrent(server, port, names, args.concurrency))
+        else:
+            sys.stderr.write("error: unknown mode %s\n" % mode)
+
+    the_end.set()
+
+if __name__ == "__main__":
+    main()
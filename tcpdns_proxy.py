@@ -0,0 +1,361 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Caching DNS forwarder.
+# Clients send their queries over UDP or TCP, the answers come from a shared
+# cache or, when they are not there, from the upstream servers (over the
+# persistent, pipelined TCP connections of tcpdns). Identical queries that
+# arrive while the first of them is still waiting for the upstream are not
+# forwarded again, they all wait for the same answer.
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+from struct import error as struct_error, pack, unpack_from
+
+from tcpdns import (AsyncDNSResolver, DNSCache, DNSMessage, DNSUpstreamStats,
+                    dns_skip_domain)
+
+DEBUG = False # Changing to True displays additional messages.
+
+# Answers sent over UDP without EDNS0 may not be longer than this.
+UDP_PAYLOAD_SIZE = 512
+
+# A cached answer together with what is needed to serve it later:
+# the moment it was stored and the offsets of the TTLs to decrease.
+class DNSProxyCacheEntry():
+    __slots__ = ("packet", "stored", "ttl_offsets")
+
+    def __init__(self, packet, stored):
+        self.packet = packet
+        self.stored = stored
+
+        # The TTL field lies 6 bytes before RDATA (TTL, RDLENGTH).
+        # The TTL of OPT is not a TTL at all, but the extended flags.
+        message = DNSMessage(packet)
+        self.ttl_offsets = [
+            r.rdata_idx - 6 for r in message.answers + message.authority + message.additional
+            if r.type != 41]
+
+    # The answer as it should look now: with the client's ID and the TTLs
+    # decreased by the time it has spent in the cache.
+    def reply(self, query_id, now):
+        age = int(now - self.stored)
+        if age <= 0:
+            return pack(">H", query_id) + self.packet[2:]
+
+        reply = bytearray(self.packet)
+        reply[0:2] = pack(">H", query_id)
+        for offset in self.ttl_offsets:
+            ttl = unpack_from(">I", reply, offset)[0]
+            reply[offset:offset + 4] = pack(">I", max(ttl - age, 0))
+        return bytes(reply)
+
+class DNSProxy():
+    def __init__(self, upstreams, upstream_port=53, timeout=2, cache=None):
+        self.upstreams = list(upstreams)
+        if not self.upstreams:
+            raise ValueError("no upstream servers")
+        self.timeout = timeout
+        self.resolver = AsyncDNSResolver(port=upstream_port, timeout=timeout)
+        self.cache = cache if cache is not None else DNSCache(
+            max_entries=100000, max_bytes=64 * 1024 * 1024)
+
+        self.in_flight = {} # key -> future of the upstream answer
+        self.upstream_stats = dict((u, DNSUpstreamStats(u)) for u in self.upstreams)
+        self.counters = {
+            "queries": 0, "udp": 0, "tcp": 0, "hits": 0, "misses": 0,
+            "coalesced": 0, "truncated": 0, "servfail": 0, "malformed": 0
+        }
+
+    # Recognizing the query. Returns (key, question end) or None if the
+    # packet does not make sense. The key tells apart the queries that
+    # can share an answer.
+    def parse_query(self, query):
+        try:
+            message = DNSMessage(query)
+            if message.header["QDCOUNT"] != 1 or query[2] & 0x80: # Not a query.
+                return None
+            name_idx, qtype, qclass = message.questions[0]
+            name = message.domain(name_idx).lower()
+            question_end = dns_skip_domain(query, 12) + 4
+        except (IndexError, ValueError, struct_error):
+            return None
+
+        # Flags that can change the answer: RD, CD and DO (in the OPT record).
+        flags = unpack_from(">H", query, 2)[0] & 0x0110
+        for record in message.additional:
+            if record.type == 41 and record.ttl & 0x8000:
+                flags |= 0x10000
+        return (qtype, qclass, flags), name, question_end
+
+    # Largest answer the client can receive over UDP.
+    def max_udp_size(self, query):
+        try:
+            for record in DNSMessage(query).additional:
+                if record.type == 41: # OPT
+                    return max(record.rclass, UDP_PAYLOAD_SIZE)
+        except (IndexError, ValueError, struct_error):
+            pass
+        return UDP_PAYLOAD_SIZE
+
+    # Answer with just the header and the question (SERVFAIL or truncated).
+    def short_reply(self, query, question_end, flags=0, rcode=0):
+        control_word = 0x8080 | (unpack_from(">H", query, 2)[0] & 0x0110) | flags | rcode
+        return pack(">HHHHHH", unpack_from(">H", query)[0], control_word, 1, 0, 0, 0) + \
+            query[12:question_end]
+
+    # Fast path: the answer from the cache, without creating any task.
+    # Returns None if the upstream has to be asked.
+    def answer_from_cache(self, query, parsed):
+        key, name, _ = parsed
+        entry = self.cache.get("", key, name)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        return entry.reply(unpack_from(">H", query)[0], time.monotonic())
+
+    async def answer_from_upstream(self, query, parsed):
+        key, name, question_end = parsed
+
+        future = self.in_flight.get((key, name))
+        if future is None:
+            future = asyncio.ensure_future(self.__forward(query, key, name))
+            self.in_flight[(key, name)] = future
+            future.add_done_callback(lambda f: self.in_flight.pop((key, name), None))
+        else:
+            self.counters["coalesced"] += 1
+
+        try:
+            packet = await asyncio.shield(future)
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError, struct_error):
+            self.counters["servfail"] += 1
+            return self.short_reply(query, question_end, rcode=2) # SERVFAIL.
+        return pack(">H", unpack_from(">H", query)[0]) + packet[2:]
+
+    async def __forward(self, query, key, name):
+        # Start with the upstream that has been the fastest and most reliable
+        # recently, but if it fails, try the others as well.
+        error = None
+        for upstream in sorted(self.upstreams,
+                               key=lambda u: self.upstream_stats[u].score(self.timeout)):
+            stats = self.upstream_stats[upstream]
+            sent = time.monotonic()
+            try:
+                packet = await self.resolver.exchange(query, upstream)
+            except (OSError, asyncio.TimeoutError) as e:
+                stats.queries += 1
+                stats.record_error()
+                error = e
+                continue
+            stats.queries += 1
+            stats.record_latency(time.monotonic() - sent)
+
+            self.cache.put("", key, name, packet, DNSProxyCacheEntry(packet, time.monotonic()))
+            return packet
+        raise error
+
+    def fit_udp(self, query, parsed, reply):
+        if len(reply) <= UDP_PAYLOAD_SIZE or len(reply) <= self.max_udp_size(query):
+            return reply
+        # Too long for a datagram: the client should ask again over TCP.
+        self.counters["truncated"] += 1
+        return self.short_reply(query, parsed[2], flags=0x0200 | (reply[2] & 0x04) << 8)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["in_flight"] = len(self.in_flight)
+        stats["cache"] = self.cache.stats()
+        stats["upstreams"] = dict((u, {
+            "latency": s.latency,
+            "p99": s.percentile(0.99),
+            "error_rate": s.error_rate,
+            "queries": s.queries
+        }) for u, s in self.upstream_stats.items())
+        return stats
+
+class DNSProxyUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, query, addr):
+        proxy = self.proxy
+        proxy.counters["queries"] += 1
+        proxy.counters["udp"] += 1
+        parsed = proxy.parse_query(query)
+        if parsed is None:
+            proxy.counters["malformed"] += 1
+            return
+
+        # Answers from the cache are sent right away, only the misses
+        # need a task waiting for the upstream.
+        reply = proxy.answer_from_cache(query, parsed)
+        if reply is not None:
+            self.transport.sendto(proxy.fit_udp(query, parsed, reply), addr)
+        else:
+            asyncio.ensure_future(self.__answer_later(query, parsed, addr))
+
+    async def __answer_later(self, query, parsed, addr):
+        reply = await self.proxy.answer_from_upstream(query, parsed)
+        self.transport.sendto(self.proxy.fit_udp(query, parsed, reply), addr)
+
+    def error_received(self, e):
+        if DEBUG:
+            sys.stdout.write("[WARNING] UDP error: %s\n" % e)
+
+# Queries over TCP can be pipelined, so every one of them is answered as soon
+# as its answer is ready, not necessarily in the order they came in.
+async def dns_proxy_handle_tcp(proxy, reader, writer, idle_timeout=10):
+    pending = set()
+    try:
+        while True:
+            try:
+                packet_len = unpack_from(">H", await asyncio.wait_for(
+                    reader.readexactly(2), idle_timeout))[0]
+                query = await reader.readexactly(packet_len)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+                break
+            proxy.counters["queries"] += 1
+            proxy.counters["tcp"] += 1
+            parsed = proxy.parse_query(query)
+            if parsed is None:
+                proxy.counters["malformed"] += 1
+                continue
+
+            reply = proxy.answer_from_cache(query, parsed)
+            if reply is not None:
+                writer.write(pack(">H", len(reply)) + reply)
+            else:
+                task = asyncio.ensure_future(
+                    dns_proxy_answer_tcp_later(proxy, writer, query, parsed))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        writer.close()
+
+async def dns_proxy_answer_tcp_later(proxy, writer, query, parsed):
+    reply = await proxy.answer_from_upstream(query, parsed)
+    if not writer.is_closing():
+        writer.write(pack(">H", len(reply)) + reply)
+
+async def dns_proxy_report(proxy, interval):
+    last_queries = 0
+    last_time = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        stats = proxy.stats()
+        qps = (stats["queries"] - last_queries) / (now - last_time)
+        last_queries, last_time = stats["queries"], now
+
+        latencies = ", ".join(
+            "%s %s" % (u, "%.1f ms" % (s["latency"] * 1000) if s["latency"] is not None else "n/a")
+            for u, s in stats["upstreams"].items())
+        sys.stdout.write(
+            "[  INFO ] [%u] %.0f q/s, hit ratio %.2f, %u in flight, %u coalesced, "
+            "%u SERVFAIL, upstream latency: %s\n" % (
+                os.getpid(), qps, stats["cache"]["hit_ratio"], stats["in_flight"],
+                stats["coalesced"], stats["servfail"], latencies))
+        sys.stdout.flush()
+
+def dns_proxy_sockets(host, port, reuse_port=False):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    udp = socket.socket(family, socket.SOCK_DGRAM)
+    tcp = socket.socket(family, socket.SOCK_STREAM)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    for s in (udp, tcp):
+        if reuse_port:
+            # Every worker process binds the same port and the kernel
+            # spreads the clients among them.
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((host, port))
+    udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    tcp.listen(1024)
+    return udp, tcp
+
+async def dns_proxy_serve(proxy, udp, tcp, stats_interval=0):
+    loop = asyncio.get_event_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DNSProxyUDPProtocol(proxy), sock=udp)
+    server = await asyncio.start_server(
+        lambda r, w: dns_proxy_handle_tcp(proxy, r, w), sock=tcp)
+
+    if stats_interval:
+        asyncio.ensure_future(dns_proxy_report(proxy, stats_interval))
+
+    try:
+        await asyncio.Event().wait() # Forever.
+    finally:
+        server.close()
+        transport.close()
+
+def dns_proxy_worker(args, udp, tcp):
+    proxy = DNSProxy(args.upstreams, args.upstream_port, args.timeout,
+                     DNSCache(max_entries=args.cache_entries,
+                              max_bytes=args.cache_mb * 1024 * 1024))
+    try:
+        asyncio.run(dns_proxy_serve(proxy, udp, tcp, args.stats_interval))
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Caching DNS forwarder.")
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5353)
+    parser.add_argument("--upstream", action="append", dest="upstreams",
+                        help="upstream DNS server (can be given many times)")
+    parser.add_argument("--upstream-port", type=int, default=53)
+    parser.add_argument("--timeout", type=float, default=2)
+    parser.add_argument("--cache-entries", type=int, default=100000)
+    parser.add_argument("--cache-mb", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes sharing the port (each with its own cache)")
+    parser.add_argument("--stats-interval", type=float, default=10,
+                        help="how often to print statistics (0 turns them off)")
+    args = parser.parse_args()
+    args.upstreams = args.upstreams or ["8.8.8.8"]
+
+    sys.stdout.write("[  INFO ] Forwarding %s:%u to %s\n" % (
+        args.listen, args.port, ", ".join(args.upstreams)))
+    sys.stdout.flush()
+
+    if args.workers <= 1:
+        dns_proxy_worker(args, *dns_proxy_sockets(args.listen, args.port))
+        return
+
+    children = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            dns_proxy_worker(args, *dns_proxy_sockets(args.listen, args.port, reuse_port=True))
+            os._exit(0)
+        children.append(pid)
+
+    # Stopping the main process stops the workers as well.
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass # Already gone.
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        stop(None, None)
+
+if __name__ == "__main__":
+    main()
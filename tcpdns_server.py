@@ -0,0 +1,386 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# A small DNS server answering from a zone file or an in-memory record table.
+# It is meant as a stand-in for real servers when measuring the tcpdns client,
+# so apart from answering it can also slow down, truncate, fail or ignore
+# the queries on demand.
+
+import argparse
+import heapq
+import random
+import socket
+import sys
+import time
+from struct import error as struct_error, pack, unpack_from
+from threading import Condition, Event, Lock, Thread
+
+from tcpdns import (DNS_QUERY_TYPES, DNSMessage, dns_encode_domain,
+                    dns_skip_domain, dns_tcp_recv_packet, dns_tcp_send_packet)
+
+DEBUG = False # Changing to True displays additional messages.
+
+# Answers sent over UDP without EDNS0 may not be longer than this.
+UDP_PAYLOAD_SIZE = 512
+
+# Records served when no zone file is given.
+# A name starting with "*." matches any name below it.
+SAMPLE_RECORDS = [
+    ("bak.pl", 3600, "SOA", "dns1.domeny.tv. hostmaster.bak.pl. 1 7200 3600 1209600 300"),
+    ("bak.pl", 3600, "NS", "dns1.domeny.tv."),
+    ("bak.pl", 3600, "MX", "10 mail.bak.pl."),
+    ("bak.pl", 3600, "TXT", "\"v=spf1 mx -all\""),
+    ("kacper.bak.pl", 300, "A", "192.0.2.10"),
+    ("mail.bak.pl", 300, "A", "192.0.2.25"),
+    ("www.bak.pl", 300, "CNAME", "kacper.bak.pl."),
+    ("*.bench.bak.pl", 60, "A", "192.0.2.1"),
+    ("*.bench.bak.pl", 60, "MX", "10 mail.bak.pl."),
+]
+
+# Encoding the textual form of RDATA (as in zone files) into bytes.
+def dns_encode_rdata(rtype, text):
+    tokens = text.split()
+    buf = bytearray()
+
+    if rtype == "A":
+        buf += socket.inet_aton(text.strip())
+    elif rtype == "AAAA":
+        buf += socket.inet_pton(socket.AF_INET6, text.strip())
+    elif rtype in ("NS", "CNAME", "PTR"):
+        dns_encode_domain(buf, tokens[0])
+    elif rtype == "MX":
+        buf += pack(">H", int(tokens[0]))
+        dns_encode_domain(buf, tokens[1])
+    elif rtype == "SRV":
+        buf += pack(">HHH", int(tokens[0]), int(tokens[1]), int(tokens[2]))
+        dns_encode_domain(buf, tokens[3])
+    elif rtype == "SOA":
+        dns_encode_domain(buf, tokens[0])
+        dns_encode_domain(buf, tokens[1])
+        buf += pack(">IIIII", *[int(t) for t in tokens[2:7]])
+    elif rtype == "TXT":
+        # Every quoted fragment becomes a separate string, at most 255 bytes each.
+        fragments = [f for f in text.strip().split('"') if f.strip()] or [""]
+        for fragment in fragments:
+            fragment = fragment.encode("utf-8")
+            for i in range(0, max(len(fragment), 1), 255):
+                chunk = fragment[i:i + 255]
+                buf.append(len(chunk))
+                buf += chunk
+    else:
+        raise ValueError("unsupported record type %s" % rtype)
+
+    return bytes(buf)
+
+# Reading a zone file in a simplified master file format (RFC 1035), e.g.:
+#   $ORIGIN bak.pl.
+#   $TTL 3600
+#   @       IN  MX  10 mail
+#   kacper  300 IN  A   192.0.2.10
+# Every record has to be written in a single line.
+def dns_read_zone(f):
+    origin = ""
+    default_ttl = 3600
+    records = []
+
+    def absolute(name):
+        if name == "@":
+            return origin
+        if name.endswith("."):
+            return name[:-1]
+        return "%s.%s" % (name, origin) if origin else name
+
+    for line in f:
+        line = line.split(";", 1)[0].rstrip()
+        if not line.strip():
+            continue
+
+        tokens = line.split()
+        if tokens[0] == "$ORIGIN":
+            origin = tokens[1].rstrip(".")
+            continue
+        if tokens[0] == "$TTL":
+            default_ttl = int(tokens[1])
+            continue
+
+        # The name, the TTL and the class can be omitted.
+        name = records[-1][0] if line[0].isspace() else absolute(tokens.pop(0))
+        ttl = default_ttl
+        if tokens[0].isdigit():
+            ttl = int(tokens.pop(0))
+        if tokens[0].upper() == "IN":
+            tokens.pop(0)
+        rtype = tokens.pop(0).upper()
+
+        rdata = " ".join(tokens)
+        if rtype in ("NS", "CNAME", "PTR", "MX", "SRV", "SOA"):
+            # Names inside RDATA are relative to the origin as well.
+            rdata = " ".join(absolute(t) + "." if not t.isdigit() else t for t in tokens)
+        records.append((name, ttl, rtype, rdata))
+
+    return records
+
+# Thread sending replies after a delay.
+# One thread with a queue ordered by time costs much less than a timer per query.
+class DelayedSender(Thread):
+    def __init__(self, the_end):
+        super(DelayedSender, self).__init__()
+        self.daemon = True
+        self.the_end = the_end
+        self.queue = []
+        self.counter = 0
+        self.cv = Condition()
+
+    def schedule(self, delay, send, *args):
+        with self.cv:
+            self.counter += 1
+            heapq.heappush(self.queue, (time.monotonic() + delay, self.counter, send, args))
+            self.cv.notify()
+
+    def run(self):
+        while not self.the_end.is_set():
+            with self.cv:
+                if not self.queue:
+                    self.cv.wait(0.5)
+                    continue
+                when = self.queue[0][0]
+                now = time.monotonic()
+                if when > now:
+                    self.cv.wait(when - now)
+                    continue
+                _, _, send, args = heapq.heappop(self.queue)
+
+            try:
+                send(*args)
+            except socket.error:
+                pass # The client went away in the meantime.
+
+class SimpleDNSServer():
+    def __init__(self, records, the_end, latency=0.0, jitter=0.0,
+                 truncate_rate=0.0, error_rate=0.0, drop_rate=0.0):
+        self.the_end = the_end
+        self.latency = latency
+        self.jitter = jitter
+        self.truncate_rate = truncate_rate
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+
+        # (name, type code) -> [encoded records]
+        self.records = {}
+        self.names = set()
+        self.soa = {}
+        for name, ttl, rtype, rdata in records:
+            name = name.lower().rstrip(".")
+            code = DNS_QUERY_TYPES[rtype]
+            rdata = dns_encode_rdata(rtype, rdata)
+            record = pack(">HHHIH", 0xc00c, code, 1, ttl, len(rdata)) + rdata
+            self.records.setdefault((name, code), []).append(record)
+            self.names.add(name)
+            if rtype == "SOA":
+                self.soa[name] = (ttl, rdata)
+
+        self.sender = DelayedSender(the_end)
+        self.stats_lock = Lock()
+        self.stats = { "queries": 0, "errors": 0, "truncated": 0, "dropped": 0 }
+
+    def __count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def __find_records(self, name, code):
+        if name in self.names:
+            return self.records.get((name, code))
+
+        # Look for a wildcard covering the name.
+        parent = name.split(".", 1)[1] if "." in name else ""
+        return self.records.get(("*." + parent, code))
+
+    def __has_name(self, name):
+        if name in self.names:
+            return True
+        parent = name.split(".", 1)[1] if "." in name else ""
+        return "*." + parent in self.names
+
+    def __find_soa(self, name):
+        while name:
+            if name in self.soa:
+                return name, self.soa[name]
+            name = name.split(".", 1)[1] if "." in name else ""
+        return None
+
+    # Prepare the reply to a query. None means that no reply should be sent.
+    def answer(self, query, udp=False):
+        try:
+            message = DNSMessage(query)
+            name_idx, qtype, qclass = message.questions[0]
+            name = message.domain(name_idx).lower()
+            question_end = dns_skip_domain(query, 12) + 4
+        except (IndexError, ValueError, struct_error):
+            return None # Not a query at all.
+
+        self.__count("queries")
+        if random.random() < self.drop_rate:
+            self.__count("dropped")
+            return None
+
+        # QR, AA and RA are set, RD is copied from the query.
+        rd = unpack_from(">H", query, 2)[0] & 0x0100
+        rcode = 0
+        answers = []
+        authority = []
+
+        if random.random() < self.error_rate:
+            self.__count("errors")
+            rcode = 2 # SERVFAIL.
+        else:
+            # If there is no record of the requested type, maybe the name is an alias.
+            answers = (self.__find_records(name, qtype) or
+                       self.__find_records(name, DNS_QUERY_TYPES["CNAME"]) or [])
+
+            if not answers:
+                if not self.__has_name(name):
+                    rcode = 3 # NXDOMAIN.
+                soa = self.__find_soa(name)
+                if soa is not None:
+                    # Negative answers carry the SOA of the zone (RFC 2308).
+                    zone, (ttl, rdata) = soa
+                    buf = bytearray()
+                    dns_encode_domain(buf, zone)
+                    buf += pack(">HHIH", DNS_QUERY_TYPES["SOA"], 1, ttl, len(rdata))
+                    buf += rdata
+                    authority = [bytes(buf)]
+
+        control_word = 0x8000 | 0x0400 | rd | 0x0080 | rcode
+        reply = (pack(">HHHHHH", message.header["ID"], control_word, 1,
+                      len(answers), len(authority), 0) +
+                 query[12:question_end] + b"".join(answers) + b"".join(authority))
+
+        if udp:
+            limit = UDP_PAYLOAD_SIZE
+            for record in message.additional:
+                if record.type == 41: # OPT, the client can receive more.
+                    limit = max(record.rclass, UDP_PAYLOAD_SIZE)
+            if len(reply) > limit or random.random() < self.truncate_rate:
+                # Send only the header and the question, with the TC flag set.
+                self.__count("truncated")
+                reply = (pack(">HHHHHH", message.header["ID"], control_word | 0x0200,
+                              1, 0, 0, 0) + query[12:question_end])
+
+        return reply
+
+    def __delay(self):
+        if self.jitter:
+            return max(0.0, random.gauss(self.latency, self.jitter))
+        return self.latency
+
+    def __reply(self, send, *args):
+        delay = self.__delay()
+        if delay > 0:
+            self.sender.schedule(delay, send, *args)
+        else:
+            send(*args)
+
+    def serve_udp(self, s):
+        s.settimeout(0.5)
+        while not self.the_end.is_set():
+            try:
+                query, addr = s.recvfrom(0xffff)
+            except socket.timeout:
+                continue
+            reply = self.answer(query, udp=True)
+            if reply is not None:
+                self.__reply(s.sendto, reply, addr)
+        s.close()
+
+    def serve_tcp(self, s):
+        s.settimeout(0.5)
+        while not self.the_end.is_set():
+            try:
+                c, c_addr = s.accept()
+                c.settimeout(None)
+            except socket.timeout:
+                continue
+            if DEBUG:
+                sys.stdout.write("[  INFO ] New connection: %s:%i\n" % c_addr[:2])
+            th = Thread(target=self.__handle_tcp_client, args=(c,))
+            th.daemon = True
+            th.start()
+        s.close()
+
+    def __handle_tcp_client(self, c):
+        # Queries can be pipelined, and with a delay the replies can even
+        # overtake each other, so sending is serialized by a lock.
+        send_lock = Lock()
+
+        def send(reply):
+            with send_lock:
+                dns_tcp_send_packet(c, reply)
+
+        try:
+            while not self.the_end.is_set():
+                query = dns_tcp_recv_packet(c)
+                if query is None:
+                    break
+                reply = self.answer(query)
+                if reply is not None:
+                    self.__reply(send, reply)
+        except socket.error:
+            pass
+        finally:
+            c.close()
+
+    # Start serving on the given address over both TCP and UDP
+    # (in background threads).
+    def start(self, host="127.0.0.1", port=5353):
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tcp.bind((host, port))
+        tcp.listen(128)
+        port = tcp.getsockname()[1] # In case port 0 (any free port) was given.
+
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.bind((host, port))
+
+        self.sender.start()
+        for target, s in ((self.serve_tcp, tcp), (self.serve_udp, udp)):
+            th = Thread(target=target, args=(s,))
+            th.daemon = True
+            th.start()
+
+        return port
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in DNS server for testing tcpdns.")
+    parser.add_argument("--zone", help="zone file to serve (built-in sample records by default)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5353)
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of every reply in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of the delay")
+    parser.add_argument("--truncate-rate", type=float, default=0.0,
+                        help="fraction of UDP replies sent truncated")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of queries answered with SERVFAIL")
+    parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="fraction of queries left without a reply")
+    args = parser.parse_args()
+
+    records = SAMPLE_RECORDS
+    if args.zone:
+        with open(args.zone) as f:
+            records = dns_read_zone(f)
+
+    the_end = Event()
+    server = SimpleDNSServer(records, the_end, args.latency, args.jitter,
+                             args.truncate_rate, args.error_rate, args.drop_rate)
+    port = server.start(args.host, args.port)
+    sys.stdout.write("[  INFO ] Serving %u records on %s:%u (TCP and UDP)\n" % (
+        len(records), args.host, port))
+
+    try:
+        while not the_end.is_set():
+            the_end.wait(1)
+    except KeyboardInterrupt:
+        the_end.set()
+
+if __name__ == "__main__":
+    main()